@@ -3,18 +3,21 @@ from __future__ import division
 from __future__ import print_function
 
 import asyncio
+import signal as os_signal
 import time, datetime
-from dask.distributed import LocalCluster, Client
+from dask.distributed import Client
 from multiprocessing import Process, Pipe, TimeoutError
 
-from utils import AsyncTimer
+from utils import AsyncTimer, create_local_cluster, init_workers
 from intrusion_detection import IntrusionDetectionPipeline
 
 from jagereye_ng import video_proc as vp
-from jagereye_ng import gpu_worker
 from jagereye_ng.api import APIConnector
 from jagereye_ng.io.streaming import VideoStreamReader, ConnectionError
-from jagereye_ng.io import io_worker, notification, database
+from jagereye_ng.io.stream_copy import StreamCopyRecorder
+from jagereye_ng.io import notification, database, shared_frames
+from jagereye_ng.io.encoder_pool import get_encoder_pool
+from jagereye_ng.io.encoder_pool import shutdown_encoder_pool
 from jagereye_ng.util.generic import get_config
 from jagereye_ng import logging
 
@@ -25,24 +28,56 @@ class HotReconfigurationError(Exception):
                 " stop analyzer first before updating it.")
 
 
-def create_pipeline(anal_id, pipelines, frame_size):
+def create_pipeline(anal_id, pipelines, frame_size, recorder=None,
+                    event_handler=None, cache_key=None):
     result = []
     for p in pipelines:
         if p["type"] == "IntrusionDetection":
             config = get_config()["apps"]["intrusion_detection"]
             params = p["params"]
+            # A pipeline has either several named zones or a single roi.
+            zones = params.get("zones")
+            if zones is None:
+                zones = [{"roi": params["roi"],
+                          "triggers": params["triggers"]}]
             result.append(IntrusionDetectionPipeline(
                 anal_id,
-                params["roi"],
-                params["triggers"],
+                zones,
                 frame_size,
                 config["detect_threshold"],
                 config["video_format"],
                 config["fps"],
-                config["history_len"]))
+                config["history_len"],
+                recorder,
+                event_handler,
+                config["crop_motion"],
+                params.get("cache_ttl", config["cache_ttl"]),
+                config["detect_interval"],
+                config["correlation_tracker"],
+                cache_key))
     return result
 
 
+def create_motion_mask(pipelines, video_info, scale=None):
+    """Create the mask of the regions where motion matters to the pipelines.
+
+    Args:
+        pipelines (list): The pipelines from create_pipeline().
+        video_info (dict): The video information of the source reader.
+        scale (float): The scale of motion detection. Defaults to None.
+
+    Returns:
+        The roi mask for motion detection, or None if some pipeline has no
+        roi.
+    """
+    rois = [getattr(p, "rois", None) for p in pipelines]
+    if not rois or any(r is None for r in rois):
+        return None
+    rois = [roi for r in rois for roi in r]
+    motion_size = vp.get_motion_size(video_info["analysis_size"], scale)
+    return vp.create_roi_mask(rois, video_info["frame_size"], motion_size)
+
+
 class Driver(object):
     def __init__(self):
         self._driver_process = None
@@ -91,12 +126,21 @@ class Driver(object):
     def recv(self):
         return self._sig_parent.recv()
 
+    @staticmethod
+    def _exit_on_sigterm(signum, frame):
+        raise SystemExit(128 + signum)
+
     @staticmethod
     def run_driver_func(driver_func, signal, *argv):
+        # Exit through the cleanup of the driver when it's terminated, so it
+        # doesn't leave its shared memory segments behind.
+        os_signal.signal(os_signal.SIGTERM, Driver._exit_on_sigterm)
         try:
             driver_func(signal, *argv[0])
         finally:
             signal.close()
+            # The process exits without running the atexit handlers.
+            shared_frames.close_rings()
 
 
 class Analyzer():
@@ -104,6 +148,7 @@ class Analyzer():
     STATUS_CREATED = "created"
     STATUS_STARTING = "starting"
     STATUS_RUNNING = "running"
+    STATUS_DEGRADED = "degraded"
     STATUS_SRC_DOWN = "source_down"
     STATUS_STOPPED = "stopped"
 
@@ -117,9 +162,13 @@ class Analyzer():
         self._status = Analyzer.STATUS_CREATED
         self._status_timer = None
 
+    def _is_active(self):
+        return self._status in (Analyzer.STATUS_RUNNING,
+                                Analyzer.STATUS_DEGRADED,
+                                Analyzer.STATUS_STARTING)
+
     def _check_hot_reconfiguring(self):
-        if (self._status == Analyzer.STATUS_RUNNING or
-                self._status == Analyzer.STATUS_STARTING):
+        if self._is_active():
             raise HotReconfigurationError()
 
     @property
@@ -163,9 +212,19 @@ class Analyzer():
                 self._wait_for_driver_countdown -= 1
             else:
                 self._status = Analyzer.STATUS_SRC_DOWN
-        elif self._status == Analyzer.STATUS_RUNNING:
-            if self._driver.poll() and self._driver.recv() == "source_down":
-                self._status = Analyzer.STATUS_SRC_DOWN
+        elif (self._status == Analyzer.STATUS_RUNNING or
+                self._status == Analyzer.STATUS_DEGRADED):
+            # The driver reports "degraded" while its reader is reconnecting
+            # to the source, and "recovered" once it's reconnected.
+            while self._driver.poll():
+                msg = self._driver.recv()
+                if msg == "source_down":
+                    self._status = Analyzer.STATUS_SRC_DOWN
+                    break
+                elif msg == "degraded":
+                    self._status = Analyzer.STATUS_DEGRADED
+                elif msg == "recovered":
+                    self._status = Analyzer.STATUS_RUNNING
         elif self._status == Analyzer.STATUS_SRC_DOWN:
             # Try to restart the driver process
             self.start()
@@ -185,8 +244,7 @@ class Analyzer():
         self._driver.terminate()
 
     def start(self):
-        if (self._status != Analyzer.STATUS_RUNNING and
-                self._status != Analyzer.STATUS_STARTING):
+        if not self._is_active():
             self._driver.start(analyzer_main_func,
                                self._cluster,
                                self._id,
@@ -198,8 +256,7 @@ class Analyzer():
             self._setup_timer()
 
     def stop(self):
-        if (self._status == Analyzer.STATUS_RUNNING or
-                self._status == Analyzer.STATUS_STARTING):
+        if self._is_active():
             self._cleanup_timer()
             self._cleanup_driver()
         self._status = Analyzer.STATUS_STOPPED
@@ -212,15 +269,25 @@ def analyzer_main_func(signal, cluster, anal_id, name, source, pipelines):
     logging.info("Starts running Analyzer: {}".format(name))
     config = get_config()["apps"]["base"]
 
-    src_reader = VideoStreamReader()
+    src_reader = VideoStreamReader(preallocate=config["preallocate"])
     try:
-        src_reader.open(source["url"])
+        src_reader.open(source["url"],
+                        decimate=config["decimate"],
+                        analysis_size=config["analysis_size"],
+                        reconnect_attempts=config["reconnect_attempts"])
     except ConnectionError:
         signal.send("source_down")
         raise
     else:
         video_info = src_reader.get_video_info()
 
+    # Cut event videos from the compressed source stream, instead of
+    # re-encoding frames, if possible.
+    recorder = None
+    if config["stream_copy"] and StreamCopyRecorder.supports(source["url"]):
+        recorder = StreamCopyRecorder(source["url"])
+        recorder.start()
+
     try:
         # TODO: Get the address of scheduler from the configuration
         #       file.
@@ -229,16 +296,38 @@ def analyzer_main_func(signal, cluster, anal_id, name, source, pipelines):
         pipelines = create_pipeline(
             anal_id,
             pipelines,
-            video_info["frame_size"])
+            video_info["frame_size"],
+            recorder)
+        motion_detector = vp.MotionDetector(
+            config["motion_threshold"],
+            config["motion_scale"],
+            create_motion_mask(pipelines, video_info, config["motion_scale"]),
+            config["motion_learning_rate"])
+
+        encoder_pool = get_encoder_pool(config["encoder_threads"])
 
         signal.send("ready")
 
+        degraded = False
+        next_metrics_time = time.time() + config["metrics_interval"]
         while True:
-            frames = src_reader.read(batch_size=config["read_batch_size"])
-            motions = vp.detect_motion(frames, config["motion_threshold"])
-
-            for p in pipelines:
-                p.run(frames, motions)
+            # Don't block on reading for too long, so we can still handle
+            # signals while the reader is reconnecting to the source.
+            frames = src_reader.read(batch_size=config["read_batch_size"],
+                                     timeout=1)
+            if src_reader.is_reconnecting() != degraded:
+                degraded = not degraded
+                signal.send("degraded" if degraded else "recovered")
+
+            if len(frames) > 0:
+                motions = motion_detector.detect(frames)
+                for p in pipelines:
+                    p.run(frames, motions)
+
+            if time.time() >= next_metrics_time:
+                next_metrics_time += config["metrics_interval"]
+                logging.info("Encoder pool of {}: {}".format(
+                    name, encoder_pool.get_metrics()))
 
             if signal.poll() and signal.recv() == "stop":
                 break
@@ -252,6 +341,10 @@ def analyzer_main_func(signal, cluster, anal_id, name, source, pipelines):
         for p in pipelines:
             if hasattr(p, "release"):
                 p.release()
+        if recorder is not None:
+            recorder.release()
+        # Wait for the event videos that are still being encoded.
+        shutdown_encoder_pool()
         dask.close()
         logging.info("Analyzer terminated: {}".format(name))
 
@@ -350,21 +443,13 @@ class AnalyzerManager(APIConnector):
 
 
 if __name__ == "__main__":
-    cluster = LocalCluster(n_workers=0)
-
-    # Add worker services
-    # TODO: Get the number of GPU from configuration file
-    cluster.start_worker(name="GPU_WORKER-1", resources={"GPU": 1})
-    cluster.start_worker(name="IO_WORKER-1", resources={"IO": 1})
+    # Remove the shared memory segments of the drivers of a previous run
+    # that were killed.
+    shared_frames.remove_stale_segments()
+    cluster = create_local_cluster()
 
     with cluster, Client(cluster.scheduler_address) as client:
-        # Initialize GPU workers
-        results = client.run(gpu_worker.init_worker, ".")
-        assert all([v == "OK" for _, v in results.items()]), "Failed to initialize GPU workers"
-
-        # Initialize IO worker
-        results = client.run(io_worker.init_worker)
-        assert all([v == "OK" for _, v in results.items()]), "Failed to initialize IO worker"
+        init_workers(client)
 
         # Start analyzer manager
         io_loop = asyncio.get_event_loop()
@@ -5,13 +5,36 @@ from __future__ import print_function
 import os
 import time
 import abc
+import threading
 from collections import deque
+from concurrent import futures
 
-from jagereye_ng.io.streaming import VideoStreamWriter
+from jagereye_ng.io.encoder_pool import get_encoder_pool
 from jagereye_ng.io.obj_storage import ObjectStorageClient
 from jagereye_ng import logging
 
 
+# The number of threads that cut and save the event videos of the process.
+MAX_SAVE_WORKERS = 2
+
+_save_executor = None
+_save_executor_lock = threading.Lock()
+
+
+def _get_save_executor():
+    """Get the executor that cuts and saves event videos.
+
+    Remuxing and uploading videos may take seconds, so they run on the
+    executor instead of blocking the frame loop or the encoder threads.
+    """
+    global _save_executor
+    with _save_executor_lock:
+        if _save_executor is None:
+            _save_executor = futures.ThreadPoolExecutor(
+                max_workers=MAX_SAVE_WORKERS)
+        return _save_executor
+
+
 class EventVideoFrame(object):
     """A class used to store VideoFrame object and its event metadata
 
@@ -27,10 +50,28 @@ class EventVideoFrame(object):
     def image(self):
         return self._frame.image
 
+    @property
+    def analysis_image(self):
+        return self._frame.analysis_image
+
     @property
     def timestamp(self):
         return self._frame.timestamp
 
+    @property
+    def after_gap(self):
+        return self._frame.after_gap
+
+    def detach(self):
+        """Get a frame that stays valid after the next read of the reader.
+
+        See `VideoFrame.detach()`.
+        """
+        frame = self._frame.detach()
+        if frame is self._frame:
+            return self
+        return EventVideoFrame(frame, self.metadata)
+
 
 class EventVideoWriter(object):
     """A class used to generate event video.
@@ -45,9 +86,16 @@ class EventVideoWriter(object):
         fps (int): The fps of the output video.
         size (tuple): The size of the output video. The format is
             (width, height).
+        recorder (StreamCopyRecorder): The recorder to cut the video from,
+            instead of encoding the written frames with the encoder pool of
+            the process. Defaults to None.
+        record_start (timestamp): The timestamp of the first written frame,
+            which is used to cut the video from the recorder. Defaults to
+            `timestamp`.
     """
-    def __init__(self, video_key, metadata_key, timestamp, metadata, fps, size):
-        self._writer = VideoStreamWriter()
+    def __init__(self, video_key, metadata_key, timestamp, metadata, fps, size,
+                 recorder=None, record_start=None):
+        self._recorder = recorder
         self._video_key = video_key
         self._metadata_key = metadata_key
         self._tmp_filepath = os.path.join("/tmp", self._video_key)
@@ -69,17 +117,22 @@ class EventVideoWriter(object):
         except KeyError:
             raise
 
-        try:
-            self._writer.open(self._tmp_filepath, fps, size)
-        except RuntimeError:
-            raise
+        self._future = None
+        if self._recorder is None:
+            self._job = get_encoder_pool().open(self._tmp_filepath, fps, size)
+        else:
+            # Keep the recorded stream until the video is cut.
+            self._record_start = (record_start if record_start is not None
+                                  else timestamp)
+            self._hold_id = self._recorder.hold(self._record_start)
 
         # Connect to Object Store service
         self._obj_store = ObjectStorageClient()
         self._obj_store.connect()
 
     def _write(self, frame):
-        self._writer.write(frame)
+        if self._recorder is None:
+            self._job.write(frame)
         self._metadata[self._event_name]["frames"].append(frame.metadata)
 
     def write(self, frames):
@@ -90,10 +143,67 @@ class EventVideoWriter(object):
             self._write(frames)
 
     def end(self, timestamp=None):
-        self._writer.end()
-        self._metadata[self._event_name]["end"] = float(
-            timestamp if timestamp is not None else time.time())
+        """Finish the video and save it to the object store.
+
+        The video is saved asynchronously, once it's encoded by the encoder
+        pool or cut from the recorder, call `wait()` to wait for it.
+        """
+        end_timestamp = float(timestamp if timestamp is not None
+                              else time.time())
+        self._metadata[self._event_name]["end"] = end_timestamp
+        if self._recorder is None:
+            self._job.end(self._on_encoded)
+        else:
+            self._future = _get_save_executor().submit(self._export,
+                                                       end_timestamp)
+
+    def wait(self, timeout=None):
+        """Wait for the video to be saved.
+
+        Returns:
+            True if the video is saved and false if the wait timed out.
+        """
+        start = time.time()
+        if self._recorder is None and not self._job.wait(timeout):
+            return False
+        # The future is set once the video is encoded or ended.
+        if self._future is None:
+            return True
+        if timeout is not None:
+            timeout = max(0.0, timeout - (time.time() - start))
+        (done, _) = futures.wait([self._future], timeout)
+        return bool(done)
+
+    def _export(self, end_timestamp):
+        # The video is cut from the keyframe before the first frame, so it
+        # may start earlier than the frame metadata.
+        try:
+            self._metadata["video_start"] = self._recorder.export(
+                self._tmp_filepath, self._record_start, end_timestamp)
+        except Exception as e:
+            logging.error("Failed to cut video {}: {}"
+                          .format(self._video_key, e))
+            return
+        finally:
+            self._recorder.unhold(self._hold_id)
+        self._save()
+
+    def _on_encoded(self, job):
+        if job.exception is not None:
+            logging.error("Failed to encode video {}: {}"
+                          .format(self._video_key, job.exception))
+            return
+        # Don't hold up the encoder thread with the upload.
+        self._future = _get_save_executor().submit(self._save)
+
+    def _save(self):
+        try:
+            self._upload()
+        except Exception as e:
+            logging.error("Failed to save video {}: {}"
+                          .format(self._video_key, e))
 
+    def _upload(self):
         # TODO: Add error handling for failure of writing to object store.
         # Write out video file to object store.
         self._obj_store.save_file_obj(self._video_key, self._tmp_filepath)
@@ -140,6 +250,10 @@ class EventVideoAgent(object):
         history_len (int): The length, in seconds, of frame history queue. This
             determines when the agent starts to record before policy returning
             action "START_RECORDING".
+        recorder (StreamCopyRecorder): The recorder of the source. If it's
+            given, event videos are cut from its compressed stream without
+            re-encoding, and frames are only used for the video metadata.
+            Defaults to None.
     """
 
     STATE_RECORDING = 0
@@ -152,7 +266,8 @@ class EventVideoAgent(object):
                  frame_size,
                  video_format="mp4",
                  fps=15,
-                 history_len=3):
+                 history_len=3,
+                 recorder=None):
         """Initialize a EventVideoAgent object."""
         self._policy = policy
         self._obj_key_prefix = obj_key_prefix
@@ -164,10 +279,20 @@ class EventVideoAgent(object):
         max_history_frames = self._fps * history_len
         self._history_q = deque(maxlen=max_history_frames)
         self._current_writer = None
+        # The ended writers whose videos may not be saved yet.
+        self._ended_writers = []
         self._state = EventVideoAgent.STATE_PASSTHROUGH
 
+        self._recorder = recorder
+        if self._recorder is not None:
+            self._recorder.retain(history_len)
+
     def process(self, frame):
-        """Process the frame to generate event video."""
+        """Process the frame to generate event video.
+
+        The frame is kept in the history queue or queued to be encoded, so
+        a frame leased from the ring buffer of a reader is copied first.
+        """
 
         class AgentEvent(object):
             __slots__ = ["action", "content"]
@@ -180,6 +305,7 @@ class EventVideoAgent(object):
         # Determine what action needs to be taken for the incoming frame
         # according to the user-defined policy.
         action = self._policy.compute(frame)
+        frame = frame.detach()
         if self._state == EventVideoAgent.STATE_PASSTHROUGH:
             self._history_q.append(frame)
             if action == EventVideoPolicy.START_RECORDING:
@@ -194,7 +320,9 @@ class EventVideoAgent(object):
                     timestamp,
                     self._event_metadata,
                     self._fps,
-                    self._frame_size)
+                    self._frame_size,
+                    self._recorder,
+                    self._history_q[0].timestamp)
 
                 # Flush out history queue to event video
                 history = self._history_q.copy()
@@ -210,6 +338,9 @@ class EventVideoAgent(object):
             self._current_writer.write(frame)
             if action == EventVideoPolicy.STOP_RECORDING:
                 self._current_writer.end(frame.timestamp)
+                self._ended_writers = [w for w in self._ended_writers
+                                       if not w.wait(0)]
+                self._ended_writers.append(self._current_writer)
                 agent_event = AgentEvent(action)
                 self._state = EventVideoAgent.STATE_PASSTHROUGH
 
@@ -218,4 +349,9 @@ class EventVideoAgent(object):
     def release(self):
         if self._state == EventVideoAgent.STATE_RECORDING:
             self._current_writer.end()
+            self._ended_writers.append(self._current_writer)
+        # Wait for the videos to be saved before the recorder is released.
+        for writer in self._ended_writers:
+            writer.wait()
+        self._ended_writers = []
         self._history_q.clear()
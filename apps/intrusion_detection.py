@@ -3,7 +3,10 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import re
 import datetime
+import cv2
+import numpy as np
 from pytz import timezone
 from dask.distributed import get_client
 from shapely import geometry
@@ -12,13 +15,28 @@ from events import EventVideoFrame, EventVideoAgent, EventVideoPolicy
 
 from jagereye_ng import image as im
 from jagereye_ng import gpu_worker
+from jagereye_ng.gpu_worker.detections import DETECTION_DTYPE
+from jagereye_ng import video_proc as vp
+from jagereye_ng.video_proc.tracker import ObjectTracker
+from jagereye_ng.io.streaming import VideoFrame
 from jagereye_ng.io.obj_storage import ObjectStorageClient
 from jagereye_ng.io.notification import Notification
 from jagereye_ng.io.database import Database
+from jagereye_ng.io.shared_frames import (DEFAULT_SHARED_RING_SIZE,
+                                          SharedFrameRing,
+                                          get_local_workers)
 from jagereye_ng import logging
 
 
 EVENT_ALERT_COLOR_CODE = (34, 87, 255)
+# The maximum number of motion regions of a frame to detect objects in.
+MAX_MOTION_CROPS = 3
+# The crops are snapped outward to a grid of this many cells on each side,
+# so the crops of a static scene keep the same boxes, which are part of the
+# cache keys of their detections.
+CROP_GRID = 32
+# The zone names are used in object keys and file paths.
+ZONE_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
 
 
 def load_category_index(path):
@@ -64,58 +82,74 @@ def transform_roi_format(roi, frame_size):
     return tuple(result)
 
 
-class IntrusionDetector(object):
-    """A class used to detect intrusion event.
+def _snap_box(box, grid=CROP_GRID):
+    """Snap a normalized box outward to a grid of `grid` cells per side."""
+    (xmin, ymin, xmax, ymax) = box
+    return (float(np.floor(xmin * grid)) / grid,
+            float(np.floor(ymin * grid)) / grid,
+            min(1.0, float(np.ceil(xmax * grid)) / grid),
+            min(1.0, float(np.ceil(ymax * grid)) / grid))
 
-    Attributes:
-        roi (list of object): The region of interest with format of a list
-            of tuple, such as [(21, 33), (32, 43), ...]
-        triggers (list of string): The target of interest.
-        frame_size (tuple): The frame size of input image frames with
-            format (width, height).
-        detect_threshold (float): The threshold of the detected object
-            confidence value (between 0 and 1).
+
+def output_event(database, notification, message):
+    """Save an event message to database and push it as a notification.
+
+    Args:
+        database (Database): The database service.
+        notification (Notification): The notification service.
+        message (dict): The event message to be outputted.
     """
+    timestamp = message["timestamp"]
 
-    STATE_NORMAL = 0
-    STATE_ALERT_START = 1
-    STATE_ALERTING = 2
-    STATE_ALERT_END = 3
+    # Save event to database
+    date_obj = (datetime.datetime
+                .utcfromtimestamp(timestamp)
+                .replace(tzinfo=timezone("UTC")))
+    message.update({"date": date_obj})
+    database.save_event(message)
 
-    def __init__(self, roi, triggers, frame_size, detect_threshold=0.25):
-        try:
-            # Get Dask client
-            self._client = get_client()
-        except ValueError:
-            assert False, ("Should connect to Dask scheduler before"
-                           " initializing this object.")
+    # Push notification
+    mlsec = repr(timestamp).split(".")[1][:3]
+    date_str = (datetime.datetime
+                .utcfromtimestamp(timestamp)
+                .replace(tzinfo=timezone("UTC"))
+                .strftime("%Y-%m-%dT%H:%M:%S.{}Z".format(mlsec)))
+    message.update({"date": date_str})
+    notification.push("Analyzer", message)
 
-        self._roi = roi
-        self._roi_polygon = geometry.Polygon(self._roi)
-        self.frame_size = frame_size
+
+class Zone(object):
+    """A zone of the frame to detect intrusion in.
+
+    Attributes:
+        name (string): The name of the zone, or None for the only zone of a
+            pipeline with a single roi.
+        roi (tuple of tuple): The region of the zone with format of a tuple
+            of points, such as ((21, 33), (32, 43), ...). It's read-only,
+            since the polygon of the zone and the masks of the detector are
+            built from it.
+        triggers (list of string): The target of interest of the zone.
+        detect_threshold (float): The threshold of the detected object
+            confidence value (between 0 and 1) of the zone.
+    """
+
+    def __init__(self, name, roi, triggers, detect_threshold):
+        self.name = name
+        self._roi = tuple(tuple(point) for point in roi)
         self.triggers = triggers
         self.detect_threshold = detect_threshold
-        self._category_index = load_category_index("./coco.labels")
-        self._max_margin = 3 * 15
-        self._state = IntrusionDetector.STATE_NORMAL
-
-        logging.info("Created an IntrusionDetector (roi: {}, triggers: {}"
-                     ", detect_threshold: {})".format(
-                         self._roi,
-                         self.triggers,
-                         self.detect_threshold))
+        self._polygon = geometry.Polygon(self._roi)
 
     @property
     def roi(self):
         return self._roi
 
-    @roi.setter
-    def roi(self, value):
-        self._roi = value
-        self._roi_polygon = geometry.Polygon(self._roi)
+    @property
+    def polygon(self):
+        return self._polygon
 
-    def _is_in_roi(self, bbox, threshold=0.0):
-        """Check whether a bbox is in the roi or not.
+    def intersects(self, bbox, threshold=0.0):
+        """Check whether a bbox is in the zone or not.
 
         Args:
             bbox (tuple): The bounding box of format:
@@ -126,113 +160,396 @@ class IntrusionDetector(object):
             threshold: The overlap threshold.
 
         Returns:
-            True if bbox is in the roi and false otherwise.
+            True if bbox is in the zone and false otherwise.
         """
         (xmin, ymin, xmax, ymax) = bbox
         obj_polygon = geometry.Polygon([[xmin, ymin], [xmax, ymin],
                                         [xmax, ymax], [xmin, ymax]])
-        overlap_area = self._roi_polygon.intersection(obj_polygon).area
+        overlap_area = self.polygon.intersection(obj_polygon).area
         return overlap_area > threshold
 
-    def _check_intrusion(self, detections):
+
+class IntrusionDetector(object):
+    """A class used to detect intrusion event.
+
+    The objects are detected once for all zones, and each zone has its own
+    alert state.
+
+    Attributes:
+        zones (list of Zone): The zones to detect intrusion in.
+        frame_size (tuple): The frame size of input image frames with
+            format (width, height).
+        crop_motion (bool): Whether to detect objects in the crops of the
+            motion regions of frames, instead of the whole frames.
+        cache_key (string): The key to cache the detections of frames under
+            on the inference workers, None means no caching.
+        cache_ttl (float): The time, in seconds, that the detections of a
+            frame are reused for near identical frames.
+        detect_interval (int): The number of motion frames from one object
+            detection to the next. The objects are tracked in the frames in
+            between, and detected again earlier if a track is lost. If it's
+            1 and there is no correlation tracker, the objects are detected
+            in every motion frame without tracking them.
+    """
+
+    STATE_NORMAL = 0
+    STATE_ALERT_START = 1
+    STATE_ALERTING = 2
+    STATE_ALERT_END = 3
+
+    def __init__(self, zones, frame_size, crop_motion=False, cache_key=None,
+                 cache_ttl=0, detect_interval=1, correlation_tracker=None):
+        try:
+            # Get Dask client
+            self._client = get_client()
+        except ValueError:
+            assert False, ("Should connect to Dask scheduler before"
+                           " initializing this object.")
+
+        self.zones = zones
+        self.frame_size = frame_size
+        self.crop_motion = crop_motion
+        self.cache_key = cache_key if cache_ttl > 0 else None
+        self.cache_ttl = cache_ttl
+        self.detect_interval = max(1, detect_interval)
+        if self.detect_interval > 1 or correlation_tracker is not None:
+            self._tracker = ObjectTracker(correlation=correlation_tracker)
+        else:
+            self._tracker = None
+        # The number of motion frames since the last object detection.
+        self._frames_since_detection = self.detect_interval
+        self._category_index = load_category_index("./coco.labels")
+        # The class IDs of the triggers of each zone.
+        self._zone_classes = [
+            np.array([class_id for class_id, label
+                      in self._category_index.items()
+                      if label in zone.triggers], dtype=np.int32)
+            for zone in self.zones]
+        # The workers only return the detections that some zone may want.
+        self._trigger_classes = sorted(
+            set(np.concatenate(self._zone_classes).tolist()))
+        self._detect_threshold = min(zone.detect_threshold
+                                     for zone in self.zones)
+        self._zone_index = vp.ZoneIndex([zone.roi for zone in self.zones],
+                                        self.frame_size)
+        self._max_margin = 3 * 15
+        self._states = [IntrusionDetector.STATE_NORMAL] * len(self.zones)
+        self._margin_counters = [0] * len(self.zones)
+
+        # Pass frames through shared memory if there are inference workers
+        # on the same host, instead of scattering them through Dask.
+        self._local_workers = get_local_workers(
+            self._client,
+            gpu_worker.INFERENCE_RESOURCE)
+        if self._local_workers:
+            # A frame may have several crops.
+            self._frame_ring = SharedFrameRing(
+                capacity=DEFAULT_SHARED_RING_SIZE * MAX_MOTION_CROPS,
+                name_prefix="intrusion_detection")
+        else:
+            self._frame_ring = None
+
+        for zone in self.zones:
+            logging.info("Created an IntrusionDetector zone (name: {}, roi: {}"
+                         ", triggers: {}, detect_threshold: {})".format(
+                             zone.name,
+                             zone.roi,
+                             zone.triggers,
+                             zone.detect_threshold))
+
+    def _check_intrusion(self, detections, track_ids=None):
         """Check if the detected objects is an intrusion event.
 
+        The detections of all frames are checked against the zones at once,
+        each detection only against the zones around it.
+
         Args:
-            detections: A list of object detection result objects, each a
-                object of format (bboxes, scores, classes, num_detctions).
+            detections: A list of object detection results, each a structured
+                array of DETECTION_DTYPE.
+            track_ids: A list of the track IDs of the detections of each
+                frame. Defaults to None, which means the objects are not
+                tracked.
 
         Returns:
-            A list of tuple list that specifies the triggered detections,
-            each a tuple list of format [(label, detect_index), ...].
+            A list of the results of each zone. The results of a zone are a
+            list of dicts of the detections in the zone, one for each frame,
+            which is empty if there is none, each a dict with keys "bboxes",
+            "scores", "labels", and "track_ids" if the objects are tracked.
         """
         width, height = self.frame_size
-
+        if detections:
+            merged = np.concatenate(detections)
+        else:
+            merged = np.empty(0, dtype=DETECTION_DTYPE)
+
+        # The boxes are of format (ymin, xmin, ymax, xmax).
+        unnormalized_bboxes = (merged["box"][:, [1, 0, 3, 2]]
+                               .astype(np.float64) *
+                               [width, height, width, height])
+        # The detections that each zone wants by their scores and classes.
+        wanted = np.stack([(merged["score"] >= zone.detect_threshold) &
+                           np.isin(merged["class"], classes)
+                           for zone, classes in zip(self.zones,
+                                                    self._zone_classes)],
+                          axis=1)
+        in_zones = self._zone_index.overlaps(unnormalized_bboxes, wanted)
+        # Only the boxes near the edges of the zones need the exact check.
+        for j, i in zip(*np.nonzero(in_zones == vp.RoiMask.UNDECIDED)):
+            in_zones[j, i] = self.zones[i].intersects(
+                unnormalized_bboxes[j].tolist())
+
+        offsets = np.cumsum([0] + [len(d) for d in detections])
         results = []
-        for i in range(len(detections)):
-            (bboxes, scores, classes, num_candidates) = detections[i]
-
-            in_roi_cands = {}
-            for j in range(int(num_candidates[0])):
-                # Check if score passes the threshold.
-                if scores[0][j] < self.detect_threshold:
-                    continue
-                # Check if the object in in the trigger list.
-                # XXX: Is it posssible to generate index that is not in the
-                #      category_index list?
-                try:
-                    label = self._category_index[int(classes[0][j])]
-                except KeyError:
+        for i in range(len(self.zones)):
+            zone_results = []
+            for k, detection in enumerate(detections):
+                in_zone = in_zones[offsets[k]:offsets[k + 1], i] > 0
+                found = detection[in_zone]
+                if len(found) == 0:
+                    zone_results.append({})
                     continue
-                else:
-                    if label not in self.triggers:
-                        continue
-                # Check whether the object's bbox is in roi or not.
-                ymin, xmin, ymax, xmax = bboxes[0][j]
-                unnormalized_bbox = (xmin * width, ymin * height,
-                                     xmax * width, ymax * height)
-                if self._is_in_roi(unnormalized_bbox):
-                    if not bool(in_roi_cands):
-                        # This is the first detected object candidate
-                        in_roi_cands = {"bboxes": [], "scores": [], "labels": []}
-                    in_roi_cands["bboxes"].append(bboxes[0][j].tolist())
-                    in_roi_cands["scores"].append(scores[0][j].tolist())
-                    in_roi_cands["labels"].append(label)
-            results.append(in_roi_cands)
+                zone_result = {
+                    "bboxes": found["box"].tolist(),
+                    "scores": found["score"].tolist(),
+                    "labels": [self._category_index[class_id]
+                               for class_id in found["class"].tolist()]
+                }
+                if track_ids is not None:
+                    zone_result["track_ids"] = track_ids[k][in_zone].tolist()
+                zone_results.append(zone_result)
+            results.append(zone_results)
         return results
 
-    def _process_state(self, catched, num_frames):
-        if self._state == IntrusionDetector.STATE_NORMAL:
+    def _process_state(self, zone_idx, catched, num_frames):
+        state = self._states[zone_idx]
+        if state == IntrusionDetector.STATE_NORMAL:
             if catched:
-                self._state = IntrusionDetector.STATE_ALERT_START
-        elif self._state == IntrusionDetector.STATE_ALERT_START:
-            self._margin_counter = 0
-            self._state = IntrusionDetector.STATE_ALERTING
-        elif self._state == IntrusionDetector.STATE_ALERTING:
+                state = IntrusionDetector.STATE_ALERT_START
+        elif state == IntrusionDetector.STATE_ALERT_START:
+            self._margin_counters[zone_idx] = 0
+            state = IntrusionDetector.STATE_ALERTING
+        elif state == IntrusionDetector.STATE_ALERTING:
             if catched:
-                self._margin_counter = 0
-            elif self._margin_counter > self._max_margin:
-                self._state = IntrusionDetector.STATE_ALERT_END
+                self._margin_counters[zone_idx] = 0
+            elif self._margin_counters[zone_idx] > self._max_margin:
+                state = IntrusionDetector.STATE_ALERT_END
             else:
-                self._margin_counter += num_frames
-        elif self._state  == IntrusionDetector.STATE_ALERT_END:
+                self._margin_counters[zone_idx] += num_frames
+        elif state == IntrusionDetector.STATE_ALERT_END:
             if catched:
-                self._state = IntrusionDetector.STATE_ALERT_START
+                state = IntrusionDetector.STATE_ALERT_START
             else:
-                self._state = IntrusionDetector.STATE_NORMAL
+                state = IntrusionDetector.STATE_NORMAL
         else:
-            assert False, "Unknown state: {}".format(self._state)
-
-    def run(self, frames, motions):
-        f_motions = self._client.scatter(motions["frames"])
-        f_detect = self._client.submit(gpu_worker.run_model,
+            assert False, "Unknown state: {}".format(state)
+        self._states[zone_idx] = state
+
+    def _submit_detection(self, frames, cache_keys=None):
+        # Detections are cached by frame, or by crop, if the keys of the crops
+        # are given.
+        cache_key = self.cache_key
+        if cache_key is not None and cache_keys is not None:
+            cache_key = cache_keys
+        # Only send the downscaled images to the worker, the full resolution
+        # ones are needed only for recording.
+        resources = {gpu_worker.INFERENCE_RESOURCE: 1}
+        if self._frame_ring is not None:
+            shared_frames = self._frame_ring.put_frames(frames)
+            return self._client.submit(gpu_worker.run_model,
                                        "object_detection",
-                                       f_motions,
-                                       resources={"GPU": 1})
-        catched = self._check_intrusion(f_detect.result())
+                                       shared_frames,
+                                       score_threshold=self._detect_threshold,
+                                       classes=self._trigger_classes,
+                                       cache_key=cache_key,
+                                       cache_ttl=self.cache_ttl,
+                                       resources=resources,
+                                       workers=self._local_workers)
+        f_frames = self._client.scatter([frame.to_analysis()
+                                         for frame in frames])
+        return self._client.submit(gpu_worker.run_model,
+                                   "object_detection",
+                                   f_frames,
+                                   score_threshold=self._detect_threshold,
+                                   classes=self._trigger_classes,
+                                   cache_key=cache_key,
+                                   cache_ttl=self.cache_ttl,
+                                   resources=resources)
+
+    def _crop_motions(self, motions):
+        """Crop the motion regions of frames for object detection.
+
+        The crops are taken from the full resolution images and resized to
+        the analysis resolution, so small objects get more pixels. The crop
+        boxes are snapped to CROP_GRID.
+
+        Returns:
+            A tuple (crops, boxes, owners): the cropped frames, the
+            normalized box of each crop with format (xmin, ymin, xmax,
+            ymax), and the index of the motion frame of each crop.
+        """
+        crops, boxes, owners = [], [], []
+        for i, frame in enumerate(motions["frames"]):
+            height, width = frame.image.shape[:2]
+            crop_size = frame.analysis_image.shape[1::-1]
+            for box in vp.get_motion_crops(motions["regions"][i],
+                                           max_crops=MAX_MOTION_CROPS):
+                box = _snap_box(box)
+                (xmin, ymin, xmax, ymax) = box
+                if box == (0.0, 0.0, 1.0, 1.0):
+                    crop = frame.to_analysis()
+                else:
+                    image = frame.image[int(ymin * height):
+                                        int(np.ceil(ymax * height)),
+                                        int(xmin * width):
+                                        int(np.ceil(xmax * width))]
+                    shrink = image.shape[1] > crop_size[0]
+                    crop = VideoFrame(cv2.resize(
+                        image,
+                        crop_size,
+                        interpolation=(cv2.INTER_AREA if shrink
+                                       else cv2.INTER_LINEAR)),
+                        frame.timestamp)
+                crops.append(crop)
+                boxes.append(box)
+                owners.append(i)
+        return crops, boxes, owners
+
+    @staticmethod
+    def _merge_crop_detections(results, boxes, owners, num_frames):
+        """Map the detections of crops back to their frames.
+
+        Returns:
+            A list of object detection results of the frames, each a
+            structured array of DETECTION_DTYPE.
+        """
+        parts = [[] for _ in range(num_frames)]
+        for detection, box, owner in zip(results, boxes, owners):
+            (xmin, ymin, xmax, ymax) = box
+            # The boxes are of format (ymin, xmin, ymax, xmax).
+            scale = np.array([ymax - ymin, xmax - xmin,
+                              ymax - ymin, xmax - xmin], dtype=np.float32)
+            offset = np.array([ymin, xmin, ymin, xmin], dtype=np.float32)
+            detection = detection.copy()
+            detection["box"] = detection["box"] * scale + offset
+            parts[owner].append(detection)
+        return [np.concatenate(part) if part
+                else np.empty(0, dtype=DETECTION_DTYPE)
+                for part in parts]
+
+    def _detect(self, motions):
+        if not self.crop_motion:
+            return self._submit_detection(motions["frames"]).result()
+        crops, boxes, owners = self._crop_motions(motions)
+        # The detections of a crop are relative to its box, so only the crops
+        # of the same box may share them.
+        cache_keys = [(self.cache_key, box) for box in boxes]
+        results = self._submit_detection(crops, cache_keys).result()
+        return self._merge_crop_detections(results,
+                                           boxes,
+                                           owners,
+                                           len(motions["frames"]))
+
+    def _track(self, motions):
+        """Detect objects in some of the motion frames and track them.
+
+        The objects are detected in every detect_interval-th motion frame,
+        in one request, and in the first one after a gap. The tracks are
+        propagated to the other frames, unless a track is lost, then the
+        objects are detected in that frame too.
 
-        output_frames = []
+        Returns:
+            A tuple (detections, track_ids): the object detection results of
+            the motion frames and the track IDs of the detections.
+        """
+        frames = motions["frames"]
+        scheduled = []
+        count = self._frames_since_detection
         for i in range(len(frames)):
-            currnet_frame = frames[i]
-            try:
-                motion_idx = motions["index"].index(i)
-            except ValueError:
-                # No motion for the current frame, update state
-                self._process_state(False, 1)
-                # Set metadata with the latest state
-                current_metadata = {"mode": self._state}
+            if count >= self.detect_interval:
+                scheduled.append(i)
+                count = 0
+            count += 1
+        detected = {}
+        if scheduled:
+            results = self._detect({
+                "frames": [frames[i] for i in scheduled],
+                "regions": [motions["regions"][i] for i in scheduled]
+            })
+            detected = dict(zip(scheduled, results))
+
+        detections, track_ids = [], []
+        for i, frame in enumerate(frames):
+            image = frame.analysis_image
+            is_detected = i in detected
+            if is_detected:
+                detection = detected[i]
             else:
-                current_metadata = catched[motion_idx].copy()
-                # Update current state according to the corresponding catched
-                # result
-                self._process_state(bool(current_metadata), 1)
-                # Update metadata with the latest state
-                current_metadata.update({"mode": self._state})
-            output_frames.append(EventVideoFrame(currnet_frame,
-                                                 current_metadata))
-        return output_frames
+                detection, ids, lost = self._tracker.predict(image)
+                if lost:
+                    # Detect the objects again where a track is lost.
+                    detection = self._detect({
+                        "frames": [frame],
+                        "regions": [motions["regions"][i]]
+                    })[0]
+                    is_detected = True
+            if is_detected:
+                ids = self._tracker.update(detection, image)
+                self._frames_since_detection = 0
+            self._frames_since_detection += 1
+            detections.append(detection)
+            track_ids.append(ids)
+        return detections, track_ids
+
+    def run(self, frames, motions):
+        """Detect intrusion in frames.
+
+        Returns:
+            A list of the output frames of each zone, the frames with the
+            detections in the zone and the state of the zone as metadata.
+        """
+        if (self._tracker is not None and
+                any(frame.after_gap for frame in frames)):
+            # The motion detector starts over after a gap, so the frame
+            # after it is never a motion frame. Forget the tracks here
+            # instead, and detect the objects in the next motion frame.
+            self._tracker.reset()
+            self._frames_since_detection = self.detect_interval
+        if not motions["frames"]:
+            # Nothing moved, so there is nothing to detect.
+            catched = [[] for _ in self.zones]
+        elif self._tracker is None:
+            catched = self._check_intrusion(self._detect(motions))
+        else:
+            catched = self._check_intrusion(*self._track(motions))
+        motion_indexes = {index: motion_idx for motion_idx, index
+                          in enumerate(motions["index"])}
+
+        results = []
+        for zone_idx in range(len(self.zones)):
+            output_frames = []
+            for i in range(len(frames)):
+                currnet_frame = frames[i]
+                motion_idx = motion_indexes.get(i)
+                if motion_idx is None:
+                    # No motion for the current frame, update state
+                    self._process_state(zone_idx, False, 1)
+                    # Set metadata with the latest state
+                    current_metadata = {"mode": self._states[zone_idx]}
+                else:
+                    current_metadata = catched[zone_idx][motion_idx].copy()
+                    # Update current state according to the corresponding
+                    # catched result
+                    self._process_state(zone_idx, bool(current_metadata), 1)
+                    # Update metadata with the latest state
+                    current_metadata.update({"mode": self._states[zone_idx]})
+                output_frames.append(EventVideoFrame(currnet_frame,
+                                                     current_metadata))
+            results.append(output_frames)
+        return results
 
     def release(self):
-        pass
+        if self._frame_ring is not None:
+            self._frame_ring.close()
 
 
 class OutputPolicy(EventVideoPolicy):
@@ -248,13 +565,25 @@ class OutputPolicy(EventVideoPolicy):
 class IntrusionDetectionPipeline(object):
     """A class used to run the Intrusion Detection pipeline.
 
+    Each zone of the pipeline has its own alerts, event videos and
+    notifications, while the objects are detected once for all zones.
+
     Attributes:
         anal_id (lib.ObjectID): The ObjectID of the analyzer that the pipeline
             was attached with.
-        roi (list of object): The region of interest with format of a list
-            of object points, such as [{"x": 0.21, "y": 0.33},
-            {"x": 0.32, "y": 0.43}, ...]
-        triggers (list of string): The target of interest.
+        zones (list of dict): The zones to detect intrusion in, each a dict
+            with the following keys:
+                name (string): The name of the zone, which is used in the
+                    keys of its event videos and in its events. It may only
+                    contain letters, digits, "_" and "-", and may only be
+                    omitted if there is a single zone.
+                roi (list of object): The region of interest with format of
+                    a list of object points, such as [{"x": 0.21, "y": 0.33},
+                    {"x": 0.32, "y": 0.43}, ...]
+                triggers (list of string): The target of interest.
+                detect_threshold (float): The detect threshold of the zone.
+                    It's optional and defaults to the detect threshold of
+                    the pipeline.
         frame_size (tuple): The size of the input image frame with format
             of (width, height).
         detect_threshold (float): The threshold of the detected object
@@ -264,34 +593,88 @@ class IntrusionDetectionPipeline(object):
         history_len (int): The length, in seconds, of frame history queue. This
             determines when the agent starts to record before policy returning
             action "START_RECORDING".
+        recorder (StreamCopyRecorder): The recorder to cut event videos from
+            without re-encoding. Defaults to None.
+        event_handler (function): If given, the event messages are passed to
+            it when the events end, with their end timestamps in "end",
+            instead of being saved to database and pushed as notifications.
+            Defaults to None.
+        crop_motion (bool): Whether to detect objects in the crops of the
+            motion regions of frames, instead of the whole frames. Defaults
+            to False.
+        cache_ttl (float): The time, in seconds, that the inference workers
+            reuse the detections of a frame for near identical frames of the
+            analyzer. Defaults to 0, which means no caching.
+        detect_interval (int): The number of motion frames from one object
+            detection to the next, the objects are tracked in between.
+            Defaults to 1, which means detecting objects in every motion
+            frame.
+        correlation_tracker (string): The correlation tracker of OpenCV to
+            track objects with, "kcf" or "csrt", which needs OpenCV with the
+            contrib modules. Defaults to None, which means tracking objects
+            by their velocities.
+        cache_key (string): The key to cache the detections of frames under,
+            which should be unique to the source of the frames. Defaults to
+            None, which means `anal_id`.
     """
-    def __init__(self, anal_id, roi, triggers, frame_size,
-                 detect_threshold=0.5, video_format="mp4", fps=15,
-                 history_len=3):
+    def __init__(self, anal_id, zones, frame_size, detect_threshold=0.5,
+                 video_format="mp4", fps=15, history_len=3, recorder=None,
+                 event_handler=None, crop_motion=False, cache_ttl=0,
+                 detect_interval=1, correlation_tracker=None, cache_key=None):
+        if not zones:
+            raise ValueError("Should have at least one zone.")
+        names = [zone.get("name") for zone in zones]
+        if len(zones) > 1 and (None in names or
+                               len(set(names)) != len(names)):
+            raise ValueError("Zones should have unique names.")
+        for name in names:
+            if name is not None and (not isinstance(name, str) or
+                                     not ZONE_NAME_PATTERN.fullmatch(name)):
+                raise ValueError("Invalid zone name {!r}, it should only"
+                                 " contain letters, digits, \"_\" and"
+                                 " \"-\".".format(name))
+
         self._anal_id = anal_id
+        self._event_handler = event_handler
+        self._last_timestamp = None
         self._obj_key_prefix = os.path.join("intrusion_detection", anal_id)
-        transformed_roi = transform_roi_format(roi, frame_size)
+        self._zones = [Zone(zone.get("name"),
+                            transform_roi_format(zone["roi"], frame_size),
+                            zone["triggers"],
+                            zone.get("detect_threshold", detect_threshold))
+                       for zone in zones]
+        # The events that are going on, one for each zone.
+        self._current_events = [None] * len(self._zones)
 
         # Create an intruson detector
         self._detector = IntrusionDetector(
-            transformed_roi,
-            triggers,
-            frame_size,
-            detect_threshold)
-
-        # Create output video agent
-        event_video_metadata = {
-            "event_name": "intrusion_detection",
-            "event_custom": {"roi": transformed_roi}
-        }
-        self._output_agent = EventVideoAgent(
-            OutputPolicy(),
-            event_video_metadata,
-            self._obj_key_prefix,
+            self._zones,
             frame_size,
-            video_format,
-            fps,
-            history_len)
+            crop_motion,
+            cache_key if cache_key is not None else anal_id,
+            cache_ttl,
+            detect_interval,
+            correlation_tracker)
+
+        # Create output video agents
+        self._output_agents = []
+        for zone in self._zones:
+            event_custom = {"roi": zone.roi}
+            if zone.name is not None:
+                event_custom["zone"] = zone.name
+            event_video_metadata = {
+                "event_name": "intrusion_detection",
+                "event_custom": event_custom
+            }
+            self._output_agents.append(EventVideoAgent(
+                OutputPolicy(),
+                event_video_metadata,
+                self._get_key_prefix(zone),
+                frame_size,
+                video_format,
+                fps,
+                history_len,
+                recorder))
 
         # Connect to Object Store service
         self._obj_store = ObjectStorageClient()
@@ -303,31 +686,43 @@ class IntrusionDetectionPipeline(object):
         # Connect to Database service
         self._database = Database()
 
-    def _take_snapshot(self, filename, frame):
+    @property
+    def rois(self):
+        """The regions of interest of the zones in frame coordinates."""
+        return [zone.roi for zone in self._zones]
+
+    def _get_key_prefix(self, zone):
+        if zone.name is None:
+            return self._obj_key_prefix
+        return os.path.join(self._obj_key_prefix, zone.name)
+
+    def _take_snapshot(self, filename, frame, zone):
         """Save a frame to an image file and push it to the object store.
 
         Args:
             filename: The name of the snapshot.
             frame: The frame object to be saved. The object should be an
                 instance of VideoFrame or EventVideoFrame.
+            zone: The zone to draw on the snapshot.
 
         Returns:
             The key of the snapshot in the object store.
         """
-        thumbnail_key = os.path.join(self._obj_key_prefix, "{}.jpg"
+        thumbnail_key = os.path.join(self._get_key_prefix(zone), "{}.jpg"
                                      .format(filename))
         drawn_image = im.draw_region(frame.image,
-                                     self._detector.roi,
+                                     zone.roi,
                                      EVENT_ALERT_COLOR_CODE,
                                      0.4)
         shrunk_image = im.shrink_image(drawn_image)
         self._obj_store.save_image_obj(thumbnail_key, shrunk_image)
         return thumbnail_key
 
-    def _output_event(self, event, thumbnail_key, triggered):
+    def _output_event(self, zone_idx, event, thumbnail_key, triggered):
         """Output event to notification center and database.
 
         Args:
+            zone_idx: The index of the zone of the event.
             event: The event object to be outputted.
             thumbnail_key: The key of the thumbnail in object store.
             triggerd: The triggerd objects of the event.
@@ -345,22 +740,22 @@ class IntrusionDetectionPipeline(object):
                 "triggered": triggered
             }
         }
+        zone = self._zones[zone_idx]
+        if zone.name is not None:
+            message["content"]["zone"] = zone.name
+
+        if self._event_handler is not None:
+            # Hand the event over when it ends.
+            self._current_events[zone_idx] = message
+        else:
+            output_event(self._database, self._notification, message)
 
-        # Save event to database
-        date_obj = (datetime.datetime
-                    .utcfromtimestamp(timestamp)
-                    .replace(tzinfo=timezone("UTC")))
-        message.update({"date": date_obj})
-        self._database.save_event(message)
-
-        # Push notification
-        mlsec = repr(timestamp).split(".")[1][:3]
-        date_str = (datetime.datetime
-                    .utcfromtimestamp(timestamp)
-                    .replace(tzinfo=timezone("UTC"))
-                    .strftime("%Y-%m-%dT%H:%M:%S.{}Z".format(mlsec)))
-        message.update({"date": date_str})
-        self._notification.push("Analyzer", message)
+    def _end_event(self, zone_idx, timestamp):
+        current_event = self._current_events[zone_idx]
+        if current_event is not None:
+            current_event["end"] = timestamp
+            self._event_handler(current_event)
+            self._current_events[zone_idx] = None
 
     def run(self, frames, motions):
         """Run Intrusion Detection pipeline.
@@ -368,21 +763,33 @@ class IntrusionDetectionPipeline(object):
         Args:
             frames: A list of raw video frames to be detected.
             motions: The motion of the input frames. It should be the output of
-                video_proc.detect_motion().
+                video_proc.MotionDetector.detect().
         """
         detected = self._detector.run(frames, motions)
-
-        for frame in detected:
-            event = self._output_agent.process(frame)
-            if event is not None:
+        if frames:
+            self._last_timestamp = frames[-1].timestamp
+
+        for zone_idx, zone_frames in enumerate(detected):
+            zone = self._zones[zone_idx]
+            output_agent = self._output_agents[zone_idx]
+            for frame in zone_frames:
+                event = output_agent.process(frame)
+                if event is None:
+                    continue
                 if event.action == EventVideoPolicy.START_RECORDING:
                     timestamp = event.content["timestamp"]
-                    thumbnail_key = self._take_snapshot(timestamp, frame)
-                    self._output_event(event, thumbnail_key,
+                    thumbnail_key = self._take_snapshot(timestamp, frame, zone)
+                    self._output_event(zone_idx, event, thumbnail_key,
                                        frame.metadata["labels"])
 
                 elif event.action == EventVideoPolicy.STOP_RECORDING:
                     logging.info("End of event video")
+                    self._end_event(zone_idx, frame.timestamp)
 
     def release(self):
-        self._output_agent.release()
+        # The events that are still going on end at the last frame.
+        for zone_idx in range(len(self._zones)):
+            self._end_event(zone_idx, self._last_timestamp)
+        self._detector.release()
+        for output_agent in self._output_agents:
+            output_agent.release()
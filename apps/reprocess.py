@@ -0,0 +1,356 @@
+"""Reprocess archived videos with the analyzer pipelines.
+
+Each video is split into chunks at keyframes, and the chunks are processed
+by a pool of processes, each one a client of the same Dask cluster. The
+frames are timestamped by their positions in the video, so the events of
+all chunks are on the same timeline. A chunk also reads the `history_len`
+seconds before it, so an event starting right after a chunk boundary still
+has its history recorded. The events found twice in the overlapping parts
+are merged, and the objects saved for the duplicates are deleted.
+
+Usage:
+    python3 reprocess.py --pipelines pipelines.json video1.mp4 video2.mp4
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+from dask.distributed import Client
+
+from analyzer import create_pipeline, create_motion_mask
+from intrusion_detection import output_event
+from utils import create_local_cluster, init_workers
+
+from jagereye_ng import video_proc as vp
+from jagereye_ng.io.streaming import VideoStreamReader, EndOfVideoError
+from jagereye_ng.io import shared_frames
+from jagereye_ng.io.notification import Notification
+from jagereye_ng.io.obj_storage import ObjectStorageClient
+from jagereye_ng.io.database import Database
+from jagereye_ng.io.encoder_pool import shutdown_encoder_pool
+from jagereye_ng.util.generic import get_config
+from jagereye_ng import logging
+
+
+FFPROBE_BIN = "ffprobe"
+DEFAULT_CHUNK_LEN = 300             # seconds
+
+
+def get_keyframe_times(path):
+    """Get the positions, in seconds, of the keyframes of a video.
+
+    Returns:
+        A sorted list of positions, which is empty if ffprobe failed.
+    """
+    # Only the packets are read, without decoding the frames.
+    cmd = [FFPROBE_BIN, "-v", "error",
+           "-select_streams", "v:0",
+           "-show_entries", "packet=pts_time,flags",
+           "-of", "csv=p=0",
+           path]
+    try:
+        output = subprocess.check_output(cmd, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.error("Failed to probe keyframes of {}: {}".format(path, e))
+        return []
+    times = []
+    for line in output.splitlines():
+        fields = line.strip().split(",")
+        if len(fields) < 2 or not fields[1].startswith("K"):
+            continue
+        try:
+            times.append(float(fields[0]))
+        except ValueError:
+            continue
+    return sorted(times)
+
+
+def get_duration(path):
+    """Get the duration, in seconds, of a video.
+
+    It's the frame count over the fps in the container header, which is
+    approximate for variable frame rate videos and for containers that don't
+    store the frame count.
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        num_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    finally:
+        cap.release()
+    if fps <= 0 or num_frames <= 0:
+        raise RuntimeError("Can't get the duration of {}".format(path))
+    return num_frames / fps
+
+
+def plan_chunks(duration, keyframes, chunk_len, overlap):
+    """Split a video into chunks that start at keyframes.
+
+    Args:
+        duration (float): The duration of the video.
+        keyframes (list of float): The sorted positions of the keyframes. If
+            it's empty, the chunks start at every `chunk_len` seconds and
+            the first frames of a chunk may not be decoded correctly.
+        chunk_len (float): The target length of each chunk.
+        overlap (float): The length of the part before each chunk to be read
+            too.
+
+    Returns:
+        A list of tuples (read_start, start, end), each the positions to
+        start reading, start of the chunk, and end of the chunk.
+    """
+    def snap(pos):
+        # The last keyframe at or before the position.
+        before = [k for k in keyframes if k <= pos]
+        return before[-1] if before else 0.0
+
+    starts = [0.0]
+    target = chunk_len
+    while target < duration:
+        start = snap(target) if keyframes else target
+        if start > starts[-1]:
+            starts.append(start)
+        target += chunk_len
+
+    chunks = []
+    for i, start in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else duration
+        read_start = start
+        if start > 0:
+            read_start = (snap(start - overlap) if keyframes
+                          else max(0.0, start - overlap))
+        chunks.append((read_start, start, end))
+    return chunks
+
+
+def process_chunk(scheduler_address, anal_id, pipelines, path, start_time,
+                  chunk):
+    """Run the pipelines on a chunk of a video.
+
+    Returns:
+        A list of the event messages found in the chunk.
+    """
+    read_start, start, end = chunk
+    logging.info("Reprocessing {} from {:.2f} to {:.2f}"
+                 .format(path, start, end))
+    config = get_config()["apps"]["base"]
+    events = []
+
+    dask = Client(scheduler_address)
+    src_reader = VideoStreamReader()
+    running = []
+    try:
+        src_reader.open(path,
+                        decimate=config["decimate"],
+                        analysis_size=config["analysis_size"],
+                        offline=True,
+                        start_time=start_time,
+                        start_pos=read_start if read_start > 0 else None,
+                        end_pos=end)
+        video_info = src_reader.get_video_info()
+        # The chunks are processed in parallel, so each one caches the
+        # detections of its own frames.
+        cache_key = "{}:{}:{}".format(anal_id, os.path.abspath(path), start)
+        running = create_pipeline(anal_id,
+                                  pipelines,
+                                  video_info["frame_size"],
+                                  event_handler=events.append,
+                                  cache_key=cache_key)
+        motion_detector = vp.MotionDetector(
+            config["motion_threshold"],
+            config["motion_scale"],
+            create_motion_mask(running, video_info, config["motion_scale"]),
+            config["motion_learning_rate"])
+        while True:
+            try:
+                frames = src_reader.read(
+                    batch_size=config["read_batch_size"])
+            except EndOfVideoError:
+                break
+            motions = motion_detector.detect(frames)
+            for p in running:
+                p.run(frames, motions)
+    finally:
+        src_reader.release()
+        for p in running:
+            if hasattr(p, "release"):
+                p.release()
+        shutdown_encoder_pool()
+        dask.close()
+    return events
+
+
+def merge_events(events):
+    """Merge the events of the same type and zone that overlap in time.
+
+    The events of a chunk never overlap each other, so the overlapping ones
+    were found twice in the overlapping parts of adjacent chunks. A merged
+    event keeps the earliest one, with the latest end and all the triggered
+    labels.
+
+    Args:
+        events (list of dict): The event messages with their end timestamps
+            in "end".
+
+    Returns:
+        A tuple (merged, duplicates): the list of the merged event messages
+        sorted by timestamp, and the list of the event messages merged into
+        them.
+    """
+    merged = []
+    duplicates = []
+    # The last merged event of each type and zone.
+    last_events = {}
+    for event in sorted(events, key=lambda e: (e["timestamp"], e["end"])):
+        key = (event["type"], event["content"].get("zone"))
+        last = last_events.get(key)
+        if last is not None and event["timestamp"] <= last["end"]:
+            last["end"] = max(last["end"], event["end"])
+            triggered = last["content"]["triggered"]
+            triggered.extend(label for label
+                             in event["content"]["triggered"]
+                             if label not in triggered)
+            duplicates.append(event)
+        else:
+            merged.append(event)
+            last_events[key] = event
+    return merged, duplicates
+
+
+def delete_event_objects(obj_store, events):
+    """Delete the videos, metadata and thumbnails saved for events.
+
+    Args:
+        obj_store (ObjectStorageClient): The object store client.
+        events (list of dict): The event messages.
+    """
+    keys = [event["content"][name] for event in events
+            for name in ("video", "metadata", "thumbnail")
+            if event["content"].get(name) is not None]
+    if keys:
+        obj_store.delete_objs(keys)
+
+
+def reprocess(scheduler_address, anal_id, pipelines, paths,
+              start_times=None, chunk_len=DEFAULT_CHUNK_LEN,
+              num_workers=None):
+    """Reprocess videos in parallel chunks.
+
+    Args:
+        scheduler_address (string): The address of the Dask scheduler.
+        anal_id (string): The analyzer id of the events.
+        pipelines (list of dict): The pipelines in the same format as the
+            ones of an analyzer.
+        paths (list of string): The paths of the videos.
+        start_times (list of float): The timestamps of the beginning of the
+            videos. Defaults to None, which means the modified time of each
+            file minus its duration, since a recording is last modified when
+            it ends.
+        chunk_len (float): The target length, in seconds, of each chunk.
+        num_workers (int): The number of processes. Defaults to None, which
+            means the number of CPU cores.
+
+    Returns:
+        A list of the event messages sorted by timestamp.
+    """
+    durations = [get_duration(path) for path in paths]
+    if start_times is None:
+        start_times = [os.path.getmtime(path) - duration
+                       for path, duration in zip(paths, durations)]
+    overlap = get_config()["apps"]["intrusion_detection"]["history_len"]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        video_futures = []
+        for path, duration, start_time in zip(paths, durations, start_times):
+            chunks = plan_chunks(duration,
+                                 get_keyframe_times(path),
+                                 chunk_len,
+                                 overlap)
+            logging.info("Split {} into {} chunks".format(path, len(chunks)))
+            video_futures.append([executor.submit(process_chunk,
+                                                  scheduler_address,
+                                                  anal_id,
+                                                  pipelines,
+                                                  path,
+                                                  start_time,
+                                                  chunk)
+                                  for chunk in chunks])
+        # Only the events of the same video are merged.
+        events = []
+        duplicates = []
+        for futures in video_futures:
+            merged, merged_away = merge_events([e for f in futures
+                                                for e in f.result()])
+            events.extend(merged)
+            duplicates.extend(merged_away)
+
+    if duplicates:
+        logging.info("Deleting the objects of {} duplicate events"
+                     .format(len(duplicates)))
+        obj_store = ObjectStorageClient()
+        obj_store.connect()
+        delete_event_objects(obj_store, duplicates)
+    return sorted(events, key=lambda e: e["timestamp"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reprocess archived videos with analyzer pipelines.")
+    parser.add_argument("videos", nargs="+", help="The video files.")
+    parser.add_argument("--pipelines", required=True,
+                        help="A JSON file of the analyzer pipelines.")
+    parser.add_argument("--anal-id", default="reprocess",
+                        help="The analyzer id of the events.")
+    parser.add_argument("--start-time", type=float, nargs="+",
+                        help="The timestamps of the beginning of the videos."
+                             " Defaults to the modified time of each file"
+                             " minus its duration. The duration is the frame"
+                             " count over the fps in the container header,"
+                             " which is approximate, so give the start times"
+                             " if the event times need to be exact.")
+    parser.add_argument("--chunk-len", type=float, default=DEFAULT_CHUNK_LEN,
+                        help="The length, in seconds, of each chunk.")
+    parser.add_argument("--workers", type=int,
+                        help="The number of processes.")
+    parser.add_argument("--save", action="store_true",
+                        help="Save the events to database and push them as"
+                             " notifications.")
+    args = parser.parse_args()
+
+    if args.start_time is not None and \
+            len(args.start_time) != len(args.videos):
+        parser.error("--start-time should be given for each video")
+    with open(args.pipelines, "r") as f:
+        pipelines = json.load(f)
+
+    shared_frames.remove_stale_segments()
+    cluster = create_local_cluster()
+    with cluster, Client(cluster.scheduler_address) as client:
+        init_workers(client)
+
+        events = reprocess(cluster.scheduler_address,
+                           args.anal_id,
+                           pipelines,
+                           args.videos,
+                           args.start_time,
+                           args.chunk_len,
+                           args.workers)
+
+        if args.save:
+            database = Database()
+            notification = Notification()
+            for event in events:
+                output_event(database, notification, dict(event))
+        print(json.dumps(events, indent=2))
+
+
+if __name__ == "__main__":
+    main()
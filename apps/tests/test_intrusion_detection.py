@@ -0,0 +1,24 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import pytest
+
+from intrusion_detection import Zone
+
+
+def test_zone_roi_is_read_only():
+    zone = Zone("door", [(0, 0), (10, 0), (10, 10)], ["person"], 0.5)
+    assert zone.roi == ((0, 0), (10, 0), (10, 10))
+    with pytest.raises(AttributeError):
+        zone.roi = [(0, 0), (20, 0), (20, 20)]
+    with pytest.raises(AttributeError):
+        zone.polygon = None
+
+
+def test_zone_intersects():
+    zone = Zone(None, [(0, 0), (10, 0), (10, 10), (0, 10)], ["person"], 0.5)
+    assert zone.intersects((5, 5, 15, 15))
+    # Touching the edge isn't intersecting.
+    assert not zone.intersects((10, 0, 20, 10))
+    assert not zone.intersects((20, 20, 30, 30))
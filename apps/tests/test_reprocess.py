@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from reprocess import delete_event_objects, merge_events, plan_chunks
+
+
+def make_event(timestamp, end, triggered, zone=None, name=None):
+    name = name if name is not None else str(timestamp)
+    content = {
+        "video": "{}.mp4".format(name),
+        "metadata": "{}.json".format(name),
+        "thumbnail": "{}.jpg".format(name),
+        "triggered": list(triggered)
+    }
+    if zone is not None:
+        content["zone"] = zone
+    return {"type": "intrusion_detection", "timestamp": timestamp,
+            "end": end, "content": content}
+
+
+class FakeObjectStore(object):
+    def __init__(self):
+        self.deleted = []
+
+    def delete_objs(self, keys):
+        self.deleted.extend(keys)
+
+
+def test_merge_overlapping_events():
+    first = make_event(10.0, 20.0, ["person"])
+    # The same event found again by the next chunk.
+    again = make_event(12.0, 25.0, ["person", "car"])
+    later = make_event(30.0, 35.0, ["car"])
+    merged, duplicates = merge_events([later, again, first])
+    assert merged == [first, later]
+    assert duplicates == [again]
+    assert first["end"] == 25.0
+    assert first["content"]["triggered"] == ["person", "car"]
+
+
+def test_merge_touching_events():
+    first = make_event(10.0, 20.0, ["person"])
+    second = make_event(20.0, 22.0, ["person"])
+    merged, duplicates = merge_events([first, second])
+    assert merged == [first] and duplicates == [second]
+    assert first["end"] == 22.0
+
+
+def test_merge_only_events_of_the_same_zone():
+    left = make_event(10.0, 20.0, ["person"], zone="left")
+    right = make_event(12.0, 18.0, ["car"], zone="right")
+    left_again = make_event(15.0, 22.0, ["person"], zone="left")
+    merged, duplicates = merge_events([left, right, left_again])
+    assert merged == [left, right]
+    assert duplicates == [left_again]
+    assert left["end"] == 22.0
+    assert right["end"] == 18.0
+    assert right["content"]["triggered"] == ["car"]
+
+
+def test_merge_only_events_of_the_same_type():
+    first = make_event(10.0, 20.0, ["person"])
+    other = make_event(12.0, 18.0, ["person"])
+    other["type"] = "other"
+    merged, duplicates = merge_events([first, other])
+    assert merged == [first, other] and duplicates == []
+
+
+def test_merge_no_events():
+    assert merge_events([]) == ([], [])
+
+
+def test_delete_event_objects():
+    obj_store = FakeObjectStore()
+    event = make_event(10.0, 20.0, ["person"], name="a")
+    event["content"]["thumbnail"] = None
+    delete_event_objects(obj_store, [event])
+    assert obj_store.deleted == ["a.mp4", "a.json"]
+
+
+def test_plan_chunks_at_keyframes():
+    keyframes = [0.0, 4.0, 8.0, 12.0, 16.0]
+    chunks = plan_chunks(18.0, keyframes, chunk_len=6.0, overlap=3.0)
+    assert chunks == [(0.0, 0.0, 4.0), (0.0, 4.0, 12.0), (8.0, 12.0, 18.0)]
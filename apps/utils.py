@@ -4,10 +4,63 @@ from __future__ import print_function
 
 import asyncio
 from concurrent.futures import CancelledError
+from dask.distributed import LocalCluster
 
+from jagereye_ng import gpu_worker
+from jagereye_ng.io import io_worker
+from jagereye_ng.util.generic import get_config
 from jagereye_ng import logging
 
 
+def create_local_cluster():
+    """Create a local Dask cluster with an inference worker and an IO worker.
+
+    Returns:
+        A LocalCluster object. Its workers should be initialized by
+        `init_workers()` once a client is connected.
+    """
+    cluster = LocalCluster(n_workers=0)
+
+    # Add worker services
+    # TODO: Get the number of GPU from configuration file
+    inference = get_config()["apps"]["base"]["inference"]
+    # Each inference slot is a request being served, the concurrent requests
+    # are batched by the worker. The worker runs on CPU if there is no GPU.
+    cluster.start_worker(
+        name="{}-1".format(gpu_worker.INFERENCE_WORKER_PREFIX),
+        ncores=inference["max_requests"],
+        resources={gpu_worker.INFERENCE_RESOURCE: inference["max_requests"]})
+    cluster.start_worker(name="IO_WORKER-1", resources={"IO": 1})
+    return cluster
+
+
+def init_workers(client):
+    """Initialize the inference and IO workers of a cluster.
+
+    Args:
+        client (dask.distributed.Client): The client of the cluster.
+    """
+    config = get_config()["apps"]["base"]
+    inference = config["inference"]
+    # Initialize inference workers
+    results = client.run(gpu_worker.init_worker,
+                         ".",
+                         inference["max_batch_size"],
+                         inference["max_wait"],
+                         inference["memory_budget"],
+                         inference["models"],
+                         inference["backend"],
+                         inference["cache"],
+                         config["metrics_interval"])
+    assert all([v == "OK" for _, v in results.items()]), \
+        "Failed to initialize inference workers"
+
+    # Initialize IO worker
+    results = client.run(io_worker.init_worker)
+    assert all([v == "OK" for _, v in results.items()]), \
+        "Failed to initialize IO worker"
+
+
 class AsyncTimer(object):
     def __init__(self, interval, func, *args, **kwargs):
         self._interval = interval
@@ -0,0 +1,66 @@
+"""Benchmark of motion detection.
+
+Measures the per-frame cost of `video_proc.detect_motion` on batches of
+synthetic frames at the default analysis size, 720p and 1080p.
+
+Usage:
+    python3 benchmarks/bench_motion.py [--batch-size 5] [--rounds 50]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from jagereye_ng.io.streaming import VideoFrame
+from jagereye_ng.video_proc.video_proc import detect_motion
+
+
+RESOLUTIONS = [
+    ("300x300", (300, 300)),
+    ("720p", (1280, 720)),
+    ("1080p", (1920, 1080))
+]
+
+
+def make_frames(size, batch_size, seed=0):
+    """Make frames of a noisy background with a moving square."""
+    width, height = size
+    rng = np.random.RandomState(seed)
+    background = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    frames = []
+    for i in range(batch_size):
+        image = background.copy()
+        side = min(width, height) // 4
+        x = (i * side // 4) % (width - side)
+        image[:side, x:x + side] = 255
+        frames.append(VideoFrame(image, float(i)))
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--scale", type=float,
+                        help="The scale to downsample the frames by.")
+    args = parser.parse_args()
+
+    for name, size in RESOLUTIONS:
+        frames = make_frames(size, args.batch_size)
+        # Warm up.
+        detect_motion(frames, scale=args.scale)
+        elapsed = timeit.timeit(
+            lambda: detect_motion(frames, scale=args.scale),
+            number=args.rounds)
+        per_frame = elapsed / (args.rounds * args.batch_size) * 1000.0
+        print("{:>7}: {:.3f} ms/frame (batch size: {})"
+              .format(name, per_frame, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
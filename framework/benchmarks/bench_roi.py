@@ -0,0 +1,103 @@
+"""Benchmark of checking detected objects against a region of interest.
+
+Compares the per-candidate polygon intersection of shapely, as the intrusion
+detection app used to check every detection, with `video_proc.RoiMask`, which
+checks a batch of boxes at once and only falls back to shapely for the boxes
+near the edges of the region. Both must give the same results.
+
+Usage:
+    python3 benchmarks/bench_roi.py [--boxes 100] [--rounds 50]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+from shapely import geometry
+
+from jagereye_ng.video_proc.video_proc import RoiMask
+
+
+FRAME_SIZES = [
+    ("300x300", (300, 300)),
+    ("1080p", (1920, 1080))
+]
+
+
+def make_roi(size):
+    """Make a concave region of interest, an L shape with a slanted edge."""
+    width, height = size
+    return [(0.1 * width, 0.2 * height), (0.6 * width, 0.1 * height),
+            (0.6 * width, 0.5 * height), (0.9 * width, 0.5 * height),
+            (0.9 * width, 0.9 * height), (0.1 * width, 0.9 * height)]
+
+
+def make_boxes(size, num_boxes, seed=0):
+    """Make random boxes of format (xmin, ymin, xmax, ymax)."""
+    width, height = size
+    rng = np.random.RandomState(seed)
+    corners = rng.rand(num_boxes, 2) * [width, height]
+    sides = rng.rand(num_boxes, 2) * [width, height] * 0.2
+    return np.concatenate([corners, corners + sides], axis=1)
+
+
+def is_in_roi(polygon, bbox):
+    (xmin, ymin, xmax, ymax) = bbox
+    obj_polygon = geometry.Polygon([[xmin, ymin], [xmax, ymin],
+                                    [xmax, ymax], [xmin, ymax]])
+    return polygon.intersection(obj_polygon).area > 0.0
+
+
+def check_polygon(polygon, boxes):
+    return [is_in_roi(polygon, bbox) for bbox in boxes.tolist()]
+
+
+def check_mask(roi_mask, polygon, boxes):
+    results = roi_mask.overlaps(boxes)
+    for j in np.flatnonzero(results == RoiMask.UNDECIDED):
+        results[j] = is_in_roi(polygon, boxes[j].tolist())
+    return (results > 0).tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--boxes", type=int, default=100,
+                        help="The number of boxes of a batch.")
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    for name, size in FRAME_SIZES:
+        roi = make_roi(size)
+        polygon = geometry.Polygon(roi)
+        roi_mask = RoiMask(roi, size)
+        boxes = make_boxes(size, args.boxes)
+        assert check_polygon(polygon, boxes) == \
+            check_mask(roi_mask, polygon, boxes), "Results differ"
+
+        elapsed_polygon = timeit.timeit(
+            lambda: check_polygon(polygon, boxes),
+            number=args.rounds)
+        elapsed_mask = timeit.timeit(
+            lambda: check_mask(roi_mask, polygon, boxes),
+            number=args.rounds)
+        elapsed_build = timeit.timeit(lambda: RoiMask(roi, size), number=10)
+        undecided = np.count_nonzero(
+            roi_mask.overlaps(boxes) == RoiMask.UNDECIDED)
+        per_box = 1e6 / (args.rounds * args.boxes)
+        print("{:>8}: polygon {:8.2f} us/box, mask {:8.2f} us/box "
+              "({:.1f}x, {} of {} undecided), mask build {:.2f} ms".format(
+                  name,
+                  elapsed_polygon * per_box,
+                  elapsed_mask * per_box,
+                  elapsed_polygon / elapsed_mask,
+                  undecided,
+                  args.boxes,
+                  elapsed_build / 10 * 1000.0))
+
+
+if __name__ == "__main__":
+    main()
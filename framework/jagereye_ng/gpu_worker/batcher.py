@@ -0,0 +1,180 @@
+"""Dynamic batching of inference requests.
+
+The drivers of all analyzers submit small requests of a few frames each to
+the same inference worker. Instead of running them one after another, a
+`DynamicBatcher` collects the concurrent requests into one batch, until the
+batch is full or the oldest request has waited long enough, runs the batch
+with one model call and hands the results back to the requests.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+from collections import deque
+
+from jagereye_ng.util import logging
+
+
+DEFAULT_MAX_BATCH_SIZE = 16         # frames
+DEFAULT_MAX_WAIT = 0.01             # seconds
+
+
+class _Request(object):
+    def __init__(self, frames):
+        self.frames = frames
+        self.enqueue_time = time.time()
+        self.results = None
+        self.exception = None
+        self.done_event = threading.Event()
+
+
+class DynamicBatcher(object):
+    """A class used to run the requests of a model in dynamic batches.
+
+    The model should take a list of frames and return a list of results, one
+    for each frame.
+
+    Attributes:
+        max_batch_size (int): The maximum number of frames of a batch. A
+            request is never split, so a request bigger than this is run as
+            a batch by itself.
+        max_wait (float): The maximum time, in seconds, that the first
+            request of a batch waits for more requests.
+    """
+
+    def __init__(self, model, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_wait=DEFAULT_MAX_WAIT):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._model = model
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._num_batches = 0
+        self._num_requests = 0
+        self._num_frames = 0
+        self._total_delay = 0.0
+        self._max_delay = 0.0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, frames):
+        """Run the model on frames, together with other requests.
+
+        It blocks until the batch of the request is done.
+
+        Args:
+            frames: A list of frames.
+
+        Returns:
+            The results of the model for the frames.
+        """
+        if not frames:
+            return []
+        request = _Request(frames)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("The batcher has been stopped")
+            self._queue.append(request)
+            self._cond.notify()
+        request.done_event.wait()
+        if request.exception is not None:
+            raise request.exception
+        return request.results
+
+    def _collect(self):
+        """Wait for a batch of requests.
+
+        Returns:
+            A list of requests, which is empty if the batcher is stopped.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._queue or self._stopped)
+            if not self._queue:
+                return []
+            batch = [self._queue.popleft()]
+            size = len(batch[0].frames)
+            deadline = batch[0].enqueue_time + self.max_wait
+            while size < self.max_batch_size:
+                if not self._queue:
+                    remaining = deadline - time.time()
+                    if (remaining <= 0 or self._stopped or
+                            not self._cond.wait(remaining)):
+                        break
+                    continue
+                if size + len(self._queue[0].frames) > self.max_batch_size:
+                    break
+                request = self._queue.popleft()
+                batch.append(request)
+                size += len(request.frames)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                break
+            start_time = time.time()
+            frames = [frame for request in batch for frame in request.frames]
+            try:
+                results = self._model.run(frames)
+            except Exception as e:
+                logging.error("Failed to run a batch of {} frames: {}"
+                              .format(len(frames), e))
+                for request in batch:
+                    request.exception = e
+            else:
+                offset = 0
+                for request in batch:
+                    num = len(request.frames)
+                    request.results = results[offset:offset + num]
+                    offset += num
+            with self._cond:
+                self._num_batches += 1
+                self._num_requests += len(batch)
+                self._num_frames += len(frames)
+                for request in batch:
+                    delay = start_time - request.enqueue_time
+                    self._total_delay += delay
+                    self._max_delay = max(self._max_delay, delay)
+            for request in batch:
+                request.done_event.set()
+        logging.info("Batcher is terminated")
+
+    def get_metrics(self):
+        """Get the metrics of the batcher.
+
+        Returns:
+            A dict with the following keys:
+                num_batches (int): The number of batches that have been run.
+                avg_batch_size (float): The average number of frames of a
+                    batch.
+                avg_batch_requests (float): The average number of requests
+                    of a batch.
+                avg_queueing_delay (float): The average time, in seconds,
+                    from submitting a request to running its batch.
+                max_queueing_delay (float): The maximum queueing delay.
+                queue_depth (int): The number of waiting requests.
+        """
+        with self._cond:
+            num_batches = max(1, self._num_batches)
+            return {
+                "num_batches": self._num_batches,
+                "avg_batch_size": self._num_frames / num_batches,
+                "avg_batch_requests": self._num_requests / num_batches,
+                "avg_queueing_delay": (self._total_delay /
+                                       max(1, self._num_requests)),
+                "max_queueing_delay": self._max_delay,
+                "queue_depth": len(self._queue)
+            }
+
+    def stop(self):
+        """Stop the batcher after the waiting requests are done."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
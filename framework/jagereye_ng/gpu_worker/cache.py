@@ -0,0 +1,234 @@
+"""Cache of inference results of near identical frames.
+
+Cameras that watch static scenes send frames that only differ by noise and
+lighting flicker, and the results of a model for them are the same. The
+results are cached by a perceptual hash of the frame, the difference hash of
+its downscaled gray image, which is robust to noise and global brightness
+changes. A frame hits the cache if the hash of a cached frame differs from
+its hash in at most a tolerated number of bits.
+
+To find the close hashes without comparing a frame with every cached frame,
+the hashes are split into one more blocks than the tolerance. Two hashes
+that differ in at most the tolerated number of bits are equal in at least
+one block, so only the hashes that share a block with the frame are
+compared.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_HASH_SIZE = 16              # bits per side
+DEFAULT_TOLERANCE = 4               # bits
+DEFAULT_CACHE_TTL = 2.0             # seconds
+
+
+def image_hash(image, hash_size=DEFAULT_HASH_SIZE):
+    """Compute the difference hash of an image.
+
+    Args:
+        image: The BGR or gray image.
+        hash_size (int): The number of bits of the hash on each side, the
+            hash has hash_size ** 2 bits.
+
+    Returns:
+        The hash as an int.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image,
+                       (hash_size + 1, hash_size),
+                       interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+class _Entry(object):
+    def __init__(self, results, expire_time):
+        self.results = results
+        self.expire_time = expire_time
+
+
+class _Group(object):
+    """The hashes of the cached frames of a group, indexed by their blocks.
+
+    Attributes:
+        hashes (set): The hashes of the group.
+    """
+
+    def __init__(self, blocks):
+        self.hashes = set()
+        self._blocks = blocks
+        # The hashes of each value of each block.
+        self._index = [{} for _ in blocks]
+
+    def _block_values(self, hash_value):
+        return [(hash_value >> shift) & mask for shift, mask in self._blocks]
+
+    def add(self, hash_value):
+        if hash_value in self.hashes:
+            return
+        self.hashes.add(hash_value)
+        for index, value in zip(self._index, self._block_values(hash_value)):
+            index.setdefault(value, set()).add(hash_value)
+
+    def discard(self, hash_value):
+        if hash_value not in self.hashes:
+            return
+        self.hashes.discard(hash_value)
+        for index, value in zip(self._index, self._block_values(hash_value)):
+            hashes = index[value]
+            hashes.discard(hash_value)
+            if not hashes:
+                del index[value]
+
+    def candidates(self, hash_value):
+        """Get the hashes that share at least one block with a hash."""
+        candidates = set()
+        for index, value in zip(self._index, self._block_values(hash_value)):
+            candidates.update(index.get(value, ()))
+        return candidates
+
+
+class ResultCache(object):
+    """A least recently used cache of inference results of frames.
+
+    The results are cached in groups, such as one for each analyzer and
+    model version, so the frames of a group only hit the results of the
+    same group, and each group has its own time to live.
+
+    Attributes:
+        max_entries (int): The maximum number of cached frames of all groups.
+        tolerance (int): The maximum number of different bits of the hashes
+            of two frames for them to be treated as the same frame.
+        hash_size (int): The number of bits on each side of the hashes.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 tolerance=DEFAULT_TOLERANCE, hash_size=DEFAULT_HASH_SIZE):
+        self.max_entries = max_entries
+        self.tolerance = tolerance
+        self.hash_size = hash_size
+        # The entries keyed by (group, hash) in least recently used order.
+        self._entries = OrderedDict()
+        # The hashes of the entries of each group.
+        self._groups = {}
+        # The (shift, mask) of each block of the hashes.
+        num_bits = hash_size ** 2
+        num_blocks = min(tolerance + 1, num_bits)
+        self._blocks = []
+        shift = 0
+        for i in range(num_blocks):
+            width = num_bits // num_blocks + (i < num_bits % num_blocks)
+            self._blocks.append((shift, (1 << width) - 1))
+            shift += width
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _remove(self, key):
+        del self._entries[key]
+        (group, hash_value) = key
+        hashes = self._groups[group]
+        hashes.discard(hash_value)
+        if not hashes.hashes:
+            del self._groups[group]
+
+    def _find(self, group, hash_value, now):
+        """Find the key of the closest unexpired entry of a frame.
+
+        It should be called with the lock held.
+        """
+        hashes = self._groups.get(group)
+        if hashes is None:
+            return None
+        if hash_value in hashes.hashes:
+            candidates = [hash_value]
+        else:
+            candidates = [h for h in hashes.candidates(hash_value)
+                          if bin(h ^ hash_value).count("1") <= self.tolerance]
+            candidates.sort(key=lambda h: bin(h ^ hash_value).count("1"))
+        for h in candidates:
+            key = (group, h)
+            if self._entries[key].expire_time > now:
+                return key
+            self._remove(key)
+            self._expirations += 1
+        return None
+
+    def get(self, group, hash_value):
+        """Get the cached results of a frame.
+
+        Args:
+            group: The group of the frame.
+            hash_value (int): The hash of the frame, see `image_hash()`.
+
+        Returns:
+            The cached results, or None if there is none.
+        """
+        now = time.time()
+        with self._lock:
+            key = self._find(group, hash_value, now)
+            if key is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key].results
+
+    def put(self, group, hash_value, results, ttl=DEFAULT_CACHE_TTL):
+        """Cache the results of a frame.
+
+        Args:
+            group: The group of the frame.
+            hash_value (int): The hash of the frame, see `image_hash()`.
+            results: The results of the frame.
+            ttl (float): The time, in seconds, to keep the results for.
+                Defaults to DEFAULT_CACHE_TTL.
+        """
+        key = (group, hash_value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(results, time.time() + ttl)
+            if group not in self._groups:
+                self._groups[group] = _Group(self._blocks)
+            self._groups[group].add(hash_value)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def get_metrics(self):
+        """Get the metrics of the cache.
+
+        Returns:
+            A dict with the following keys:
+                hits (int): The number of frames that hit the cache.
+                misses (int): The number of frames that missed the cache.
+                hit_rate (float): The ratio of hits to all lookups.
+                evictions (int): The number of entries evicted to stay
+                    within max_entries.
+                expirations (int): The number of expired entries removed.
+                size (int): The number of cached frames.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / max(1, lookups),
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "size": len(self._entries)
+            }
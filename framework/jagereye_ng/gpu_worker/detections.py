@@ -0,0 +1,50 @@
+"""Compact object detection results.
+
+The raw results of an object detection model have a fixed number of
+candidates for every frame, most of them with low scores or of classes that
+nobody asked for. Filtering them on the inference worker and returning only
+the remaining detections as a structured array keeps the results that travel
+back to the drivers small.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+# A detection with a normalized box of format (ymin, xmin, ymax, xmax), the
+# score and the class ID.
+DETECTION_DTYPE = np.dtype([("box", np.float32, (4,)),
+                            ("score", np.float32),
+                            ("class", np.int32)])
+
+
+def filter_detections(result, score_threshold=0.0, classes=None):
+    """Filter the raw object detection result of a frame.
+
+    Args:
+        result: The result of a frame, a list of (boxes, scores, classes,
+            num_detections) with a batch dimension of 1, see
+            `ObjectDetection.run()`.
+        score_threshold (float): The minimum score of the detections to keep.
+            Defaults to 0.0.
+        classes (list of int): The class IDs of the detections to keep.
+            Defaults to None, which keeps all classes.
+
+    Returns:
+        A structured array of DETECTION_DTYPE, in the order of the raw result.
+    """
+    (boxes, scores, class_ids, num) = result
+    n = int(num[0])
+    scores = scores[0][:n]
+    class_ids = class_ids[0][:n].astype(np.int32)
+    keep = scores >= score_threshold
+    if classes is not None:
+        keep &= np.isin(class_ids, classes)
+    detections = np.empty(np.count_nonzero(keep), dtype=DETECTION_DTYPE)
+    detections["box"] = boxes[0][:n][keep]
+    detections["score"] = scores[keep]
+    detections["class"] = class_ids[keep]
+    return detections
@@ -2,8 +2,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import glob
 import os
+import threading
+import time
+import cv2
 from dask.distributed import get_worker
+from jagereye_ng.io import shared_frames
+from jagereye_ng.gpu_worker.batcher import (DEFAULT_MAX_BATCH_SIZE,
+                                            DEFAULT_MAX_WAIT)
+from jagereye_ng.gpu_worker.cache import (ResultCache,
+                                          image_hash,
+                                          DEFAULT_CACHE_TTL)
+from jagereye_ng.gpu_worker.detections import filter_detections
+from jagereye_ng.gpu_worker.registry import (ModelRegistry,
+                                             DEFAULT_MEMORY_BUDGET)
 from jagereye_ng.util import logging
 
 
@@ -20,21 +33,277 @@ class ModelPath(object):
             "frozen_inference_graph.pb")
 
 
-def init_worker(model_dir):
+DEFAULT_MODEL_VERSIONS = {
+    "object_detection": "ssd_mobilenet_v1_coco_11_06_2017"
+}
+# The Dask resource of inference workers, each unit is a request that can be
+# served at the same time.
+INFERENCE_RESOURCE = "INFERENCE"
+INFERENCE_WORKER_PREFIX = "INFERENCE_WORKER"
+
+RUNTIME_TENSORFLOW = "tensorflow"
+RUNTIME_OPENCV = "opencv"
+# The OpenCV runtime needs the DNN backend of OpenCV and its support of the
+# text graphs of SSD models, which came in OpenCV 3.4.2.
+MIN_OPENCV_RUNTIME_VERSION = (3, 4, 2)
+
+
+def has_gpu():
+    """Check whether there is a visible NVIDIA GPU or not.
+
+    It checks the device files instead of initializing CUDA, so it's cheap
+    and doesn't allocate GPU memory in the calling process.
+    """
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None and visible.strip() in ("", "-1"):
+        return False
+    return bool(glob.glob("/dev/nvidia[0-9]*"))
+
+
+def resolve_device(device):
+    """Resolve the "auto" device to "gpu" if there is a GPU or "cpu"."""
+    if device == "auto":
+        return "gpu" if has_gpu() else "cpu"
+    return device
+
+
+def check_opencv_runtime():
+    """Check whether the installed OpenCV can run the OpenCV runtime.
+
+    Raises:
+        RuntimeError: If the OpenCV is too old.
+    """
+    version = tuple(int(v) for v in
+                    cv2.__version__.split("-")[0].split(".")[:3])
+    if version < MIN_OPENCV_RUNTIME_VERSION:
+        raise RuntimeError(
+            "The \"{}\" runtime needs OpenCV {} or later, but OpenCV {} is"
+            " installed".format(RUNTIME_OPENCV,
+                                ".".join(str(v) for v in
+                                         MIN_OPENCV_RUNTIME_VERSION),
+                                cv2.__version__))
+
+
+def _log_metrics(worker, interval):
+    """Log the metrics of an inference worker every `interval` seconds."""
+    while True:
+        time.sleep(interval)
+        registry = getattr(worker, "model_registry", None)
+        if registry is not None:
+            logging.info("Batching metrics of {}: {}".format(
+                worker.name, registry.get_metrics()))
+        cache = getattr(worker, "result_cache", None)
+        if cache is not None:
+            logging.info("Result cache metrics of {}: {}".format(
+                worker.name, cache.get_metrics()))
+
+
+def _start_metrics_log(worker, interval):
+    """Start logging the metrics of a worker, once for each worker."""
+    if getattr(worker, "metrics_thread", None) is not None:
+        return
+    worker.metrics_thread = threading.Thread(target=_log_metrics,
+                                             args=(worker, interval))
+    worker.metrics_thread.daemon = True
+    worker.metrics_thread.start()
+
+
+def init_worker(model_dir, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                max_wait=DEFAULT_MAX_WAIT, memory_budget=DEFAULT_MEMORY_BUDGET,
+                model_versions=None, backend=None, cache=None,
+                metrics_interval=None):
+    """Initialize an inference worker.
+
+    The models are loaded on their first use, except the default versions
+    are loaded and warmed up here if the backend asks for warm-up.
+
+    Args:
+        model_dir (string): The base directory of the models.
+        max_batch_size (int): The maximum number of frames of a batch of
+            requests. Defaults to DEFAULT_MAX_BATCH_SIZE.
+        max_wait (float): The maximum time, in seconds, that a request waits
+            for other requests to be batched with. Defaults to
+            DEFAULT_MAX_WAIT.
+        memory_budget (int): The memory, in MB, that the loaded models may
+            use. Defaults to DEFAULT_MEMORY_BUDGET.
+        model_versions (dict): The default version of each model. Defaults
+            to None, which means DEFAULT_MODEL_VERSIONS.
+        backend (dict): The inference backend with the following keys, all
+            of them are optional:
+                device (string): "gpu", "cpu" or "auto". Defaults to "auto".
+                runtime (string): RUNTIME_TENSORFLOW or RUNTIME_OPENCV. The
+                    OpenCV runtime only runs on CPU, and needs OpenCV
+                    MIN_OPENCV_RUNTIME_VERSION or later and the text graphs
+                    of the models. Defaults to RUNTIME_TENSORFLOW.
+                intra_op_threads (int): The number of threads to run an
+                    operation with. Defaults to 0, which means automatic.
+                inter_op_threads (int): The number of operations to run at
+                    the same time. Defaults to 0, which means automatic.
+                warmup (bool): Whether to load and warm up the default models
+                    at startup. Defaults to False.
+        cache (dict): The cache of results of near identical frames with the
+            following keys, see `ResultCache`. Defaults to None, which
+            means no cache.
+                max_entries (int): The maximum number of cached frames.
+                tolerance (int): The maximum number of different bits of
+                    the hashes of the same frame.
+        metrics_interval (float): The interval, in seconds, to log the
+            metrics of the worker. Defaults to None, which means the metrics
+            are not logged.
+    """
     worker = get_worker()
-    if hasattr(worker, "name") and worker.name.startswith("GPU_WORKER"):
+    if (hasattr(worker, "name") and
+            worker.name.startswith(INFERENCE_WORKER_PREFIX)):
         logging.info("Initializing worker: {}".format(worker.name))
-        model_path = ModelPath(model_dir)
-
         from jagereye_ng import models
-        worker.global_models = dict()
-        worker.global_models["object_detection"] = models.ObjectDetection(
-            model_path.get("object_detection",
-                           "ssd_mobilenet_v1_coco_11_06_2017"),
-            "ssd_mobilenet_v1_coco_11_06_2017")
-        worker.global_models["object_detection"].load()
+        backend = backend or {}
+        device = resolve_device(backend.get("device", "auto"))
+        runtime = backend.get("runtime", RUNTIME_TENSORFLOW)
+        if runtime == RUNTIME_OPENCV:
+            check_opencv_runtime()
+            device = "cpu"
+            detection_class = models.OpenCVObjectDetection
+        else:
+            detection_class = models.ObjectDetection
+        logging.info("Inference backend: {} on {}".format(runtime, device))
+
+        versions = dict(DEFAULT_MODEL_VERSIONS)
+        versions.update(model_versions or {})
+        if runtime == RUNTIME_OPENCV:
+            # Fail at startup instead of on the first request.
+            for name, version in versions.items():
+                text_graph = os.path.join(
+                    os.path.dirname(ModelPath(model_dir).get(name, version)),
+                    models.OpenCVObjectDetection.TEXT_GRAPH_NAME)
+                if not os.path.isfile(text_graph):
+                    raise RuntimeError("The \"{}\" runtime needs the text"
+                                       " graph of the model: {}".format(
+                                           RUNTIME_OPENCV, text_graph))
+        worker.model_registry = ModelRegistry(
+            ModelPath(model_dir),
+            {"object_detection": detection_class},
+            versions,
+            memory_budget,
+            max_batch_size,
+            max_wait,
+            model_options={
+                "device": device,
+                "intra_op_threads": backend.get("intra_op_threads", 0),
+                "inter_op_threads": backend.get("inter_op_threads", 0)
+            },
+            warmup=backend.get("warmup", False))
+        if cache is not None:
+            worker.result_cache = ResultCache(cache["max_entries"],
+                                              cache["tolerance"])
+        else:
+            worker.result_cache = None
+        if backend.get("warmup", False):
+            for name in versions:
+                worker.model_registry.preload(name)
+        if metrics_interval:
+            _start_metrics_log(worker, metrics_interval)
     return "OK"
 
 
-def run_model(name, *args):
-    return get_worker().global_models[name].run(*args)
+def _run_cached(registry, cache, name, frames, version, cache_keys,
+                cache_ttl):
+    """Run a model on the frames that miss the result cache."""
+    version = registry.get_version(name, version)
+    groups = [(key, name, version) for key in cache_keys]
+    hashes = [image_hash(frame.image, cache.hash_size) for frame in frames]
+    results = [cache.get(group, h) for group, h in zip(groups, hashes)]
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        with registry.use(name, version) as batcher:
+            computed = batcher.run([frames[i] for i in misses])
+        for i, result in zip(misses, computed):
+            results[i] = result
+            cache.put(groups[i], hashes[i], result, cache_ttl)
+    return results
+
+
+def run_model(name, frames, version=None, score_threshold=None,
+              classes=None, cache_key=None, cache_ttl=DEFAULT_CACHE_TTL):
+    """Run a model on the worker, together with the requests of others.
+
+    If a score threshold or classes are given, the results of an object
+    detection model are filtered on the worker, so only the wanted
+    detections are sent back.
+
+    If a cache key is given and the worker has a result cache, the frames
+    that are near identical to recent frames of the same cache key get the
+    cached results instead of running the model.
+
+    Args:
+        name (string): The name of the model.
+        frames: A list of VideoFrame objects or shared frame descriptors.
+        version (string): The version of the model. Defaults to None, which
+            means the default version of the model.
+        score_threshold (float): The minimum score of the detections to
+            return. Defaults to None.
+        classes (list of int): The class IDs of the detections to return.
+            Defaults to None, which means all classes.
+        cache_key: The key, such as the analyzer ID, to cache the results
+            under, or a list of keys, one for each frame, such as the
+            analyzer ID and the box of each crop of a frame. The frames only
+            share the results of the same key. Defaults to None, which means
+            no caching.
+        cache_ttl (float): The time, in seconds, to keep the results in the
+            cache for. Defaults to DEFAULT_CACHE_TTL.
+
+    Returns:
+        A list of results, one for each frame. If a score threshold or
+        classes are given, each result is a structured array of
+        DETECTION_DTYPE, otherwise it's the raw result of the model.
+    """
+    # Frames may be passed as descriptors of shared memory frames by drivers
+    # on the same host.
+    frames = shared_frames.resolve(frames)
+    worker = get_worker()
+    cache = getattr(worker, "result_cache", None)
+    if cache_key is not None and cache is not None:
+        if not isinstance(cache_key, list):
+            cache_key = [cache_key] * len(frames)
+        results = _run_cached(worker.model_registry, cache, name, frames,
+                              version, cache_key, cache_ttl)
+    else:
+        with worker.model_registry.use(name, version) as batcher:
+            results = batcher.run(frames)
+    if score_threshold is None and classes is None:
+        return results
+    return [filter_detections(result, score_threshold or 0.0, classes)
+            for result in results]
+
+
+def get_batching_metrics():
+    """Get the metrics of the batchers of the worker.
+
+    It can be run on the workers with `Client.run()`, the metrics are also
+    logged periodically if the worker is initialized with a metrics
+    interval.
+
+    Returns:
+        A dict of the metrics of each loaded model, see
+        DynamicBatcher.get_metrics().
+    """
+    registry = getattr(get_worker(), "model_registry", None)
+    if registry is None:
+        return {}
+    return registry.get_metrics()
+
+
+def get_cache_metrics():
+    """Get the metrics of the result cache of the worker.
+
+    It can be run on the workers with `Client.run()`, the metrics are also
+    logged periodically if the worker is initialized with a metrics
+    interval.
+
+    Returns:
+        The metrics of the cache, see ResultCache.get_metrics(), or an empty
+        dict if the worker has no cache.
+    """
+    cache = getattr(get_worker(), "result_cache", None)
+    if cache is None:
+        return {}
+    return cache.get_metrics()
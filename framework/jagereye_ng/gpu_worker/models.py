@@ -2,15 +2,44 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+
+import cv2
 import tensorflow as tf
 import numpy as np
 import abc
 
+from jagereye_ng.io.streaming import VideoFrame
+
+
+DEVICE_GPU = "gpu"
+DEVICE_CPU = "cpu"
+# The size of the frames to warm up models with.
+WARMUP_FRAME_SIZE = (300, 300)
+
 
 class ModelBase(object):
-    def __init__(self, path=None, version=None):
+    def __init__(self, path=None, version=None, device=DEVICE_GPU,
+                 intra_op_threads=0, inter_op_threads=0):
+        """Initialize a model.
+
+        Args:
+            path (string): The path of the model file.
+            version (string): The version of the model.
+            device (string): The device to run the model on, DEVICE_GPU or
+                DEVICE_CPU. Defaults to DEVICE_GPU.
+            intra_op_threads (int): The number of threads to run an operation
+                with. Defaults to 0, which lets the runtime decide.
+            inter_op_threads (int): The number of operations to run at the
+                same time. Defaults to 0, which lets the runtime decide.
+        """
         self._path = path
         self._version = version
+        self._device = device
+        self._intra_op_threads = intra_op_threads
+        self._inter_op_threads = inter_op_threads
+        self._graph = None
+        self._session = None
 
     def load(self):
         self._graph = tf.Graph()
@@ -20,41 +49,153 @@ class ModelBase(object):
                 serialized_graph = f.read()
                 od_graph_def.ParseFromString(serialized_graph)
                 tf.import_graph_def(od_graph_def, name="")
-            gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.15)
-            with tf.Session(graph=self._graph, config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
-                self._session = sess
+            config = tf.ConfigProto(
+                intra_op_parallelism_threads=self._intra_op_threads,
+                inter_op_parallelism_threads=self._inter_op_threads)
+            if self._device == DEVICE_CPU:
+                config.device_count["GPU"] = 0
+            else:
+                config.gpu_options.per_process_gpu_memory_fraction = 0.15
+            # The session is kept open until the model is released.
+            self._session = tf.Session(graph=self._graph, config=config)
+
+    def release(self):
+        """Close the session and free the graph of the model."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self._graph = None
 
     def get_info(self):
-        return {"version": self._version}
+        return {"version": self._version, "device": self._device}
+
+    def warmup(self):
+        """Run the model once, so the first request doesn't pay for the
+        lazy initialization of the runtime."""
+        pass
 
     @abc.abstractmethod
     def run(self):
         raise NotImplementedError()
 
 
+def _warmup_frames():
+    width, height = WARMUP_FRAME_SIZE
+    return [VideoFrame(np.zeros((height, width, 3), dtype=np.uint8))]
+
+
 class ObjectDetection(ModelBase):
-    def __init__(self, path, version):
-        super().__init__(path, version)
+    def __init__(self, path, version, **kwargs):
+        super().__init__(path, version, **kwargs)
+
+    def load(self):
+        super().load()
+        # Resolve the tensors once, instead of on every run.
+        get_tensor = self._graph.get_tensor_by_name
+        self._image_tensor = get_tensor("image_tensor:0")
+        self._fetches = [get_tensor("detection_boxes:0"),
+                         get_tensor("detection_scores:0"),
+                         get_tensor("detection_classes:0"),
+                         get_tensor("num_detections:0")]
 
     def run(self, frames):
+        """Detect objects in frames.
+
+        Frames of the same image shape are stacked and run as one batch.
+
+        Args:
+            frames: A list of VideoFrame objects.
+
+        Returns:
+            A list of results, one for each frame in the same order. Each
+            result is a list of (boxes, scores, classes, num_detections) with
+            a batch dimension of 1.
+        """
         assert self._graph, "Should load the model first before running it"
-        image_tensor = self._graph.get_tensor_by_name("image_tensor:0")
-        detection_boxes = self._graph.get_tensor_by_name("detection_boxes:0")
-        detection_scores = self._graph.get_tensor_by_name("detection_scores:0")
-        detection_classes = self._graph.get_tensor_by_name("detection_classes:0")
-        num_detections = self._graph.get_tensor_by_name("num_detections:0")
-
-        # input_data = np.stack([blob.fetch("image") for blob in frames])
-        fetches = [detection_boxes,
-                   detection_scores,
-                   detection_classes,
-                   num_detections]
-        # feed_dict = {image_tensor: input_data}
-        # (boxes, scores, classes, num) = \
-        #    self._session.run(fetches, feed_dict=feed_dict)
-        images = [np.expand_dims(frame.image, axis=0)
-                  for frame in frames]
-        results = [self._session.run(fetches,
-                                     feed_dict={image_tensor: image})
-                   for image in images]
+        groups = {}
+        for i, frame in enumerate(frames):
+            groups.setdefault(frame.image.shape, []).append(i)
+
+        results = [None] * len(frames)
+        for indexes in groups.values():
+            input_data = np.stack([frames[i].image for i in indexes])
+            outputs = self._session.run(
+                self._fetches,
+                feed_dict={self._image_tensor: input_data})
+            for j, i in enumerate(indexes):
+                results[i] = [output[j:j + 1] for output in outputs]
         return results
+
+    def warmup(self):
+        self.run(_warmup_frames())
+
+
+class OpenCVObjectDetection(ModelBase):
+    """Object detection with the DNN module of OpenCV.
+
+    It's an alternative runtime for CPU nodes, with the same results as
+    `ObjectDetection`. Besides the frozen graph, it needs the text graph of
+    the model generated by the tf_text_graph_ssd.py script of OpenCV, named
+    "graph.pbtxt" in the same directory.
+    """
+
+    TEXT_GRAPH_NAME = "graph.pbtxt"
+    # The input size of the network.
+    INPUT_SIZE = (300, 300)
+    # The maximum number of detections of a frame, as the TensorFlow model.
+    MAX_DETECTIONS = 100
+
+    def __init__(self, path, version, **kwargs):
+        super().__init__(path, version, **kwargs)
+        self._net = None
+
+    def load(self):
+        text_graph = os.path.join(os.path.dirname(self._path),
+                                  self.TEXT_GRAPH_NAME)
+        if not os.path.isfile(text_graph):
+            raise IOError("The OpenCV runtime needs the text graph of the"
+                          " model: {}".format(text_graph))
+        self._net = cv2.dnn.readNetFromTensorflow(self._path, text_graph)
+        self._net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self._net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        if self._intra_op_threads > 0:
+            cv2.setNumThreads(self._intra_op_threads)
+
+    def release(self):
+        self._net = None
+
+    def run(self, frames):
+        """Detect objects in frames.
+
+        Returns:
+            A list of results in the same format as `ObjectDetection.run()`.
+        """
+        assert self._net is not None, ("Should load the model first before"
+                                       " running it")
+        blob = cv2.dnn.blobFromImages([frame.image for frame in frames],
+                                      size=self.INPUT_SIZE,
+                                      swapRB=True,
+                                      crop=False)
+        self._net.setInput(blob)
+        # Each detection is (batch_id, class_id, score, xmin, ymin, xmax,
+        # ymax), sorted by score in each frame.
+        detections = self._net.forward().reshape(-1, 7)
+
+        results = []
+        for i in range(len(frames)):
+            found = detections[detections[:, 0] == i][:self.MAX_DETECTIONS]
+            num = len(found)
+            boxes = np.zeros((1, self.MAX_DETECTIONS, 4), dtype=np.float32)
+            scores = np.zeros((1, self.MAX_DETECTIONS), dtype=np.float32)
+            classes = np.zeros((1, self.MAX_DETECTIONS), dtype=np.float32)
+            boxes[0, :num] = np.clip(found[:, [4, 3, 6, 5]], 0.0, 1.0)
+            scores[0, :num] = found[:, 2]
+            classes[0, :num] = found[:, 1]
+            results.append([boxes,
+                            scores,
+                            classes,
+                            np.array([num], dtype=np.float32)])
+        return results
+
+    def warmup(self):
+        self.run(_warmup_frames())
@@ -0,0 +1,209 @@
+"""Registry of the models of an inference worker.
+
+Models are loaded on their first use, and the least recently used ones are
+unloaded when the loaded models don't fit in the memory budget of the worker.
+The memory of a model is estimated by the size of its graph file.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from jagereye_ng.gpu_worker.batcher import (DynamicBatcher,
+                                            DEFAULT_MAX_BATCH_SIZE,
+                                            DEFAULT_MAX_WAIT)
+from jagereye_ng.util import logging
+
+
+DEFAULT_MEMORY_BUDGET = 2048        # MB
+
+
+class _Entry(object):
+    def __init__(self, key):
+        self.key = key
+        self.model = None
+        self.batcher = None
+        self.size = 0
+        self.users = 0
+        self.exception = None
+        self.loaded_event = threading.Event()
+
+
+class ModelRegistry(object):
+    """A class used to load and unload the models of a worker on demand.
+
+    Attributes:
+        memory_budget (int): The memory, in MB, that the loaded models may
+            use. A model that is in use is never unloaded, so the budget may
+            be exceeded while all loaded models are in use.
+    """
+
+    def __init__(self, model_path, model_classes, default_versions,
+                 memory_budget=DEFAULT_MEMORY_BUDGET,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_wait=DEFAULT_MAX_WAIT, model_options=None,
+                 warmup=False):
+        """Initialize a `ModelRegistry` object.
+
+        Args:
+            model_path (ModelPath): The paths of the model files.
+            model_classes (dict): The model class of each model name.
+            default_versions (dict): The version of each model name to use
+                if no version is given.
+            memory_budget (int): The memory budget in MB.
+            max_batch_size (int): The maximum batch size of the batchers of
+                the models.
+            max_wait (float): The maximum wait of the batchers of the models.
+            model_options (dict): The keyword arguments to create the models
+                with, besides the path and version. Defaults to None.
+            warmup (bool): Whether to warm up the models after loading them.
+                Defaults to False.
+        """
+        self.memory_budget = memory_budget
+        self._model_path = model_path
+        self._model_classes = model_classes
+        self._default_versions = default_versions
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._model_options = model_options or {}
+        self._warmup = warmup
+        # The entries in least recently used order.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_key(self, name, version):
+        if name not in self._model_classes:
+            raise KeyError("Unknown model: {}".format(name))
+        if version is None:
+            version = self._default_versions[name]
+        return (name, version)
+
+    def get_version(self, name, version=None):
+        """Get the version of a model that `use()` would use."""
+        return self._get_key(name, version)[1]
+
+    def _used_memory(self):
+        return sum(e.size for e in self._entries.values())
+
+    def _evict(self, size):
+        """Unload the least recently used models to make space for a model.
+
+        It should be called with the lock held.
+        """
+        for key, entry in list(self._entries.items()):
+            if self._used_memory() + size <= self.memory_budget * 2 ** 20:
+                break
+            if entry.users > 0 or not entry.loaded_event.is_set():
+                continue
+            logging.info("Unloading model: {}".format(key))
+            del self._entries[key]
+            threading.Thread(target=self._unload, args=(entry,)).start()
+
+    @staticmethod
+    def _unload(entry):
+        # The waiting requests of the batcher are finished first.
+        if entry.batcher is not None:
+            entry.batcher.stop()
+        if entry.model is not None:
+            entry.model.release()
+
+    def _load(self, entry):
+        name, version = entry.key
+        path = self._model_path.get(name, version)
+        logging.info("Loading model: {}".format(entry.key))
+        try:
+            model = self._model_classes[name](path,
+                                              version,
+                                              **self._model_options)
+            model.load()
+            if self._warmup:
+                model.warmup()
+            entry.model = model
+            entry.batcher = DynamicBatcher(model,
+                                           self._max_batch_size,
+                                           self._max_wait)
+        except Exception as e:
+            logging.error("Failed to load model {}: {}".format(entry.key, e))
+            entry.exception = e
+            with self._lock:
+                self._entries.pop(entry.key, None)
+        finally:
+            entry.loaded_event.set()
+
+    def _acquire(self, name, version):
+        key = self._get_key(name, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            is_new = entry is None
+            if is_new:
+                entry = _Entry(key)
+                path = self._model_path.get(*key)
+                entry.size = os.path.getsize(path)
+                self._evict(entry.size)
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            entry.users += 1
+        if is_new:
+            self._load(entry)
+        else:
+            entry.loaded_event.wait()
+        if entry.exception is not None:
+            self._release(entry)
+            raise entry.exception
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+
+    @contextmanager
+    def use(self, name, version=None):
+        """Use a model, loading it if it's not loaded.
+
+        The model isn't unloaded while it's in use.
+
+        Args:
+            name (string): The name of the model.
+            version (string): The version of the model. Defaults to None,
+                which means the default version of the model.
+
+        Yields:
+            The `DynamicBatcher` of the model.
+        """
+        entry = self._acquire(name, version)
+        try:
+            yield entry.batcher
+        finally:
+            self._release(entry)
+
+    def preload(self, name, version=None):
+        """Load a model if it's not loaded."""
+        with self.use(name, version):
+            pass
+
+    def get_metrics(self):
+        """Get the metrics of the loaded models.
+
+        Returns:
+            A dict of the batching metrics of each loaded model, keyed by
+            "<name>/<version>". See `DynamicBatcher.get_metrics()`.
+        """
+        with self._lock:
+            entries = [e for e in self._entries.values()
+                       if e.batcher is not None]
+        return {"{}/{}".format(*e.key): e.batcher.get_metrics()
+                for e in entries}
+
+    def release(self):
+        """Unload all models."""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.loaded_event.wait()
+            self._unload(entry)
@@ -0,0 +1,249 @@
+"""A process-wide pool of video encoder threads.
+
+Instead of starting a writer thread for each event video, the videos are
+encoded by a fixed number of encoder threads that live as long as the
+process. Each video is an `EncodeJob` pinned to the least loaded encoder,
+which can encode several videos at the same time. The number of encoders is
+capped at the number of CPU cores, so bursts of events don't oversubscribe
+the CPU.
+
+Only the threads are pooled. A `cv2.VideoWriter` is bound to one output file,
+so each video still opens its own writer, and its GStreamer pipeline, on the
+encoder thread. Each process has its own pool, so the analyzer drivers of a
+node should be given a few encoders each rather than one per core.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+from queue import Queue
+
+import cv2
+
+from jagereye_ng.io.streaming import open_video_writer
+from jagereye_ng.util import logging
+
+
+DEFAULT_ENCODER_QUEUE_SIZE = 256    # frames
+
+_OP_OPEN = 0
+_OP_WRITE = 1
+_OP_END = 2
+_OP_STOP = 3
+
+
+class EncodeJob(object):
+    """A video file being encoded by an `EncoderPool`.
+
+    Attributes:
+        filename (string): The path of the video file.
+        exception (Exception): The exception raised when encoding the video,
+            if any.
+    """
+
+    def __init__(self, encoder, filename, fps, size):
+        self.filename = filename
+        self.fps = fps
+        self.size = size
+        self.exception = None
+        self._encoder = encoder
+        self._done_event = threading.Event()
+        self._callback = None
+        self.writer = None
+
+    def write(self, frames):
+        """Queue frames to be encoded.
+
+        Args:
+            frames: A VideoFrame object or a list of them.
+        """
+        if not isinstance(frames, list):
+            frames = [frames]
+        for frame in frames:
+            self._encoder.submit(_OP_WRITE, self, frame)
+
+    def end(self, callback=None):
+        """Finish the video after all queued frames are encoded.
+
+        Args:
+            callback (function): The function to call, in the encoder thread,
+                when the video file is closed. It's called with the job as
+                its argument, and should hand slow work, such as uploading
+                the file, to another thread. Defaults to None.
+        """
+        self._callback = callback
+        self._encoder.submit(_OP_END, self)
+
+    def wait(self, timeout=None):
+        """Wait for the video to be finished.
+
+        Returns:
+            True if the video is finished and false if the wait timed out.
+        """
+        return self._done_event.wait(timeout)
+
+    def finish(self):
+        if self._callback is not None:
+            try:
+                self._callback(self)
+            except Exception as e:
+                logging.error("Callback of encoding {} failed: {}"
+                              .format(self.filename, e))
+        self._done_event.set()
+
+
+class EncoderThread(threading.Thread):
+    """An encoder thread of an `EncoderPool`."""
+
+    def __init__(self, queue_size, jobs_lock):
+        super(EncoderThread, self).__init__()
+        self._queue = Queue(maxsize=queue_size)
+        self._jobs_lock = jobs_lock
+        self.num_jobs = 0
+
+    def submit(self, op, job=None, frame=None):
+        self._queue.put((op, job, frame))
+
+    def get_queue_depth(self):
+        return self._queue.qsize()
+
+    def _open(self, job):
+        writer = cv2.VideoWriter()
+        open_video_writer(writer, job.filename, job.fps, job.size)
+        job.writer = writer
+
+    def _end(self, job):
+        try:
+            if job.writer is not None:
+                job.writer.release()
+                job.writer = None
+        finally:
+            with self._jobs_lock:
+                self.num_jobs -= 1
+            job.finish()
+
+    def run(self):
+        while True:
+            op, job, frame = self._queue.get()
+            if op == _OP_STOP:
+                break
+            # Once a job has failed, the rest of its frames are skipped.
+            if op != _OP_END and job.exception is not None:
+                continue
+            try:
+                if op == _OP_OPEN:
+                    self._open(job)
+                elif op == _OP_WRITE:
+                    job.writer.write(frame.image)
+                elif op == _OP_END:
+                    self._end(job)
+            except Exception as e:
+                logging.error("Failed to encode {}: {}"
+                              .format(job.filename, e))
+                job.exception = e
+        logging.info("Encoder thread is terminated")
+
+
+class EncoderPool(object):
+    """A pool of encoder threads shared by all event videos of a process."""
+
+    def __init__(self, num_encoders=None,
+                 queue_size=DEFAULT_ENCODER_QUEUE_SIZE):
+        """Initialize an `EncoderPool` object.
+
+        Args:
+            num_encoders (int): The number of encoder threads. It's capped at
+                the number of CPU cores. Defaults to None, which means the
+                number of CPU cores.
+            queue_size (int): The maximum number of frames waiting to be
+                encoded by each encoder. Writing to a full encoder blocks.
+        """
+        num_cores = os.cpu_count() or 1
+        if num_encoders is None:
+            num_encoders = num_cores
+        self._lock = threading.Lock()
+        self._encoders = [EncoderThread(queue_size, self._lock)
+                          for _ in range(min(num_encoders, num_cores))]
+        for encoder in self._encoders:
+            encoder.daemon = True
+            encoder.start()
+
+    def open(self, filename, fps, size):
+        """Start encoding a video file.
+
+        The file is opened asynchronously, errors are reported through
+        `EncodeJob.exception`.
+
+        Args:
+            filename (string): The path of the video file.
+            fps (float): The fps of the video.
+            size (tuple): The size of the video with format (width, height).
+
+        Returns:
+            An `EncodeJob` object to write frames to.
+        """
+        with self._lock:
+            encoder = min(self._encoders,
+                          key=lambda e: (e.num_jobs, e.get_queue_depth()))
+            encoder.num_jobs += 1
+        job = EncodeJob(encoder, filename, fps, size)
+        encoder.submit(_OP_OPEN, job)
+        return job
+
+    def get_metrics(self):
+        """Get the metrics of the pool.
+
+        Returns:
+            A dict with the following keys:
+                active_jobs (int): The number of videos being encoded.
+                queue_depth (int): The number of queued operations of all
+                    encoders.
+                encoders (list of dict): The metrics of each encoder, with
+                    keys "active_jobs" and "queue_depth".
+        """
+        with self._lock:
+            encoders = [{"active_jobs": e.num_jobs,
+                         "queue_depth": e.get_queue_depth()}
+                        for e in self._encoders]
+        return {
+            "active_jobs": sum(e["active_jobs"] for e in encoders),
+            "queue_depth": sum(e["queue_depth"] for e in encoders),
+            "encoders": encoders
+        }
+
+    def shutdown(self):
+        """Stop the encoders after all queued videos are finished."""
+        for encoder in self._encoders:
+            encoder.submit(_OP_STOP)
+        for encoder in self._encoders:
+            encoder.join()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_encoder_pool(num_encoders=None):
+    """Get the encoder pool of the process, creating it on first use.
+
+    Args:
+        num_encoders (int): The number of encoder threads of the pool if it's
+            created by this call, see `EncoderPool`. Defaults to None.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EncoderPool(num_encoders)
+        return _pool
+
+
+def shutdown_encoder_pool():
+    """Shut down the encoder pool of the process, if it has been created."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -98,6 +98,22 @@ class ObjectStorageClient(object):
         with open(file_path, "rb") as obj:
             self.save_obj(key, obj)
 
+    def delete_objs(self, keys):
+        """Delete objects from object store.
+
+        Args:
+          keys (list of string): The keys of the objects.
+        """
+        if not self._client:
+            raise RuntimeError("Not connected to object storage yet")
+
+        # At most 1000 objects can be deleted by a request.
+        for i in range(0, len(keys), 1000):
+            objects = [{"Key": key} for key in keys[i:i + 1000]]
+            self._client.delete_objects(Bucket=self._bucket_name,
+                                        Delete={"Objects": objects,
+                                                "Quiet": True})
+
     def _gen_public_read_policy(self, bucket_name):
         """Generate a bucket policy to be public readable.
 
@@ -0,0 +1,310 @@
+"""Shared memory transport of video frames.
+
+Frames put into a `SharedFrameRing` are copied into a memory mapped file
+under /dev/shm, so only small `SharedFrameRef` descriptors have to be sent to
+the workers on the same host. The workers map the segment and read the pixels
+without copying them.
+
+The segments are named after the process that created them. A process
+removes its segments when it exits, and `remove_stale_segments()` removes
+the segments left behind by processes that were killed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import atexit
+import os
+import socket
+import tempfile
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import numpy as np
+
+from jagereye_ng.io.streaming import VideoFrame
+from jagereye_ng.util import logging
+
+
+# The directory to create segments in, it should be backed by memory.
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+# The prefix of the names of all segments.
+SEGMENT_PREFIX = "jagereye"
+DEFAULT_SHARED_RING_SIZE = 16       # frames
+# The maximum number of segments that a worker keeps mapped.
+MAX_ATTACHED_SEGMENTS = 64
+
+
+class SharedFrameRef(object):
+    """A descriptor of a frame stored in a shared memory segment.
+
+    Attributes:
+        segment (string): The name of the segment.
+        offset (int): The offset, in bytes, of the image in the segment.
+        shape (tuple): The shape of the image.
+        dtype (string): The data type of the image.
+        timestamp (float): The timestamp of the frame.
+    """
+    __slots__ = ["segment", "offset", "shape", "dtype", "timestamp"]
+
+    def __init__(self, segment, offset, shape, dtype, timestamp):
+        self.segment = segment
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        self.timestamp = timestamp
+
+    def __getstate__(self):
+        return (self.segment, self.offset, self.shape, self.dtype,
+                self.timestamp)
+
+    def __setstate__(self, state):
+        (self.segment, self.offset, self.shape, self.dtype,
+         self.timestamp) = state
+
+
+class SharedFrameRing(object):
+    """A ring of frame slots in a named shared memory segment.
+
+    The slot size is determined by the first frame put into the ring. A
+    descriptor returned by `put()` is only valid until `capacity` more frames
+    have been put, so the frames of a batch must be consumed before the ring
+    wraps around to them.
+    """
+
+    def __init__(self, capacity=DEFAULT_SHARED_RING_SIZE,
+                 name_prefix="frames"):
+        """Initialize a `SharedFrameRing` object.
+
+        Args:
+            capacity (int): The number of frame slots.
+            name_prefix (string): The prefix of the segment name, after
+                SEGMENT_PREFIX.
+        """
+        self.capacity = capacity
+        self._name_prefix = name_prefix
+        self._segment = None
+        self._buffer = None
+        self._slot_bytes = 0
+        self._next_slot = 0
+        _open_rings.add(self)
+
+    def _create_segment(self, slot_bytes):
+        self.close()
+        self._segment = "{}-{}-{}-{}".format(SEGMENT_PREFIX,
+                                             self._name_prefix,
+                                             os.getpid(),
+                                             uuid.uuid4().hex)
+        path = os.path.join(SHM_DIR, self._segment)
+        with open(path, "w+b") as f:
+            f.truncate(self.capacity * slot_bytes)
+        self._buffer = np.memmap(path,
+                                 dtype=np.uint8,
+                                 mode="r+",
+                                 shape=(self.capacity * slot_bytes,))
+        self._slot_bytes = slot_bytes
+        self._next_slot = 0
+        logging.info("Created shared frame segment: {}".format(path))
+
+    def put(self, image, timestamp):
+        """Copy an image into the next slot of the ring.
+
+        Args:
+            image (ndarray): The image to be shared.
+            timestamp (float): The timestamp of the frame.
+
+        Returns:
+            A `SharedFrameRef` object of the stored frame.
+        """
+        image = np.ascontiguousarray(image)
+        if image.nbytes > self._slot_bytes:
+            # The frames are bigger than before, start a new segment.
+            self._create_segment(image.nbytes)
+        offset = self._next_slot * self._slot_bytes
+        self._buffer[offset:offset + image.nbytes] = image.reshape(-1).view(
+            np.uint8)
+        self._next_slot = (self._next_slot + 1) % self.capacity
+        return SharedFrameRef(self._segment,
+                              offset,
+                              image.shape,
+                              image.dtype.str,
+                              timestamp)
+
+    def put_frames(self, frames):
+        """Share the analysis images of a list of VideoFrame objects.
+
+        Returns:
+            A list of `SharedFrameRef` objects.
+        """
+        if len(frames) > self.capacity:
+            raise ValueError("Can't share {} frames in a ring of {} slots"
+                             .format(len(frames), self.capacity))
+        # Fit the whole batch into one segment, since starting a new segment
+        # removes the frames put before.
+        max_bytes = max([frame.analysis_image.nbytes for frame in frames],
+                        default=0)
+        if max_bytes > self._slot_bytes:
+            self._create_segment(max_bytes)
+        return [self.put(frame.analysis_image, frame.timestamp)
+                for frame in frames]
+
+    def close(self):
+        """Remove the segment.
+
+        Workers that still map the segment can keep reading it until they
+        unmap it.
+        """
+        if self._segment is None:
+            return
+        self._buffer = None
+        try:
+            os.remove(os.path.join(SHM_DIR, self._segment))
+        except OSError as e:
+            logging.error("Failed to remove shared frame segment: {}"
+                          .format(e))
+        self._segment = None
+
+
+# The rings of the process, whose segments are removed when it exits.
+_open_rings = weakref.WeakSet()
+
+
+@atexit.register
+def close_rings():
+    """Remove the segments of all rings of the process.
+
+    It's called when the interpreter exits, but processes that exit with
+    `os._exit()`, such as the ones of `multiprocessing`, should call it
+    themselves.
+    """
+    for ring in list(_open_rings):
+        ring.close()
+
+
+def _get_segment_pid(segment):
+    """Get the id of the process that created a segment, or None."""
+    if not segment.startswith(SEGMENT_PREFIX + "-"):
+        return None
+    try:
+        return int(segment.rsplit("-", 2)[-2])
+    except (IndexError, ValueError):
+        return None
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user.
+        pass
+    return True
+
+
+def remove_stale_segments():
+    """Remove the segments of processes that are no longer running.
+
+    A killed process can't remove its segments, so they stay in memory
+    until they are removed by this function, which should be called when
+    the application starts.
+
+    Returns:
+        The number of removed segments.
+    """
+    removed = 0
+    for name in os.listdir(SHM_DIR):
+        pid = _get_segment_pid(name)
+        if pid is None or _is_process_alive(pid):
+            continue
+        try:
+            os.remove(os.path.join(SHM_DIR, name))
+            removed += 1
+        except OSError as e:
+            logging.error("Failed to remove stale shared frame segment: {}"
+                          .format(e))
+    if removed > 0:
+        logging.info("Removed {} stale shared frame segments"
+                     .format(removed))
+    return removed
+
+
+_attached_segments = OrderedDict()
+_attached_lock = threading.Lock()
+
+
+def _map_segment(segment):
+    with _attached_lock:
+        try:
+            buf = _attached_segments.pop(segment)
+        except KeyError:
+            buf = np.memmap(os.path.join(SHM_DIR, segment),
+                            dtype=np.uint8,
+                            mode="r")
+            # A new segment usually replaces a removed one. Unmap the
+            # removed segments, since their memory is only freed once no
+            # one maps them.
+            for name in list(_attached_segments):
+                if not os.path.exists(os.path.join(SHM_DIR, name)):
+                    del _attached_segments[name]
+            if len(_attached_segments) >= MAX_ATTACHED_SEGMENTS:
+                _attached_segments.popitem(last=False)
+        _attached_segments[segment] = buf
+        return buf
+
+
+def attach(ref):
+    """Get the frame of a descriptor without copying its image.
+
+    Args:
+        ref (SharedFrameRef): The descriptor of the frame.
+
+    Returns:
+        A VideoFrame object whose image is a read-only view of the segment.
+    """
+    buf = _map_segment(ref.segment)
+    dtype = np.dtype(ref.dtype)
+    nbytes = int(np.prod(ref.shape)) * dtype.itemsize
+    image = buf[ref.offset:ref.offset + nbytes].view(dtype).reshape(ref.shape)
+    return VideoFrame(image, ref.timestamp)
+
+
+def resolve(arg):
+    """Replace shared frame descriptors in a task argument with frames.
+
+    Args:
+        arg: A `SharedFrameRef` object, a list of them, or any other value
+            which is returned as is.
+    """
+    if isinstance(arg, SharedFrameRef):
+        return attach(arg)
+    if (isinstance(arg, list) and arg and
+            all(isinstance(a, SharedFrameRef) for a in arg)):
+        return [attach(a) for a in arg]
+    return arg
+
+
+def get_local_workers(client, resource=None):
+    """Get the addresses of the Dask workers running on the local host.
+
+    Args:
+        client (dask.distributed.Client): The Dask client.
+        resource (string): Only get the workers that provide the resource.
+            Defaults to None.
+
+    Returns:
+        A list of worker addresses.
+    """
+    local_hosts = {"127.0.0.1", "localhost", socket.gethostname()}
+    try:
+        local_hosts.add(socket.gethostbyname(socket.gethostname()))
+    except socket.error:
+        pass
+    workers = client.scheduler_info()["workers"]
+    return [addr for addr, info in workers.items()
+            if urlparse(addr).hostname in local_hosts and
+            (resource is None or resource in info.get("resources", {}))]
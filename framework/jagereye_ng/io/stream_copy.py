@@ -0,0 +1,242 @@
+"""Recording of compressed video streams without re-encoding.
+
+A `StreamCopyRecorder` keeps a rolling buffer of the compressed packets of a
+source, so event videos can be cut from it by remuxing, instead of decoding
+and re-encoding the frames. The buffer is a directory of short MPEG-TS
+segments written by an ffmpeg process in stream copy mode. Each segment
+starts at a keyframe, so an exported video starts from the nearest keyframe
+before the requested start time.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from jagereye_ng.io.streaming import _is_livestream
+from jagereye_ng.util import logging
+
+
+FFMPEG_BIN = "ffmpeg"
+DEFAULT_SEGMENT_TIME = 2            # seconds
+# The backoff, in seconds, before restarting a stopped ffmpeg process.
+RESTART_BACKOFF = 2.0
+# The time, in seconds, to wait beyond the segment time for the segment at
+# the end of an export to be closed, since segments are only cut at
+# keyframes.
+EXPORT_GRACE_TIME = 4.0
+# The interval, in seconds, to poll for new segments.
+POLL_INTERVAL = 0.2
+SEGMENT_EXT = ".ts"
+
+
+class StreamCopyRecorder(object):
+    """A class used to record a source into a rolling buffer of segments.
+
+    Attributes:
+        src (string): The url of the video source.
+        history_len (int): The length, in seconds, of the buffer that is kept
+            when no one holds it.
+        segment_time (int): The target length, in seconds, of each segment.
+            The actual length depends on the keyframe interval of the source.
+    """
+
+    def __init__(self, src, history_len=3,
+                 segment_time=DEFAULT_SEGMENT_TIME):
+        """Initialize a `StreamCopyRecorder` object."""
+        self.src = src
+        self.history_len = history_len
+        self.segment_time = segment_time
+        self._segment_dir = None
+        self._process = None
+        self._holds = {}
+        self._next_hold_id = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def supports(src):
+        """Check whether a source can be recorded or not.
+
+        Only livestreams are supported, since the segments are timed by the
+        wall clock.
+        """
+        return _is_livestream(src)
+
+    def retain(self, history_len):
+        """Extend the length of the buffer to at least `history_len`."""
+        self.history_len = max(self.history_len, history_len)
+
+    def _ffmpeg_cmd(self):
+        cmd = [FFMPEG_BIN, "-nostdin", "-loglevel", "error",
+               "-rtsp_transport", "tcp"]
+        # The segments are named by their start time in seconds since epoch.
+        cmd += ["-i", self.src,
+                "-map", "0:v",
+                "-c", "copy",
+                "-f", "segment",
+                "-segment_time", str(self.segment_time),
+                "-segment_format", "mpegts",
+                "-reset_timestamps", "1",
+                "-strftime", "1",
+                os.path.join(self._segment_dir, "%s" + SEGMENT_EXT)]
+        return cmd
+
+    def _start_process(self):
+        logging.info("Starting stream copy of {}".format(self.src))
+        self._process = subprocess.Popen(self._ffmpeg_cmd(),
+                                         stdin=subprocess.DEVNULL)
+
+    def start(self):
+        """Start recording the source."""
+        assert self._thread is None, ("Perhaps you call start() twice by"
+                                      " accident?")
+        self._segment_dir = tempfile.mkdtemp(prefix="jagereye-segments-")
+        self._start_process()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._maintain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def release(self):
+        """Stop recording and remove the buffered segments."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+            self._process = None
+        if self._segment_dir is not None:
+            shutil.rmtree(self._segment_dir, ignore_errors=True)
+            self._segment_dir = None
+
+    def _maintain(self):
+        """Restart ffmpeg if it stops, and prune expired segments."""
+        while not self._stop_event.wait(self.segment_time):
+            if self._process.poll() is not None:
+                logging.error("Stream copy of {} stopped with code {}"
+                              .format(self.src, self._process.returncode))
+                if self._stop_event.wait(RESTART_BACKOFF):
+                    break
+                self._start_process()
+            self._prune()
+
+    def _list_segments(self):
+        """List the segments with their start times, sorted by time."""
+        segments = []
+        for name in os.listdir(self._segment_dir):
+            stem, ext = os.path.splitext(name)
+            if ext == SEGMENT_EXT and stem.isdigit():
+                segments.append((int(stem),
+                                 os.path.join(self._segment_dir, name)))
+        segments.sort()
+        return segments
+
+    def _prune(self):
+        with self._lock:
+            keep_since = time.time() - self.history_len
+            if self._holds:
+                keep_since = min(keep_since, min(self._holds.values()))
+        segments = self._list_segments()
+        # A segment ends where the next one starts, and the last one is
+        # still being written.
+        for (_, path), (next_start, _) in zip(segments, segments[1:]):
+            if next_start < keep_since:
+                os.remove(path)
+
+    def hold(self, timestamp):
+        """Keep the segments since a timestamp until the hold is removed.
+
+        Args:
+            timestamp (float): The timestamp to keep the segments since.
+
+        Returns:
+            The id of the hold.
+        """
+        with self._lock:
+            hold_id = self._next_hold_id
+            self._next_hold_id += 1
+            self._holds[hold_id] = timestamp
+        return hold_id
+
+    def unhold(self, hold_id):
+        with self._lock:
+            self._holds.pop(hold_id, None)
+
+    def _wait_segment_after(self, timestamp):
+        """Wait until a segment newer than a timestamp is started.
+
+        The segment containing the timestamp is still being written until
+        the next one is started. The wait gives up after the segment time
+        plus EXPORT_GRACE_TIME since the timestamp, or if the recorder is
+        released.
+        """
+        deadline = timestamp + self.segment_time + EXPORT_GRACE_TIME
+        while True:
+            segments = self._list_segments()
+            if segments and segments[-1][0] > timestamp:
+                return
+            if time.time() >= deadline:
+                logging.warn("No segment of {} after {}, the video may be"
+                             " truncated".format(self.src, timestamp))
+                return
+            if self._stop_event.wait(POLL_INTERVAL):
+                return
+
+    def export(self, filename, start, end):
+        """Remux the buffered stream between two timestamps into a file.
+
+        It blocks until the segment containing `end` is closed.
+
+        Args:
+            filename (string): The output file, its container is determined
+                by the file extension.
+            start (float): The start timestamp.
+            end (float): The end timestamp.
+
+        Returns:
+            The start timestamp of the exported video, which is the start of
+            the segment containing `start`.
+
+        Raises:
+            RuntimeError: Raise if no segment covers the time range or ffmpeg
+                failed to remux the segments.
+        """
+        self._wait_segment_after(end)
+        segments = self._list_segments()
+        selected = []
+        for i, (seg_start, path) in enumerate(segments):
+            seg_end = (segments[i + 1][0] if i + 1 < len(segments)
+                       else float("inf"))
+            if seg_start <= end and seg_end > start:
+                selected.append((seg_start, path))
+        if not selected:
+            raise RuntimeError("No buffered stream between {} and {}"
+                               .format(start, end))
+
+        list_fd, list_path = tempfile.mkstemp(suffix=".txt")
+        try:
+            with os.fdopen(list_fd, "w") as f:
+                for _, path in selected:
+                    f.write("file '{}'\n".format(path))
+            cmd = [FFMPEG_BIN, "-nostdin", "-loglevel", "error", "-y",
+                   "-f", "concat", "-safe", "0", "-i", list_path,
+                   "-c", "copy", filename]
+            if subprocess.call(cmd) != 0:
+                raise RuntimeError("Failed to remux stream into {}"
+                                   .format(filename))
+        finally:
+            os.remove(list_path)
+        return float(selected[0][0])
@@ -4,10 +4,12 @@ from __future__ import print_function
 
 import os
 import time
+import heapq
 import threading
 import signal
 import cv2
-from queue import Queue
+import numpy as np
+from queue import Queue, Full, Empty
 from collections import deque
 from urllib.parse import urlparse
 
@@ -16,6 +18,23 @@ from jagereye_ng.util import logging
 
 DEFAULT_STREAM_BUFFER_SIZE = 64     # frames
 DEFAULT_FPS = 15
+# The maximum fps reported by a source that is considered valid, some
+# livestreams report their time base instead of the frame rate.
+MAX_SOURCE_FPS = 240
+# The bounds of the backoff, in seconds, between reconnection attempts.
+RECONNECT_MIN_BACKOFF = 0.5
+RECONNECT_MAX_BACKOFF = 30.0
+# The time, in seconds, after which a multiplexed source that is still being
+# read is considered stalled.
+DEFAULT_MUX_READ_TIMEOUT = 10.0
+# The maximum time, in seconds, to wait for the decode threads to stop.
+MUX_RELEASE_TIMEOUT = 5.0
+DEFAULT_WRITER_QUEUE_SIZE = 64      # frames
+# The interval, in seconds, to check whether the writer thread is still alive
+# while waiting for room in the queue.
+WRITER_PUT_TIMEOUT = 1.0
+# The queue item to tell the writer thread to stop.
+WRITER_END_OF_STREAM = object()
 
 
 class ConnectionError(Exception):
@@ -94,51 +113,606 @@ def run_with_timeout(timeout, func, *args, **kwargs):
 
 
 class VideoFrame(object):
-    def __init__(self, image_raw, timestamp=None):
+    """A class used to store a captured frame.
+
+    Attributes:
+        image (ndarray): The full resolution image of the frame.
+        timestamp (float): The timestamp of which the frame been captured.
+        analysis_image (ndarray): The image downscaled to the analysis
+            resolution. It's the same as `image` if the frame has not been
+            downscaled.
+        after_gap (bool): Whether frames are missing right before this frame
+            or not, which happens when the reader has reconnected to the
+            source.
+        leased (bool): Whether the frame is a slot of a `FrameRingBuffer` or
+            not. The images and attributes of a leased frame are overwritten
+            by the reader after the next `read()`, call `detach()` to keep
+            the frame for longer.
+    """
+    def __init__(self, image_raw, timestamp=None, analysis_image=None,
+                 after_gap=False, leased=False):
         self.image = image_raw
+        self.after_gap = after_gap
+        self.leased = leased
         if timestamp is None:
             self.timestamp = time.time()
         else:
             self.timestamp = timestamp
+        if analysis_image is None:
+            self.analysis_image = image_raw
+        else:
+            self.analysis_image = analysis_image
+
+    def to_analysis(self):
+        """Get a copy of the frame that only holds the analysis image.
+
+        It's useful to avoid transferring the full resolution image when
+        sending the frame to other workers for analyzing.
+        """
+        return VideoFrame(self.analysis_image, self.timestamp,
+                          after_gap=self.after_gap, leased=self.leased)
+
+    def detach(self):
+        """Get a frame that stays valid after the next read of the reader.
+
+        The images of a leased frame are copied, other frames are returned
+        as they are.
+        """
+        if not self.leased:
+            return self
+        analysis_image = None
+        if self.analysis_image is not self.image:
+            analysis_image = self.analysis_image.copy()
+        return VideoFrame(self.image.copy(), self.timestamp, analysis_image,
+                          self.after_gap)
+
+
+class FrameBatch(object):
+    """A batch of frames leased from a `FrameRingBuffer`.
+
+    The frames of the batch are the leased frames of the ring buffer slots,
+    they stay valid until the next call to `FrameRingBuffer.read()`. Callers
+    that need to keep a frame for longer should call `VideoFrame.detach()`.
+
+    Attributes:
+        slots (list of int): The ring buffer slots of the frames.
+        images (list of ndarray): The views of the frame images.
+        analysis_images (list of ndarray): The views of the downscaled frame
+            images, which are the same as `images` if the ring buffer doesn't
+            downscale frames.
+        timestamps (ndarray): The float64 timestamps of the frames, parallel
+            to `images`.
+        after_gaps (ndarray): The bool flags of whether frames are missing
+            right before each frame, parallel to `images`.
+    """
+    def __init__(self, ring, slots):
+        self.slots = slots
+        self.images = [ring.images[slot] for slot in slots]
+        if ring.analysis_images is None:
+            self.analysis_images = self.images
+        else:
+            self.analysis_images = [ring.analysis_images[slot]
+                                    for slot in slots]
+        self.timestamps = ring.timestamps[slots]
+        self.after_gaps = ring.after_gaps[slots]
+        self._frames = [ring.frames[slot] for slot in slots]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getitem__(self, index):
+        return self._frames[index]
+
+    def __iter__(self):
+        for i in range(len(self.slots)):
+            yield self[i]
+
+
+class FrameRingBuffer(object):
+    """A preallocated ring buffer of video frames.
+
+    All frame images are stored in one `(capacity, height, width, 3)` uint8
+    array which is allocated once, so the reader thread can decode each frame
+    in place without allocating memory. The slots are recycled through a free
+    list: when no slot is free, the oldest unread frame is dropped, which
+    matches the behavior of a bounded deque.
+
+    Slots returned by `read()` are leased to the consumer and won't be
+    overwritten until the next `read()` call. Each slot has one `VideoFrame`
+    object, in `frames`, which is reused for every frame written to the slot.
+    """
+
+    def __init__(self, capacity, frame_size, analysis_size=None):
+        """Initialize a `FrameRingBuffer` object.
+
+        Args:
+            capacity (int): The number of frame slots.
+            frame_size (tuple): The frame size with format (width, height).
+            analysis_size (tuple): The size of the downscaled frames with
+                format (width, height). Defaults to None, which means frames
+                are not downscaled.
+        """
+        width, height = frame_size
+        self.capacity = capacity
+        self.images = np.zeros((capacity, height, width, 3), dtype=np.uint8)
+        if analysis_size is None:
+            self.analysis_images = None
+        else:
+            self.analysis_images = np.zeros(
+                (capacity, analysis_size[1], analysis_size[0], 3),
+                dtype=np.uint8)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.after_gaps = np.zeros(capacity, dtype=np.bool_)
+        self.frames = [VideoFrame(self.images[slot],
+                                  0.0,
+                                  (None if self.analysis_images is None
+                                   else self.analysis_images[slot]),
+                                  leased=True)
+                       for slot in range(capacity)]
+        self._free = deque(range(capacity))
+        self._ready = deque()
+        self._leased = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ready)
+
+    def acquire(self):
+        """Acquire a slot to write a new frame into.
+
+        Returns:
+            A tuple of (slot, image), where image is the view of the slot.
+        """
+        with self._lock:
+            if self._free:
+                slot = self._free.popleft()
+            else:
+                # Drop the oldest unread frame.
+                slot = self._ready.popleft()
+        return slot, self.images[slot]
+
+    def commit(self, slot, timestamp, after_gap=False):
+        """Mark an acquired slot as a readable frame."""
+        with self._lock:
+            self.timestamps[slot] = timestamp
+            self.after_gaps[slot] = after_gap
+            self.frames[slot].timestamp = float(timestamp)
+            self.frames[slot].after_gap = bool(after_gap)
+            self._ready.append(slot)
+
+    def discard(self, slot):
+        """Give back an acquired slot without committing it."""
+        with self._lock:
+            self._free.append(slot)
+
+    def read(self, batch_size):
+        """Lease the oldest `batch_size` frames to the consumer.
+
+        The frames leased by the previous call are released first.
+
+        Returns:
+            A `FrameBatch` object.
+        """
+        # One slot may be held by the writer, and the slots of the batch must
+        # not be taken back to write new frames while being leased.
+        assert batch_size < self.capacity - 1, ("batch_size should be smaller"
+                                                " than the buffer size - 1")
+        with self._lock:
+            self._free.extend(self._leased)
+            num = min(batch_size, len(self._ready))
+            self._leased = [self._ready.popleft() for _ in range(num)]
+            return FrameBatch(self, self._leased)
+
+    def has_free_slot(self):
+        """Check whether a frame can be written without dropping another."""
+        with self._lock:
+            return len(self._free) > 0
+
+    def clear(self):
+        with self._lock:
+            self._free = deque(range(self.capacity))
+            self._ready.clear()
+            self._leased = []
+
+
+def _open_capture(reader, src, timeout):
+    """Open a video source with a timeout and read its first frame.
+
+    Args:
+        reader (cv2.VideoCapture): The capture to open the source with.
+        src (string): The url of the video source.
+        timeout (float): The timeout, in seconds, of opening the source.
+
+    Returns:
+        The image of the first frame.
+
+    Raises:
+        ConnectionError: Raise if the source can't be opened.
+    """
+    error_message = "Can't open video source from {}".format(src)
+
+    # Open video source
+    try:
+        if not run_with_timeout(timeout, reader.open, src):
+            raise ConnectionError(error_message)
+    except TaskTimeoutError:
+        logging.error("Timeout error occurred when opening video source"
+                      " from {}".format(src))
+        raise ConnectionError(error_message)
+
+    success, image = reader.read()
+    if not success:
+        raise ConnectionError(error_message)
+    return image
+
+
+def _downscale(image, analysis_size):
+    if analysis_size is None:
+        return None
+    return cv2.resize(image, analysis_size, interpolation=cv2.INTER_AREA)
+
+
+class FrameDecimator(object):
+    """A class used to decide which frames of a source to keep.
+
+    Every frame of the source is expected to be grabbed, but only a fraction
+    of them, given by the keep ratio, should be retrieved to follow the
+    target fps. When the source fps is unknown, frames are kept on a capture
+    interval schedule instead.
+
+    Attributes:
+        grab_interval (float): The expected interval, in seconds, between two
+            grabbed frames.
+    """
+    def __init__(self, fps, src_fps=None):
+        """Initialize a `FrameDecimator` object.
+
+        Args:
+            fps (float): The target fps.
+            src_fps (float): The fps reported by the source. Defaults to None.
+        """
+        self._cap_interval = 1.0 / fps
+        if src_fps is not None and 0 < src_fps <= MAX_SOURCE_FPS:
+            self._keep_ratio = min(1.0, fps / src_fps)
+            self.grab_interval = 1.0 / src_fps
+        else:
+            self._keep_ratio = None
+            self.grab_interval = self._cap_interval
+        self._keep_credit = 1.0
+        self._next_due = 0.0
+
+    def is_due(self, now=None):
+        """Check whether the grabbed frame should be kept or not.
+
+        Args:
+            now (float): The current time, which is only used if the source
+                fps is unknown. Defaults to None, which means the wall clock.
+        """
+        if self._keep_ratio is not None:
+            self._keep_credit += self._keep_ratio
+            if self._keep_credit < 1.0:
+                return False
+            self._keep_credit -= 1.0
+            return True
+        if now is None:
+            now = time.time()
+        if now < self._next_due:
+            return False
+        self._next_due = now + self._cap_interval
+        return True
 
 
 class StreamReaderThread(threading.Thread):
     def __init__(self,
                  reader,
                  queue,
+                 frame_ready,
                  stop_event,
                  cap_interval,
-                 is_livestream):
+                 is_livestream,
+                 src_fps=None,
+                 decimate=False,
+                 analysis_size=None,
+                 src=None,
+                 open_timeout=15,
+                 reconnect_attempts=0,
+                 offline=False,
+                 start_time=None,
+                 end_pos=None):
         super(StreamReaderThread, self).__init__()
         self._reader = reader
         self._queue = queue
+        self._frame_ready = frame_ready
         self._stop_event = stop_event
         self._cap_interval = cap_interval / 1000.0
         self._is_livestream = is_livestream
+        self._decimate = decimate
+        self._decimator = FrameDecimator(1.0 / self._cap_interval, src_fps)
+        self._analysis_size = analysis_size
+        self._src = src
+        self._open_timeout = open_timeout
+        self._reconnect_attempts = reconnect_attempts
+        self._reconnecting = False
+        self._after_gap = False
+        self.num_reconnects = 0
+        self._offline = offline
+        self._start_time = start_time
+        self._end_pos = end_pos
         self._exception = None
+        self._next_grab = 0.0
+
+    def _notify(self):
+        with self._frame_ready:
+            self._frame_ready.notify_all()
+
+    def _clock(self):
+        """Get the timestamp of the latest grabbed frame.
+
+        In offline mode, it's the position of the frame in the video plus the
+        start time, otherwise, it's the wall clock.
+        """
+        if self._offline:
+            return (self._start_time +
+                    self._reader.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+        return time.time()
+
+    def _check_end_pos(self):
+        """Stop reading at the end position in offline mode."""
+        if (self._end_pos is not None and
+                self._clock() - self._start_time >= self._end_pos):
+            raise EndOfVideoError()
+
+    def _has_space(self):
+        if isinstance(self._queue, FrameRingBuffer):
+            return self._queue.has_free_slot()
+        return len(self._queue) < self._queue.maxlen
+
+    def _wait_for_space(self):
+        """Wait until a frame can be buffered without dropping another."""
+        with self._frame_ready:
+            self._frame_ready.wait_for(
+                lambda: self._has_space() or self._stop_event.is_set())
+
+    def _pace(self):
+        """Pace grabbing of file sources to the source fps."""
+        delay = self._next_grab - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Don't try to catch up if we have fallen behind.
+            self._next_grab = time.time()
+        self._next_grab += self._decimator.grab_interval
+
+    def _read_to_ring(self, decode):
+        slot, target = self._queue.acquire()
+        success, image = decode(image=target)
+        if not success:
+            self._queue.discard(slot)
+            return False
+        if image is not target:
+            # The decoder reallocated the image, which happens when the
+            # stream changes its resolution. Fit it into the slot.
+            logging.warn("Frame size changed to {}, resizing it to fit into"
+                         " the ring buffer".format(image.shape))
+            cv2.resize(image, (target.shape[1], target.shape[0]), dst=target)
+        if self._analysis_size is not None:
+            cv2.resize(target,
+                       self._analysis_size,
+                       dst=self._queue.analysis_images[slot],
+                       interpolation=cv2.INTER_AREA)
+        self._queue.commit(slot, self._clock(), self._after_gap)
+        self._after_gap = False
+        return True
+
+    def _read_to_deque(self, decode):
+        success, image = decode()
+        if not success:
+            return False
+        timestamp = self._clock()
+        analysis_image = _downscale(image, self._analysis_size)
+        self._queue.appendleft(VideoFrame(image,
+                                          timestamp,
+                                          analysis_image,
+                                          self._after_gap))
+        self._after_gap = False
+        return True
+
+    def _reconnect(self):
+        """Reopen the livestream with bounded exponential backoff.
+
+        Returns:
+            True if the livestream has been reopened, and false if the
+            attempts are exhausted or the thread is stopped.
+        """
+        self._reconnecting = True
+        self._reader.release()
+        backoff = RECONNECT_MIN_BACKOFF
+        for attempt in range(1, self._reconnect_attempts + 1):
+            logging.warn("Lost connection to {}, reconnecting in {} seconds"
+                         " (attempt {}/{})".format(self._src,
+                                                   backoff,
+                                                   attempt,
+                                                   self._reconnect_attempts))
+            if self._stop_event.wait(backoff):
+                return False
+            # Each attempt opens a new capture, since a timed out attempt may
+            # still be opening its capture in the background.
+            reader = cv2.VideoCapture()
+            try:
+                if run_with_timeout(self._open_timeout,
+                                    reader.open,
+                                    self._src):
+                    logging.info("Reconnected to {}".format(self._src))
+                    self._reader = reader
+                    self._reconnecting = False
+                    self._after_gap = True
+                    self.num_reconnects += 1
+                    return True
+                reader.release()
+            except TaskTimeoutError:
+                # Abandon the capture to the timed out attempt.
+                logging.error("Timeout error occurred when reopening video"
+                              " source from {}".format(self._src))
+            backoff = min(backoff * 2, RECONNECT_MAX_BACKOFF)
+        return False
+
+    def is_reconnecting(self):
+        return self._reconnecting
+
+    def _handle_read_error(self):
+        """Try to recover from a failed read, or raise the error.
+
+        Returns:
+            True if the reading can continue and false if the thread is
+            stopped.
+        """
+        if self._is_livestream and self._reconnect():
+            return True
+        if self._stop_event.is_set():
+            return False
+        self._raise_read_error()
+
+    def _raise_read_error(self):
+        if self._is_livestream:
+            raise ConnectionError()
+        else:
+            raise EndOfVideoError()
 
     def run(self):
+        if isinstance(self._queue, FrameRingBuffer):
+            read_frame = self._read_to_ring
+        else:
+            read_frame = self._read_to_deque
         try:
             while not self._stop_event.is_set():
-                success, image = self._reader.read()
+                if self._offline:
+                    # Decode as fast as the consumer takes the frames.
+                    self._wait_for_space()
+                    if self._stop_event.is_set():
+                        break
+                if self._decimate or self._offline:
+                    # Advance the stream without decoding, so the end
+                    # position is checked before the frame is kept, and with
+                    # `decimate`, only decode the frames that we are going to
+                    # keep.
+                    if (self._decimate and not self._is_livestream and
+                            not self._offline):
+                        self._pace()
+                    if not self._reader.grab():
+                        if self._handle_read_error():
+                            continue
+                        break
+                    if self._offline:
+                        self._check_end_pos()
+                    if self._decimate:
+                        now = self._clock() if self._offline else None
+                        if not self._decimator.is_due(now):
+                            continue
+                    success = read_frame(self._reader.retrieve)
+                else:
+                    success = read_frame(self._reader.read)
                 if not success:
-                    if self._is_livestream:
-                        raise ConnectionError()
-                    else:
-                        raise EndOfVideoError()
-                timestamp = time.time()
-                self._queue.appendleft(VideoFrame(image, timestamp))
-                time.sleep(self._cap_interval)
+                    if self._handle_read_error():
+                        continue
+                    break
+                self._notify()
+                if not self._decimate and not self._offline:
+                    time.sleep(self._cap_interval)
             logging.info("Reader thread is terminated")
         except Exception as e:
             logging.error(str(e))
             self._exception = e
+            # Wake up the consumer so it can handle the exception.
+            self._notify()
 
     def get_exception(self):
         return self._exception
 
+    def get_reader(self):
+        """Get the capture, which is replaced when reconnecting."""
+        return self._reader
+
+
+class BufferedStreamReader(object):
+    """The base class of readers that buffer the captured frames.
+
+    Subclasses fill `_queue` from another thread, notify `_frame_ready` when
+    new frames or an exception are available, and implement
+    `_get_exception()`.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_STREAM_BUFFER_SIZE):
+        self._queue = deque(maxlen=buffer_size)
+        self._frame_ready = threading.Condition()
+        self._video_info = {}
+
+    def get_video_info(self):
+        return self._video_info
+
+    def _get_exception(self):
+        raise NotImplementedError()
+
+    def _read_all(self):
+        return self._read(len(self._queue))
+
+    def _read(self, batch_size):
+        if isinstance(self._queue, FrameRingBuffer):
+            return self._queue.read(batch_size)
+        return [self._queue.pop() for _ in range(batch_size)]
+
+    def _is_readable(self, batch_size):
+        return (len(self._queue) >= batch_size or
+                self._get_exception() is not None)
+
+    def read(self, batch_size=1, timeout=None):
+        """The routine of video stream capturer capturation.
+
+        The call blocks until `batch_size` frames are available or the reader
+        thread stops with an exception.
+
+        Args:
+            batch_size (int): The number of frames to read. Defaults to 1.
+            timeout (float): The maximum time, in seconds, to wait for the
+                frames. When the timeout expires, a partial batch with the
+                frames read so far is returned, which may be empty. Defaults
+                to None, which means waiting without a deadline.
+
+        Returns:
+            A list of captured VideoFrame objects, or a `FrameBatch` object if
+            the reader was created with `preallocate`. The length of the
+            result is determined by the `batch_size`.
+
+        Raises:
+            ConnectionError: Raise if the livestream connection is
+                disconnected.
+            EndOfVideoError: Raise if the file stream reaches the end.
+        """
+        with self._frame_ready:
+            self._frame_ready.wait_for(
+                lambda: self._is_readable(batch_size), timeout)
+        cur_q_size = len(self._queue)
+
+        exception = self._get_exception()
+        if isinstance(exception, EndOfVideoError):
+            if cur_q_size == 0:
+                raise EndOfVideoError()
+            elif cur_q_size <= batch_size:
+                data = self._read_all()
+            else:
+                data = self._read(batch_size)
+        elif isinstance(exception, ConnectionError):
+            raise ConnectionError()
+        else:
+            # The queue may hold less than `batch_size` frames only if the
+            # wait has timed out, return what we have got in that case.
+            data = self._read(min(cur_q_size, batch_size))
+        # Wake up the producer if it's waiting for space in the queue.
+        with self._frame_ready:
+            self._frame_ready.notify_all()
+        return data
+
 
-class VideoStreamReader(object):
+class VideoStreamReader(BufferedStreamReader):
     """The video stream reader.
 
     The reader to read frames from a video stream source. The source can be a
@@ -154,42 +728,104 @@ class VideoStreamReader(object):
 
     The "timestamp" tensor is a 0-dimensional numpy `ndarray` whose type is
     string.
+
+    With `preallocate` enabled, the frames are decoded in place into a
+    `FrameRingBuffer` that is sized from the first frame in `open()`, and
+    `read()` returns a `FrameBatch` whose images are views into the buffer.
+    The frames are only valid until the next `read()` call, so consumers
+    that keep frames across reads, such as event video agents, should keep
+    `VideoFrame.detach()` of them instead.
     """
 
-    def __init__(self, buffer_size=DEFAULT_STREAM_BUFFER_SIZE):
+    def __init__(self, buffer_size=DEFAULT_STREAM_BUFFER_SIZE,
+                 preallocate=False):
         """Initialize a `VideoStreamReader` object.
 
         Args:
             buffer_size: The maximum size to buffering the video stream.
+            preallocate: Whether to decode frames into a preallocated ring
+                buffer or not. Defaults to False.
         """
+        super(VideoStreamReader, self).__init__(buffer_size)
         self._reader = cv2.VideoCapture()
-        self._queue = deque(maxlen=buffer_size)
+        self._buffer_size = buffer_size
+        self._preallocate = preallocate
         self._stop_event = threading.Event()
-        self._video_info = {}
 
-    def open(self, src, timeout=15, fps=DEFAULT_FPS):
+    def open(self, src, timeout=15, fps=DEFAULT_FPS, decimate=False,
+             analysis_size=None, reconnect_attempts=0, offline=False,
+             start_time=None, start_pos=None, end_pos=None):
+        """Open a video source and start reading frames from it.
+
+        Args:
+            src (string): The url of the video source.
+            timeout (float): The timeout, in seconds, of opening the source.
+                Defaults to 15.
+            fps (float): The target fps to capture frames. Defaults to
+                `DEFAULT_FPS`.
+            decimate (bool): Whether to skip decoding of the frames that are
+                not captured or not. In this mode, each frame is grabbed to
+                advance the stream, but only the frames needed to keep up
+                with `fps` are retrieved. Defaults to False.
+            analysis_size (tuple): The resolution, with format (width,
+                height), to downscale frames to for analyzing. The downscaled
+                image of each frame is stored in `VideoFrame.analysis_image`
+                alongside the full resolution one. Defaults to None, which
+                means frames are not downscaled.
+            reconnect_attempts (int): The number of attempts to reconnect to
+                a livestream before `read()` raises ConnectionError. The
+                attempts are made with bounded exponential backoff by the
+                reader thread, and the first frame after a reconnection has
+                `after_gap` set. Defaults to 0.
+            offline (bool): Whether to read a file source faster than real
+                time or not. In this mode, frames are decoded as fast as they
+                are read, without dropping any of them, and each frame is
+                timestamped with its position in the video plus
+                `start_time`. Enable `decimate` too to keep following `fps`.
+                Defaults to False.
+            start_time (float): The timestamp of the beginning of the video
+                in offline mode. Defaults to None, which means the time of
+                opening the source.
+            start_pos (float): The position, in seconds, to start reading
+                from in offline mode. It should be a keyframe position for
+                frames to be decoded correctly. Defaults to None.
+            end_pos (float): The position, in seconds, to stop reading at in
+                offline mode. Defaults to None, which means the end of the
+                video.
+
+        Raises:
+            ConnectionError: Raise if the source can't be opened.
+        """
         logging.info("Opening video source: {}".format(src))
 
         assert not self._reader.isOpened(), ("Perhaps you call open() twice"
                                              " by accident?")
-
-        error_message = "Can't open video source from {}".format(src)
-
-        # Open video source
-        try:
-            if not run_with_timeout(timeout, self._reader.open, src):
-                raise ConnectionError(error_message)
-        except TaskTimeoutError:
-            logging.error("Timeout error occurred when opening video source"
-                          " from {}".format(src))
-            raise ConnectionError(error_message)
+        if offline and _is_livestream(src):
+            raise ValueError("Offline mode is only for file sources")
+        if not offline and (start_pos is not None or end_pos is not None):
+            raise ValueError("Reading positions are only for offline mode")
+        if start_time is None:
+            start_time = time.time()
 
         # Get video information
-        success, image = self._reader.read()
-        if not success:
-            raise ConnectionError(error_message)
+        image = _open_capture(self._reader, src, timeout)
         height, width, _ = image.shape
         self._video_info["frame_size"] = (width, height)
+        self._video_info["fps"] = self._reader.get(cv2.CAP_PROP_FPS)
+        if offline:
+            # Seek back over the first frame read by opening the source, so
+            # no frame of the video is skipped.
+            start_pos = start_pos or 0.0
+            self._reader.set(cv2.CAP_PROP_POS_MSEC, start_pos * 1000.0)
+        if analysis_size is not None:
+            analysis_size = tuple(analysis_size)
+            self._video_info["analysis_size"] = analysis_size
+        else:
+            self._video_info["analysis_size"] = (width, height)
+        if self._preallocate:
+            self._queue = FrameRingBuffer(self._buffer_size,
+                                          (width, height),
+                                          analysis_size)
 
         # Start reader thread
         self._stop_event.clear()
@@ -197,85 +833,408 @@ class VideoStreamReader(object):
         logging.info("Starting reader thread")
         self._thread = StreamReaderThread(self._reader,
                                           self._queue,
+                                          self._frame_ready,
                                           self._stop_event,
                                           capture_interval,
-                                          _is_livestream(src))
+                                          _is_livestream(src),
+                                          self._video_info["fps"],
+                                          decimate,
+                                          analysis_size,
+                                          src,
+                                          timeout,
+                                          reconnect_attempts,
+                                          offline,
+                                          start_time,
+                                          end_pos)
         self._thread.daemon = True
         self._thread.start()
 
     def release(self):
         self._stop_event.set()
+        # Wake up the reader thread if it's waiting for space in the queue.
+        with self._frame_ready:
+            self._frame_ready.notify_all()
         if hasattr(self, "_thread"):
             self._thread.join()
+            self._reader = self._thread.get_reader()
         self._reader.release()
         self._queue.clear()
 
-    def get_video_info(self):
-        return self._video_info
+    def _get_exception(self):
+        return self._thread.get_exception()
 
-    def _read_all(self):
-        return [self._queue.pop() for _ in range(len(self._queue))]
+    def is_reconnecting(self):
+        """Check whether the reader is reconnecting to the source or not."""
+        return self._thread.is_reconnecting()
 
-    def _read(self, batch_size):
-        return [self._queue.pop() for _ in range(batch_size)]
+    def get_num_reconnects(self):
+        return self._thread.num_reconnects
 
-    def read(self, batch_size=1):
-        """The routine of video stream capturer capturation.
+
+class MultiplexedSource(BufferedStreamReader):
+    """A video source decoded by the thread pool of a `StreamMultiplexer`.
+
+    The object is created by `StreamMultiplexer.add_source()`, consumers read
+    frames from it in the same way as from a `VideoStreamReader`.
+    """
+
+    def __init__(self, source_id, src, fps, decimate, analysis_size,
+                 buffer_size):
+        super(MultiplexedSource, self).__init__(buffer_size)
+        self.source_id = source_id
+        self._src = src
+        self._reader = cv2.VideoCapture()
+        self._is_livestream = _is_livestream(src)
+        self._fps = fps
+        self._decimate = decimate
+        if analysis_size is not None:
+            analysis_size = tuple(analysis_size)
+        self._analysis_size = analysis_size
+        self._exception = None
+        # The scheduling states, guarded by the multiplexer.
+        self.removed = False
+        self.scheduled = False
+        self.next_due = 0.0
+        # The time the current step started, None if the source is not being
+        # decoded.
+        self.stepping_since = None
+        self.stalled = False
+
+    def open(self, timeout):
+        image = _open_capture(self._reader, self._src, timeout)
+        height, width, _ = image.shape
+        self._video_info["frame_size"] = (width, height)
+        self._video_info["fps"] = self._reader.get(cv2.CAP_PROP_FPS)
+        if self._analysis_size is not None:
+            self._video_info["analysis_size"] = self._analysis_size
+        else:
+            self._video_info["analysis_size"] = (width, height)
+        self._decimator = FrameDecimator(self._fps, self._video_info["fps"])
+        if self._decimate:
+            self.interval = self._decimator.grab_interval
+        else:
+            self.interval = 1.0 / self._fps
+        self.next_due = time.time()
+
+    def release(self):
+        self._reader.release()
+        self._queue.clear()
+
+    def _get_exception(self):
+        return self._exception
+
+    def _notify(self):
+        with self._frame_ready:
+            self._frame_ready.notify_all()
+
+    def fail(self, exception):
+        """Stop the source with an exception raised to its consumer."""
+        logging.error("Source {} stopped: {!r}".format(self.source_id,
+                                                       exception))
+        self._exception = exception
+        self._notify()
+
+    def _decode(self):
+        if self._decimate:
+            if not self._reader.grab():
+                return False, None
+            if not self._decimator.is_due():
+                return True, None
+            return self._reader.retrieve()
+        return self._reader.read()
+
+    def step(self):
+        """Advance the source by one frame.
+
+        It's called by one decode thread at a time.
 
         Returns:
-            A list of captured VideoFrame objects. The length of the list
-            is determined by the `batch_size`.
+            True if the source can be scheduled again and false otherwise.
+        """
+        try:
+            success, image = self._decode()
+            if not success:
+                if self._is_livestream:
+                    raise ConnectionError()
+                else:
+                    raise EndOfVideoError()
+            if image is not None:
+                self._queue.appendleft(VideoFrame(
+                    image,
+                    time.time(),
+                    _downscale(image, self._analysis_size)))
+                self._notify()
+            return True
+        except Exception as e:
+            self.fail(e)
+            return False
+
+
+class StreamMultiplexer(object):
+    """Decode many video sources with a bounded pool of threads.
+
+    Instead of a reader thread per source, the sources are shared by a fixed
+    number of decode threads. Each source is scheduled to be decoded at its
+    own frame interval, and the threads always pick the source with the
+    earliest due time, so all sources are served fairly. When the pool can't
+    keep up, a source is put back behind the others after it's served, which
+    degrades all sources evenly instead of starving some of them.
+
+    A read that blocks for longer than `read_timeout`, such as on a stalled
+    RTSP connection, stops the source with a `ConnectionError` and a new
+    decode thread is started to take the place of the blocked one. Unlike
+    `VideoStreamReader`, the sources don't reconnect, don't support offline
+    reading and don't preallocate frames, so the multiplexer is meant for
+    video files and for livestreams whose consumers re-add the source on
+    `ConnectionError`.
+
+    Examples:
+        mux = StreamMultiplexer(num_workers=4)
+        mux.start()
+        source = mux.add_source("cam-1", "rtsp://...")
+        frames = source.read(batch_size=5)
+    """
+
+    def __init__(self, num_workers=None,
+                 buffer_size=DEFAULT_STREAM_BUFFER_SIZE,
+                 read_timeout=DEFAULT_MUX_READ_TIMEOUT):
+        """Initialize a `StreamMultiplexer` object.
+
+        Args:
+            num_workers (int): The number of decode threads. Defaults to None,
+                which means the number of CPU cores.
+            buffer_size (int): The maximum size to buffering each source.
+            read_timeout (float): The time, in seconds, after which a source
+                blocked on reading is stopped. Defaults to 10.
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self._num_workers = num_workers
+        self._buffer_size = buffer_size
+        self._read_timeout = read_timeout
+        self._sources = {}
+        self._schedule = []
+        self._schedule_seq = 0
+        self._schedule_cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the decode threads."""
+        assert not self._threads, ("Perhaps you call start() twice by"
+                                   " accident?")
+        self._stop_event.clear()
+        logging.info("Starting {} decode threads".format(self._num_workers))
+        for _ in range(self._num_workers):
+            self._start_thread(self._run_worker)
+        self._start_thread(self._run_watchdog)
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def release(self):
+        """Stop the decode threads and release all sources.
+
+        The threads that are still blocked on reading after
+        `MUX_RELEASE_TIMEOUT` seconds are left behind, and their sources are
+        released when the reads return.
+        """
+        self._stop_event.set()
+        with self._schedule_cond:
+            self._schedule_cond.notify_all()
+        deadline = time.time() + MUX_RELEASE_TIMEOUT
+        for thread in self._threads:
+            thread.join(max(deadline - time.time(), 0))
+        num_blocked = sum(thread.is_alive() for thread in self._threads)
+        if num_blocked > 0:
+            logging.warn("{} decode threads are still blocked on reading"
+                         .format(num_blocked))
+        self._threads = []
+        with self._schedule_cond:
+            sources = list(self._sources.values())
+            sources += [source for _, _, source in self._schedule
+                        if source.removed]
+            for source in sources:
+                source.removed = True
+                # The source is released by its decode thread when the
+                # blocked read returns.
+                if source.stepping_since is None:
+                    source.release()
+        self._sources.clear()
+        self._schedule = []
+
+    def add_source(self, source_id, src, timeout=15, fps=DEFAULT_FPS,
+                   decimate=False, analysis_size=None):
+        """Open a video source and schedule it to be decoded.
+
+        Args:
+            source_id (string): The unique id of the source.
+            src (string): The url of the video source.
+            timeout (float): The timeout, in seconds, of opening the source.
+                Defaults to 15.
+            fps, decimate, analysis_size: See `VideoStreamReader.open()`.
+
+        Returns:
+            A `MultiplexedSource` object to read frames from.
 
         Raises:
-            ConnectionError: Raise if the livestream connection is
-                disconnected.
-            EndOfVideoError: Raise if the file stream reaches the end.
+            ConnectionError: Raise if the source can't be opened.
         """
-        cur_q_size = len(self._queue)
-        while cur_q_size < batch_size:
-            if self._thread.get_exception() is not None:
+        logging.info("Adding video source {}: {}".format(source_id, src))
+        if source_id in self._sources:
+            raise ValueError("Source already exists: {}".format(source_id))
+
+        source = MultiplexedSource(source_id, src, fps, decimate,
+                                   analysis_size, self._buffer_size)
+        source.open(timeout)
+        with self._schedule_cond:
+            self._sources[source_id] = source
+            self._push(source)
+        return source
+
+    def remove_source(self, source_id):
+        """Stop decoding a source.
+
+        The source is released by the decode thread that picks it up next.
+        """
+        with self._schedule_cond:
+            source = self._sources.pop(source_id)
+            source.removed = True
+            if source.scheduled:
+                self._schedule_cond.notify_all()
+            else:
+                # The source has stopped, no decode thread will pick it up.
+                source.release()
+
+    def get_source(self, source_id):
+        return self._sources[source_id]
+
+    def read(self, source_id, batch_size=1, timeout=None):
+        """Read a batch of frames of a source.
+
+        See `VideoStreamReader.read()` for the arguments and the result.
+        """
+        return self._sources[source_id].read(batch_size, timeout)
+
+    def _push(self, source):
+        # The sequence number breaks ties, so sources due at the same time
+        # are served in order.
+        heapq.heappush(self._schedule,
+                       (source.next_due, self._schedule_seq, source))
+        self._schedule_seq += 1
+        source.scheduled = True
+        self._schedule_cond.notify()
+
+    def _pop_due(self):
+        """Wait for and take the source with the earliest due time."""
+        with self._schedule_cond:
+            while not self._stop_event.is_set():
+                if self._schedule:
+                    due, _, source = self._schedule[0]
+                    if source.removed:
+                        heapq.heappop(self._schedule)
+                        source.release()
+                        continue
+                    delay = due - time.time()
+                    if delay <= 0:
+                        heapq.heappop(self._schedule)
+                        return source
+                    self._schedule_cond.wait(delay)
+                else:
+                    self._schedule_cond.wait()
+        return None
+
+    def _run_watchdog(self):
+        """Stop the sources blocked on reading and replace their threads."""
+        while not self._stop_event.wait(self._read_timeout / 2):
+            now = time.time()
+            with self._schedule_cond:
+                stalled = [
+                    source for source in self._sources.values()
+                    if (source.stepping_since is not None and
+                        not source.stalled and
+                        now - source.stepping_since > self._read_timeout)]
+                for source in stalled:
+                    source.stalled = True
+            for source in stalled:
+                source.fail(ConnectionError(
+                    "Read timed out after {} seconds".format(
+                        self._read_timeout)))
+                self._start_thread(self._run_worker)
+
+    def _run_worker(self):
+        while True:
+            source = self._pop_due()
+            if source is None:
                 break
-            time.sleep(0.1)
-            cur_q_size = len(self._queue)
+            with self._schedule_cond:
+                source.stepping_since = time.time()
+            alive = source.step()
+            with self._schedule_cond:
+                source.stepping_since = None
+                if source.stalled:
+                    # Another thread has taken the place of this one while
+                    # the read was blocked.
+                    source.scheduled = False
+                    if source.removed:
+                        source.release()
+                    break
+                if source.removed:
+                    source.release()
+                elif alive:
+                    source.next_due = max(source.next_due + source.interval,
+                                          time.time())
+                    self._push(source)
+                else:
+                    source.scheduled = False
+        logging.info("Decode thread is terminated")
+
+
+def open_video_writer(writer, filename, fps, size):
+    """Open a video file to write.
+
+    Files with extension ".mp4" are encoded with x264 through GStreamer, and
+    the other files are encoded with XVID.
 
-        exception = self._thread.get_exception()
-        if isinstance(exception, EndOfVideoError):
-            if cur_q_size == 0:
-                raise EndOfVideoError()
-            elif cur_q_size <= batch_size:
-                data = self._read_all()
-            else:
-                data = self._read(batch_size)
-        elif isinstance(exception, ConnectionError):
-            raise ConnectionError()
-        else:
-            # XXX: In this case we are assuming that everything is fine,
-            #      and current queue size should greater than the batch
-            #      size.
-            data = self._read(batch_size)
-        return data
+    Args:
+        writer (cv2.VideoWriter): The writer to open the file with.
+        filename (string): The path of the video file.
+        fps (float): The fps of the video.
+        size (tuple): The size of the video with format (width, height).
+
+    Raises:
+        RuntimeError: Raise if the file can't be opened.
+    """
+    _, ext = os.path.splitext(filename)
+    if ext == ".mp4":
+        filename = ('appsrc ! autovideoconvert ! x264enc ! matroskamux !'
+                     ' filesink location={}'.format(filename))
+        fourcc = 0
+    else:
+        fourcc = cv2.VideoWriter_fourcc(*'XVID')
+
+    if not writer.open(filename, fourcc, fps, size):
+        raise RuntimeError("Can't open video file {}"
+                           .format(filename))
 
 
 class StreamWriterThread(threading.Thread):
-    def __init__(self, writer, queue, stop_event):
+    def __init__(self, writer, queue):
         super(StreamWriterThread, self).__init__()
         self._writer = writer
         self._queue = queue
-        self._stop_event = stop_event
         self._exception = None
 
     def run(self):
         try:
             while True:
-                if self._queue.empty():
-                    if self._stop_event.is_set():
-                        break
-                    else:
-                        time.sleep(0.01)
-                        continue
                 frame = self._queue.get()
+                if frame is WRITER_END_OF_STREAM:
+                    break
                 self._writer.write(frame.image)
-                self._queue.task_done()
             logging.info("Writer thread is terminated")
         except Exception as e:
             logging.error(str(e))
@@ -286,50 +1245,98 @@ class StreamWriterThread(threading.Thread):
 
 
 class VideoStreamWriter(object):
-    def __init__(self):
+    """The video stream writer.
+
+    Frames are written by a writer thread through a bounded queue. When the
+    queue is full, `write()` follows the overflow policy:
+    1. OVERFLOW_BLOCK: Wait until the writer thread catches up.
+    2. OVERFLOW_DROP_OLDEST: Drop the oldest queued frame.
+    3. OVERFLOW_DROP_NEWEST: Drop the frame being written.
+
+    Attributes:
+        num_dropped (int): The number of frames dropped so far.
+    """
+
+    OVERFLOW_BLOCK = "block"
+    OVERFLOW_DROP_OLDEST = "drop_oldest"
+    OVERFLOW_DROP_NEWEST = "drop_newest"
+
+    def __init__(self, queue_size=DEFAULT_WRITER_QUEUE_SIZE,
+                 overflow=OVERFLOW_BLOCK):
+        """Initialize a `VideoStreamWriter` object.
+
+        Args:
+            queue_size (int): The maximum number of frames waiting to be
+                written. Defaults to `DEFAULT_WRITER_QUEUE_SIZE`.
+            overflow (string): The overflow policy. Defaults to
+                `OVERFLOW_BLOCK`.
+        """
+        if overflow not in (VideoStreamWriter.OVERFLOW_BLOCK,
+                            VideoStreamWriter.OVERFLOW_DROP_OLDEST,
+                            VideoStreamWriter.OVERFLOW_DROP_NEWEST):
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
         self._writer = cv2.VideoWriter()
-        self._queue = Queue()
-        self._stop_event = threading.Event()
+        self._queue = Queue(maxsize=queue_size)
+        self._overflow = overflow
+        self.num_dropped = 0
 
     def open(self, filename, fps, size):
         if self._writer.isOpened():
             raise RuntimeError("Stream is already opened")
 
-        _, ext = os.path.splitext(filename)
-        if ext == ".mp4":
-            filename = ('appsrc ! autovideoconvert ! x264enc ! matroskamux !'
-                         ' filesink location={}'.format(filename))
-            fourcc = 0
-        else:
-            fourcc = cv2.VideoWriter_fourcc(*'XVID')
-
-        if not self._writer.open(filename, fourcc, fps, size):
-            raise RuntimeError("Can't open video file {}"
-                               .format(filename))
-
-        self._stop_event.clear()
+        open_video_writer(self._writer, filename, fps, size)
 
         logging.info("Starting writer thread")
-        self._thread = StreamWriterThread(self._writer,
-                                          self._queue,
-                                          self._stop_event)
+        self._thread = StreamWriterThread(self._writer, self._queue)
         self._thread.daemon = True
         self._thread.start()
 
     def end(self):
         try:
-            self._stop_event.set()
             if hasattr(self, "_thread") and self._thread.is_alive():
-                if not self._queue.empty():
-                    self._queue.join()
+                # The writer thread stops after writing all queued frames.
+                self._put_blocking(WRITER_END_OF_STREAM)
                 self._thread.join()
             self._writer.release()
+            if self.num_dropped > 0:
+                logging.warn("Dropped {} frames when writing video"
+                             .format(self.num_dropped))
         except Exception as e:
             logging.error(str(e))
 
+    def _put_blocking(self, item):
+        """Put an item into the queue, unless the writer thread has died."""
+        while True:
+            try:
+                self._queue.put(item, timeout=WRITER_PUT_TIMEOUT)
+                return True
+            except Full:
+                if not self._thread.is_alive():
+                    return False
+
+    def _put(self, frame):
+        if self._overflow == VideoStreamWriter.OVERFLOW_BLOCK:
+            if not self._put_blocking(frame):
+                self.num_dropped += 1
+            return
+        while True:
+            try:
+                self._queue.put_nowait(frame)
+                return
+            except Full:
+                if self._overflow == VideoStreamWriter.OVERFLOW_DROP_NEWEST:
+                    self.num_dropped += 1
+                    return
+            # Drop the oldest frame and try again.
+            try:
+                self._queue.get_nowait()
+                self.num_dropped += 1
+            except Empty:
+                pass
+
     def write(self, frames):
         if isinstance(frames, list):
             for frame in frames:
-                self._queue.put(frame)
+                self._put(frame)
         else:
-            self._queue.put(frames)
+            self._put(frames)
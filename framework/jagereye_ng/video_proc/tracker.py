@@ -0,0 +1,256 @@
+"""Tracking of detected objects between object detections.
+
+An `ObjectTracker` follows the objects detected in a frame sequence, so that
+object detection only needs to run on some of the frames. Detections are
+associated with the tracks by the IoU of their boxes, and the boxes of the
+tracks are propagated to the frames in between, either by the velocities of
+the tracks or by the correlation trackers of OpenCV.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import cv2
+import numpy as np
+
+from jagereye_ng.gpu_worker.detections import DETECTION_DTYPE
+
+
+DEFAULT_MAX_AGE = 30                # frames
+
+# The correlation trackers, which are only available if OpenCV is built with
+# the contrib modules.
+CORRELATION_TRACKERS = {
+    "kcf": "TrackerKCF_create",
+    "csrt": "TrackerCSRT_create"
+}
+
+
+def get_correlation_tracker(name):
+    """Get the function to create a correlation tracker of OpenCV.
+
+    Args:
+        name (string): The name of the tracker, "kcf" or "csrt".
+
+    Returns:
+        The function to create a tracker.
+
+    Raises:
+        ValueError: If the tracker is unknown or not built in OpenCV.
+    """
+    if name not in CORRELATION_TRACKERS:
+        raise ValueError("Unknown correlation tracker: {}".format(name))
+    attr = CORRELATION_TRACKERS[name]
+    for module in (cv2, getattr(cv2, "legacy", None)):
+        create = getattr(module, attr, None)
+        if create is not None:
+            return create
+    raise ValueError("Correlation tracker \"{}\" needs OpenCV with the contrib"
+                     " modules".format(name))
+
+
+def box_iou(boxes1, boxes2):
+    """Compute the IoU of each pair of boxes of two arrays.
+
+    Args:
+        boxes1: An array of shape (N, 4) of boxes, each with format (ymin,
+            xmin, ymax, xmax).
+        boxes2: An array of shape (M, 4) of boxes of the same format.
+
+    Returns:
+        An array of shape (N, M).
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(1, -1, 4)
+    top_left = np.maximum(boxes1[..., :2], boxes2[..., :2])
+    bottom_right = np.minimum(boxes1[..., 2:], boxes2[..., 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=-1)
+    area1 = np.prod(boxes1[..., 2:] - boxes1[..., :2], axis=-1)
+    area2 = np.prod(boxes2[..., 2:] - boxes2[..., :2], axis=-1)
+    union = area1 + area2 - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0.0)
+
+
+class _Track(object):
+    def __init__(self, track_id, detection):
+        self.track_id = track_id
+        self.detection = detection.copy()
+        # The box of the last detection, while the box of `detection` is
+        # propagated to the following frames.
+        self.detected_box = detection["box"].copy()
+        # The change of the box per frame.
+        self.velocity = np.zeros(4, dtype=np.float32)
+        self.frames_since_detection = 0
+        self.missed = 0
+        self.correlation_tracker = None
+
+
+class ObjectTracker(object):
+    """A class used to track detected objects in a frame sequence.
+
+    The frames should be given in order, either with their detections to
+    `update()`, or without to `predict()` to propagate the boxes of the
+    tracks to them.
+
+    Attributes:
+        iou_threshold (float): The minimum IoU of the box of a detection and
+            the box of a track to associate them.
+        max_missed (int): The number of detections in a row that a track may
+            be missing from before it's dropped. The tracks that are missing
+            from the last detection are kept but not reported.
+        correlation (string): The correlation tracker to propagate the boxes
+            with, "kcf", "csrt" or None to propagate them by the velocities
+            of the tracks.
+        max_age (int): The number of frames that a reported track may be
+            propagated without a detection before it's lost.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=1, correlation=None,
+                 max_age=DEFAULT_MAX_AGE):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.correlation = correlation
+        self.max_age = max_age
+        if correlation is not None:
+            self._create_correlation_tracker = get_correlation_tracker(
+                correlation)
+        self._tracks = []
+        self._next_id = 0
+
+    def __len__(self):
+        """The number of reported tracks."""
+        return sum(1 for t in self._tracks if t.missed == 0)
+
+    def reset(self):
+        """Drop all tracks, such as when frames are missing."""
+        self._tracks = []
+
+    def _match(self, detection):
+        """Greedily match the tracks and detections of the highest IoUs.
+
+        Returns:
+            A dict of the index of the matched track of each matched
+            detection.
+        """
+        if not self._tracks or not len(detection):
+            return {}
+        ious = box_iou([t.detection["box"] for t in self._tracks],
+                       detection["box"])
+        # Only objects of the same class are associated.
+        same_class = (np.array([t.detection["class"] for t in self._tracks])
+                      [:, np.newaxis] == detection["class"][np.newaxis, :])
+        ious[~same_class] = 0.0
+        matches = {}
+        matched_tracks = set()
+        for flat in np.argsort(-ious, axis=None):
+            i, j = np.unravel_index(flat, ious.shape)
+            if ious[i, j] < self.iou_threshold:
+                break
+            if i in matched_tracks or j in matches:
+                continue
+            matches[j] = i
+            matched_tracks.add(i)
+        return matches
+
+    def _init_correlation_tracker(self, track, image):
+        height, width = image.shape[:2]
+        ymin, xmin, ymax, xmax = track.detection["box"].tolist()
+        rect = (int(xmin * width), int(ymin * height),
+                max(1, int((xmax - xmin) * width)),
+                max(1, int((ymax - ymin) * height)))
+        track.correlation_tracker = self._create_correlation_tracker()
+        track.correlation_tracker.init(image, rect)
+
+    def update(self, detection, image=None):
+        """Update the tracks with the detections of a frame.
+
+        Args:
+            detection: A structured array of DETECTION_DTYPE of the
+                detections of the frame.
+            image: The image of the frame. It's needed by correlation
+                trackers. Defaults to None.
+
+        Returns:
+            An int array of the track IDs of the detections.
+        """
+        matches = self._match(detection)
+        track_ids = np.empty(len(detection), dtype=np.int64)
+        matched = set(matches.values())
+        tracks = []
+        for i, track in enumerate(self._tracks):
+            if i in matched:
+                continue
+            track.missed += 1
+            if track.missed <= self.max_missed:
+                tracks.append(track)
+        for j in range(len(detection)):
+            if j in matches:
+                track = self._tracks[matches[j]]
+                frames = track.frames_since_detection + 1
+                track.velocity = ((detection[j]["box"] -
+                                   track.detected_box) / frames)
+                track.detection = detection[j].copy()
+                track.detected_box = detection[j]["box"].copy()
+                track.frames_since_detection = 0
+                track.missed = 0
+            else:
+                track = _Track(self._next_id, detection[j])
+                self._next_id += 1
+            if self.correlation is not None and image is not None:
+                self._init_correlation_tracker(track, image)
+            track_ids[j] = track.track_id
+            tracks.append(track)
+        self._tracks = tracks
+        return track_ids
+
+    def predict(self, image=None):
+        """Propagate the tracks to a frame without detections.
+
+        Args:
+            image: The image of the frame. It's needed by correlation
+                trackers. Defaults to None.
+
+        Returns:
+            A tuple (detection, track_ids, lost): the detections of the
+            reported tracks with propagated boxes, their track IDs and
+            whether some track is lost, that is its correlation tracker has
+            lost its object, its box has left the frame or it has not been
+            detected for more than max_age frames. The lost tracks are not
+            reported.
+        """
+        lost = False
+        reported = []
+        for track in self._tracks:
+            track.frames_since_detection += 1
+            box = None
+            if track.correlation_tracker is not None and image is not None:
+                found, rect = track.correlation_tracker.update(image)
+                if found:
+                    height, width = image.shape[:2]
+                    (x, y, w, h) = rect
+                    box = np.array([y / height, x / width,
+                                    (y + h) / height, (x + w) / width],
+                                   dtype=np.float32)
+                else:
+                    # Fall back to the velocity until the next detection.
+                    lost = True
+                    track.correlation_tracker = None
+            if box is None:
+                box = track.detection["box"] + track.velocity
+            track.detection["box"] = np.clip(box, 0.0, 1.0)
+            if track.missed > 0:
+                continue
+            (ymin, xmin, ymax, xmax) = track.detection["box"].tolist()
+            if (ymax <= ymin or xmax <= xmin or
+                    track.frames_since_detection > self.max_age):
+                # Until the next detection, which either confirms or drops
+                # the track.
+                lost = True
+                track.missed = 1
+                continue
+            reported.append(track)
+        detection = np.array([t.detection for t in reported],
+                             dtype=DETECTION_DTYPE)
+        track_ids = np.array([t.track_id for t in reported], dtype=np.int64)
+        return detection, track_ids, lost
@@ -6,51 +6,619 @@ import cv2
 import numpy as np
 
 
-def detect_motion(frames, sensitivity=80):
-    """Detect motion between frames.
+# The radius of the blur kernel of motion detection.
+_BLUR_RADIUS = 2
+# The number of rows between the frames of a stacked image. The seams are
+# refilled before each filter with the border of that filter, so they only
+# need to fit the widest border, the rows that the blur reads below a frame
+# and above the next one.
+_SEAM_ROWS = 2 * _BLUR_RADIUS
+# The maximum number of pixels of a stacked image. Stacking reduces the calls
+# for small images, but bigger stacks fall out of the CPU cache.
+_MAX_STACK_PIXELS = 1 << 20
+
+
+def get_motion_size(image_size, scale=None):
+    """Get the size of the images that motion is detected on.
+
+    Args:
+        image_size (tuple): The size of the analysis images with format
+            (width, height).
+        scale (float): The scale to downsample the images by. Defaults to
+            None, which means no downsampling.
+
+    Returns:
+        The size with format (width, height).
+    """
+    if scale is None:
+        return tuple(image_size)
+    return (max(1, int(round(image_size[0] * scale))),
+            max(1, int(round(image_size[1] * scale))))
+
+
+def create_roi_mask(rois, frame_size, mask_size):
+    """Create a binary mask of regions of interest.
+
+    Args:
+        rois (list): The regions of interest, each a list of points in frame
+            coordinates, such as [(21, 33), (32, 43), ...].
+        frame_size (tuple): The size of the frame that the points are in,
+            with format (width, height).
+        mask_size (tuple): The size of the mask with format (width, height).
+            It should be the size from get_motion_size().
+
+    Returns:
+        A uint8 array of the mask, which is 255 inside the regions and 0
+        outside.
+    """
+    scale = (mask_size[0] / frame_size[0], mask_size[1] / frame_size[1])
+    mask = np.zeros((mask_size[1], mask_size[0]), dtype=np.uint8)
+    polygons = [np.round(np.array(roi, dtype=np.float64) * scale)
+                .astype(np.int32) for roi in rois]
+    cv2.fillPoly(mask, polygons, 255)
+    return mask
+
+
+class RoiMask(object):
+    """A rasterized region of interest to check boxes against in batches.
+
+    The region is rasterized once into cells, and the cells that are surely
+    inside or surely outside the region are summed up in integral images, so
+    checking a box takes a few lookups regardless of the shape of the region.
+    A box that only overlaps the cells near the edges of the region is left
+    undecided, for the caller to check exactly.
+
+    Attributes:
+        frame_size (tuple): The size of the frame that the region is in, with
+            format (width, height).
+    """
+
+    # The result of a box that overlaps the cells near the edges.
+    UNDECIDED = -1
+    # The number of cells from the edges of the rasterized region, within
+    # which the cells may be partly inside the region.
+    _EDGE_CELLS = 2
+    # The fractional bits of the points to rasterize the region with.
+    _SHIFT = 4
+
+    def __init__(self, roi, frame_size, max_side=640):
+        """Initialize a `RoiMask` object.
+
+        Args:
+            roi (list): The points of the region in frame coordinates, such
+                as [(21, 33), (32, 43), ...].
+            frame_size (tuple): The size of the frame with format (width,
+                height).
+            max_side (int): The maximum number of cells on each side of the
+                mask. Defaults to 640.
+        """
+        self.frame_size = tuple(frame_size)
+        width, height = self.frame_size
+        scale = min(1.0, max_side / max(width, height))
+        mask_size = (max(1, int(np.ceil(width * scale))),
+                     max(1, int(np.ceil(height * scale))))
+        self._scale = np.array([mask_size[0] / width,
+                                mask_size[1] / height] * 2)
+        self._mask_size = mask_size
+
+        # The points are at the corners of the cells, while OpenCV puts them
+        # at the centers of the pixels.
+        points = ((np.array(roi, dtype=np.float64) * self._scale[:2] - 0.5) *
+                  (1 << self._SHIFT))
+        points = [np.round(points).astype(np.int32)]
+        mask = np.zeros((mask_size[1], mask_size[0]), dtype=np.uint8)
+        cv2.fillPoly(mask, points, 1, shift=self._SHIFT)
+        kernel = np.ones((2 * self._EDGE_CELLS + 1, 2 * self._EDGE_CELLS + 1),
+                         dtype=np.uint8)
+        inside = cv2.erode(mask, kernel, borderValue=1)
+        # The cells that may be partly inside the region. Only the cells
+        # whose centers are inside are filled, so the outline is drawn too,
+        # for the parts of the region that are thinner than a cell. The
+        # outline is moved into the centers of the border cells, or an edge
+        # along the frame border could be rounded out of the mask.
+        outline = np.clip(points[0],
+                          0,
+                          (np.array(mask_size) - 1) << self._SHIFT)
+        cv2.polylines(mask, [outline], True, 1, shift=self._SHIFT)
+        touched = cv2.dilate(mask, kernel, borderValue=0)
+        self._inside_sum = cv2.integral(inside)
+        self._touched_sum = cv2.integral(touched)
+
+    @staticmethod
+    def _sum(integral, x0, y0, x1, y1):
+        x1 = np.maximum(x0, x1)
+        y1 = np.maximum(y0, y1)
+        return (integral[y1, x1] - integral[y0, x1] -
+                integral[y1, x0] + integral[y0, x0])
+
+    def overlaps(self, boxes):
+        """Check whether boxes overlap the region by a positive area.
+
+        Args:
+            boxes: An array of shape (N, 4) of boxes in frame coordinates,
+                each with format (xmin, ymin, xmax, ymax).
+
+        Returns:
+            An int8 array of shape (N,), which is 1 for the boxes that
+            overlap the region, 0 for the ones that don't and UNDECIDED for
+            the ones that need an exact check.
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        cells = boxes * self._scale
+        limits = np.array(self._mask_size * 2)
+        # The cells that are fully covered by the boxes.
+        inner = np.clip(np.concatenate([np.ceil(cells[:, :2]),
+                                        np.floor(cells[:, 2:])], axis=1),
+                        0, limits).astype(np.intp)
+        # The cells that the boxes overlap by a positive area.
+        outer = np.clip(np.concatenate([np.floor(cells[:, :2]),
+                                        np.ceil(cells[:, 2:])], axis=1),
+                        0, limits).astype(np.intp)
+
+        results = np.full(len(boxes), self.UNDECIDED, dtype=np.int8)
+        results[self._sum(self._touched_sum, *outer.T) == 0] = 0
+        results[self._sum(self._inside_sum, *inner.T) > 0] = 1
+        return results
+
+
+class ZoneIndex(object):
+    """A grid index of several regions of interest of a frame.
+
+    The frame is divided into a coarse grid, and each region is registered
+    in the grid cells that it may touch. A box is only checked against the
+    `RoiMask` of the regions registered in the grid cells that it covers,
+    so adding regions in other parts of the frame costs little.
+
+    Attributes:
+        frame_size (tuple): The size of the frame that the regions are in,
+            with format (width, height).
+        grid_size (int): The number of grid cells on each side.
+    """
+
+    def __init__(self, rois, frame_size, grid_size=16, max_side=640):
+        """Initialize a `ZoneIndex` object.
+
+        Args:
+            rois (list): The regions, each a list of points in frame
+                coordinates, such as [(21, 33), (32, 43), ...].
+            frame_size (tuple): The size of the frame with format (width,
+                height).
+            grid_size (int): The number of grid cells on each side. Defaults
+                to 16.
+            max_side (int): The maximum number of cells on each side of the
+                mask of each region, see `RoiMask`. Defaults to 640.
+        """
+        self.frame_size = tuple(frame_size)
+        self.grid_size = grid_size
+        self._masks = [RoiMask(roi, frame_size, max_side) for roi in rois]
+
+        width, height = self.frame_size
+        self._scale = np.array([grid_size / width, grid_size / height] * 2)
+        xs, ys = np.meshgrid(np.arange(grid_size), np.arange(grid_size))
+        cells = (np.stack([xs, ys, xs + 1, ys + 1], axis=-1).reshape(-1, 4) /
+                 self._scale)
+        # The number of grid cells, up to each cell, that each region may
+        # touch, of shape (regions, grid_size + 1, grid_size + 1).
+        self._grid_sums = np.zeros((len(rois), grid_size + 1, grid_size + 1),
+                                   dtype=np.int32)
+        for i, mask in enumerate(self._masks):
+            touched = (mask.overlaps(cells) != 0).reshape(grid_size,
+                                                          grid_size)
+            self._grid_sums[i, 1:, 1:] = touched.cumsum(0).cumsum(1)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def candidates(self, boxes):
+        """Get the regions that boxes may overlap.
+
+        Args:
+            boxes: An array of shape (N, 4) of boxes in frame coordinates,
+                each with format (xmin, ymin, xmax, ymax).
+
+        Returns:
+            A bool array of shape (N, regions).
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        cells = boxes * self._scale
+        limits = np.array([self.grid_size] * 4)
+        (x0, y0, x1, y1) = np.clip(
+            np.concatenate([np.floor(cells[:, :2]), np.ceil(cells[:, 2:])],
+                           axis=1),
+            0, limits).astype(np.intp).T
+        x1 = np.maximum(x0, x1)
+        y1 = np.maximum(y0, y1)
+        sums = self._grid_sums
+        counts = (sums[:, y1, x1] - sums[:, y0, x1] -
+                  sums[:, y1, x0] + sums[:, y0, x0])
+        return counts.T > 0
+
+    def overlaps(self, boxes, wanted=None):
+        """Check whether boxes overlap each region by a positive area.
+
+        Args:
+            boxes: An array of shape (N, 4) of boxes in frame coordinates,
+                each with format (xmin, ymin, xmax, ymax).
+            wanted: A bool array of shape (N, regions) of the pairs of boxes
+                and regions to check. Defaults to None, which means all
+                pairs. The other pairs are 0 in the results.
+
+        Returns:
+            An int8 array of shape (N, regions), see `RoiMask.overlaps()`.
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        candidates = self.candidates(boxes)
+        if wanted is not None:
+            candidates &= wanted
+        results = np.zeros(candidates.shape, dtype=np.int8)
+        for i, mask in enumerate(self._masks):
+            indexes = np.flatnonzero(candidates[:, i])
+            if len(indexes):
+                results[indexes, i] = mask.overlaps(boxes[indexes])
+        return results
+
+
+def get_motion_crops(regions, padding=0.25, min_size=0.2, max_crops=3,
+                     max_area=0.5):
+    """Get the regions of a frame to run object detection on.
+
+    The motion regions are padded and merged with the ones they overlap.
+    If they are too many or too big, the whole frame is used instead.
+
+    Args:
+        regions (list of tuple): The normalized motion regions of a frame,
+            each with format (xmin, ymin, xmax, ymax).
+        padding (float): The padding around each region, relative to its
+            size. Defaults to 0.25.
+        min_size (float): The minimum normalized width and height of each
+            crop. Defaults to 0.2.
+        max_crops (int): The maximum number of crops. Defaults to 3.
+        max_area (float): The maximum normalized total area of the crops.
+            Defaults to 0.5.
+
+    Returns:
+        A list of normalized crops with format (xmin, ymin, xmax, ymax).
+    """
+    full_frame = [(0.0, 0.0, 1.0, 1.0)]
+    crops = []
+    for (xmin, ymin, xmax, ymax) in regions:
+        pad_x = max((xmax - xmin) * padding, (min_size - (xmax - xmin)) / 2)
+        pad_y = max((ymax - ymin) * padding, (min_size - (ymax - ymin)) / 2)
+        crops.append([max(0.0, xmin - pad_x), max(0.0, ymin - pad_y),
+                      min(1.0, xmax + pad_x), min(1.0, ymax + pad_y)])
+
+    # Merge the overlapping crops until none of them overlap.
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(crops)):
+            for j in range(i + 1, len(crops)):
+                a, b = crops[i], crops[j]
+                if (a[0] < b[2] and b[0] < a[2] and
+                        a[1] < b[3] and b[1] < a[3]):
+                    crops[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                max(a[2], b[2]), max(a[3], b[3])]
+                    del crops[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    area = sum((c[2] - c[0]) * (c[3] - c[1]) for c in crops)
+    if not crops or len(crops) > max_crops or area > max_area:
+        return full_frame
+    return [tuple(c) for c in crops]
+
+
+def _get_regions(changed, origin):
+    """Get the normalized bounding boxes of the changed regions of an image.
+
+    Args:
+        changed (ndarray): The binary image of the changed pixels.
+        origin (tuple): The position of the image in the downsampled frame,
+            and the size of the frame, with format (x, y, width, height).
+
+    Returns:
+        A list of boxes with format (xmin, ymin, xmax, ymax).
+    """
+    x, y, width, height = origin
+    _, _, stats, _ = cv2.connectedComponentsWithStats(changed)
+    # The first component is the background.
+    return [((x + left) / width,
+             (y + top) / height,
+             (x + left + w) / width,
+             (y + top + h) / height)
+            for (left, top, w, h, _) in stats[1:]]
+
+
+def _fill_seams(stacked, height, value=None):
+    """Fill the seam rows of stacked frames with the border of a filter.
+
+    Args:
+        stacked (ndarray): The stacked frames with shape (num, height +
+            _SEAM_ROWS, width).
+        height (int): The height of the frames.
+        value (int): The value to fill the seams with. Defaults to None,
+            which fills them with the rows that BORDER_REFLECT_101 reads
+            below each frame and above the next one.
+    """
+    if value is not None:
+        stacked[:, height:] = value
+        return
+    # The first rows of a seam reflect the frame above, and the last ones
+    # reflect the frame below, which for the last frame is the end of the
+    # stacked image.
+    below = [cv2.borderInterpolate(height + i, height, cv2.BORDER_REFLECT_101)
+             for i in range(_BLUR_RADIUS)]
+    above = [cv2.borderInterpolate(i - _BLUR_RADIUS, height,
+                                   cv2.BORDER_REFLECT_101)
+             for i in range(_BLUR_RADIUS)]
+    stacked[:, height:height + _BLUR_RADIUS] = stacked[:, below]
+    stacked[:-1, height + _BLUR_RADIUS:] = stacked[1:, above]
+
+
+def _count_changed_pixels(images, references, mask=None, origin=None):
+    """Count the changed pixels between gray images and their references.
+
+    The differences are filtered as tall images of stacked frames. The seams
+    between the frames are filled with the border of each filter, so the
+    results are the same as filtering each frame alone.
+
+    Args:
+        images (ndarray): The gray images with shape (num, height, width).
+        references (ndarray): The gray images to compare with, with the same
+            shape as `images`.
+        mask (ndarray): Only count the pixels inside the mask, and ignore the
+            differences outside it. Defaults to None.
+        origin (tuple): The origin from _to_gray(). If given, the changed
+            regions of the images are returned too. Defaults to None.
+
+    Returns:
+        A list of the numbers of changed pixels, one for each image. If
+        `origin` is given, a tuple of the list and a list of the changed
+        regions of each image.
+    """
+    num_diffs, height, width = images.shape
+    pitch = height + _SEAM_ROWS
+    group_size = min(num_diffs,
+                     max(1, _MAX_STACK_PIXELS // (pitch * width)))
+    stacked = np.empty((group_size, pitch, width), dtype=np.uint8)
+    work = np.empty_like(stacked)
+
+    counts = []
+    regions = []
+    ksize = (2 * _BLUR_RADIUS + 1, 2 * _BLUR_RADIUS + 1)
+    for start in range(0, num_diffs, group_size):
+        num = min(group_size, num_diffs - start)
+        for i in range(num):
+            diff = stacked[i, :height]
+            cv2.absdiff(images[start + i], references[start + i], dst=diff)
+            if mask is not None:
+                cv2.bitwise_and(diff, mask, dst=diff)
+        res = stacked[:num].reshape(num * pitch, width)
+        tmp = work[:num].reshape(num * pitch, width)
+        # Remove the noise and do the threshold. The opening and closing are
+        # split into erosions and dilations, which ignore the pixels beyond
+        # the borders of the frames.
+        _fill_seams(stacked[:num], height)
+        cv2.blur(res, ksize, dst=tmp)
+        _fill_seams(work[:num], height, 255)
+        cv2.erode(tmp, None, dst=res)
+        _fill_seams(stacked[:num], height, 0)
+        cv2.dilate(res, None, dst=tmp)
+        _fill_seams(work[:num], height, 0)
+        cv2.dilate(tmp, None, dst=res)
+        _fill_seams(stacked[:num], height, 255)
+        cv2.erode(res, None, dst=tmp)
+        cv2.threshold(tmp, 10, 255, cv2.THRESH_BINARY, dst=tmp)
+        # Count the changed pixels without building a boolean image.
+        for i in range(num):
+            changed = work[i, :height]
+            if mask is not None:
+                cv2.bitwise_and(changed, mask, dst=changed)
+            counts.append(cv2.countNonZero(changed))
+            if origin is not None:
+                regions.append(_get_regions(changed, origin))
+    if origin is not None:
+        return counts, regions
+    return counts
+
+
+def _to_gray(frames, scale=None, roi_mask=None):
+    """Convert the region to detect motion in of frames to gray images.
 
     Args:
         frames: A list of VideoFrame objects.
+        scale (float): The scale to downsample the analysis images by.
+        roi_mask (ndarray): The mask from create_roi_mask().
+
+    Returns:
+        A tuple (gray, mask, area, origin): the stacked gray images of the
+        bounding box of the mask, the mask cropped to the same box, the
+        number of pixels in the mask, and the position of the box with the
+        size of the downsampled images, with format (x, y, width, height).
+        Return None if the mask is empty.
+
+    Raises:
+        ValueError: Raise if the shape of the mask doesn't match the size of
+            the downsampled images.
+    """
+    height, width = frames[0].analysis_image.shape[:2]
+    size = get_motion_size((width, height), scale)
+    # The region to detect motion in, in the coordinates of the downsampled
+    # images.
+    x, y, w, h = 0, 0, size[0], size[1]
+    if roi_mask is not None:
+        if roi_mask.shape != (size[1], size[0]):
+            raise ValueError("The shape of roi mask {} doesn't match the"
+                             " motion size {}".format(roi_mask.shape, size))
+        x, y, w, h = cv2.boundingRect(roi_mask)
+        if w == 0 or h == 0:
+            return None
+        roi_mask = roi_mask[y:y + h, x:x + w]
+        area = cv2.countNonZero(roi_mask)
+    else:
+        area = w * h
+
+    # Only the region is converted and downsampled, in the coordinates of
+    # the analysis images.
+    sx, sy = width / size[0], height / size[1]
+    left, top = int(x * sx), int(y * sy)
+    right = min(width, int(np.ceil((x + w) * sx)))
+    bottom = min(height, int(np.ceil((y + h) * sy)))
+    gray = np.empty((len(frames), h, w), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        region = frame.analysis_image[top:bottom, left:right]
+        if scale is None:
+            cv2.cvtColor(region, cv2.COLOR_BGR2GRAY, dst=gray[i])
+        else:
+            cv2.resize(cv2.cvtColor(region, cv2.COLOR_BGR2GRAY),
+                       (w, h),
+                       dst=gray[i],
+                       interpolation=cv2.INTER_AREA)
+    return gray, roi_mask, area, (x, y, size[0], size[1])
+
+
+def _get_threshold(sensitivity):
+    """Get the percentage of changed pixels that counts as motion."""
+    sensitivity_clamp = max(1, min(sensitivity, 100))
+    return (100 - sensitivity_clamp) * 0.05
+
+
+def detect_motion(frames, sensitivity=80, scale=None, roi_mask=None):
+    """Detect motion between frames.
+
+    Each frame is compared with the previous one. The frames of a batch are
+    converted to grayscale into one stacked array, and the changed pixel
+    ratios of all frames are computed at once.
+
+    Args:
+        frames: A list of VideoFrame objects. The motion is detected on their
+            analysis images.
         sensitivity: The sensitivity of motion detection, range from 1
                      to 100. Defaults to 80.
+        scale (float): The scale to downsample the analysis images by before
+            detecting motion. Defaults to None, which means no downsampling.
+        roi_mask (ndarray): The mask from create_roi_mask(). If given, only
+            motion inside the mask is detected, and the threshold applies to
+            the ratio of changed pixels inside it. Defaults to None.
     Returns:
         A dict with the following keys:
             frames (list): frames that have motion difference against the first
                 frame in the input frames.
             index (list): the index of the detected frames in the input frame
                 list.
+            regions (list): the normalized bounding boxes of the changed
+                regions of each detected frame, with format (xmin, ymin,
+                xmax, ymax). The first frame has the whole frame as region.
     """
-    sensitivity_clamp = max(1, min(sensitivity, 100))
-    threshold = (100 - sensitivity_clamp) * 0.05
+    threshold = _get_threshold(sensitivity)
     num_frames = len(frames)
     if num_frames < 1:
         return []
 
-    results = {"frames": [], "index": []}
-
-    def add_to_results(frame, index):
-        results["frames"].append(frame)
-        results["index"].append(index)
-
-    add_to_results(frames[0], 0)
-    last = cv2.cvtColor(frames[0].image, cv2.COLOR_BGR2GRAY)
-    for i in range(1, num_frames):
-        current = cv2.cvtColor(frames[i].image, cv2.COLOR_BGR2GRAY)
-        res = cv2.absdiff(last, current)
-        # Remove the noise and do the threshold.
-        res = cv2.blur(res, (5, 5))
-        res = cv2.morphologyEx(res, cv2.MORPH_OPEN, None)
-        res = cv2.morphologyEx(res, cv2.MORPH_CLOSE, None)
-        ret, res = cv2.threshold(res, 10, 255, cv2.THRESH_BINARY_INV)  # pylint: disable=unused-variable
-        # Count the number of black pixels.
-        num_black = np.count_nonzero(res == 0)
-        # Calculate the image size.
-        im_size = current.shape[1] * current.shape[0]
-        # Calculate the average of black pixel in the image.
-        avg_black = (num_black * 100.0) / im_size
-        # Detect moving by testing whether the average of black exceeds the
-        # threshold or not.
-        if avg_black >= threshold:
-            add_to_results(frames[i], i)
-        last = current
+    results = {"frames": [frames[0]],
+               "index": [0],
+               "regions": [[(0.0, 0.0, 1.0, 1.0)]]}
+    if num_frames == 1:
+        return results
+
+    converted = _to_gray(frames, scale, roi_mask)
+    if converted is None:
+        return results
+    gray, mask, area, origin = converted
+
+    num_changed, regions = _count_changed_pixels(gray[1:],
+                                                 gray[:-1],
+                                                 mask,
+                                                 origin)
+    num_changed = np.array(num_changed)
+    # Calculate the percentage of changed pixels of each frame, and detect
+    # moving by testing whether it exceeds the threshold or not.
+    changed_ratio = num_changed * 100.0 / area
+    for i in np.flatnonzero(changed_ratio >= threshold):
+        results["frames"].append(frames[i + 1])
+        results["index"].append(int(i + 1))
+        results["regions"].append(regions[i])
     return results
+
+
+class MotionDetector(object):
+    """A class used to detect motion against a running background model.
+
+    Unlike detect_motion(), the background is kept across batches, so a
+    static scene has no motion at all, and an object that stops moving is
+    still detected until it fades into the background.
+
+    Attributes:
+        sensitivity (int): The sensitivity of motion detection, range from 1
+            to 100.
+        scale (float): The scale to downsample the analysis images by.
+        roi_mask (ndarray): The mask from create_roi_mask(), or None to
+            detect motion in the whole frames.
+        learning_rate (float): The weight of each frame in the running
+            average of the background, range from 0 to 1.
+    """
+
+    def __init__(self, sensitivity=80, scale=None, roi_mask=None,
+                 learning_rate=0.02):
+        self.sensitivity = sensitivity
+        self.scale = scale
+        self.roi_mask = roi_mask
+        self.learning_rate = learning_rate
+        self._background = None
+
+    def reset(self):
+        """Forget the background, the next frame becomes the background."""
+        self._background = None
+
+    def detect(self, frames):
+        """Detect motion in frames and update the background with them.
+
+        Args:
+            frames: A list of VideoFrame objects. The motion is detected on
+                their analysis images.
+
+        Returns:
+            A dict with the following keys:
+                frames (list): frames that differ from the background.
+                index (list): the index of the detected frames in the input
+                    frame list.
+                regions (list): the normalized bounding boxes of the changed
+                    regions of each detected frame, with format (xmin, ymin,
+                    xmax, ymax).
+        """
+        results = {"frames": [], "index": [], "regions": []}
+        if len(frames) < 1:
+            return results
+        converted = _to_gray(frames, self.scale, self.roi_mask)
+        if converted is None:
+            return results
+        gray, mask, area, origin = converted
+
+        # The background before each frame is its reference.
+        references = np.empty_like(gray)
+        changed = np.ones(len(frames), dtype=bool)
+        for i, frame in enumerate(frames):
+            if (self._background is None or frame.after_gap or
+                    self._background.shape != gray[i].shape):
+                # Start over after the source is reconnected or resized.
+                self._background = gray[i].astype(np.float32)
+                changed[i] = False
+            cv2.convertScaleAbs(self._background, dst=references[i])
+            cv2.accumulateWeighted(gray[i],
+                                   self._background,
+                                   self.learning_rate)
+
+        num_changed, regions = _count_changed_pixels(gray,
+                                                     references,
+                                                     mask,
+                                                     origin)
+        num_changed = np.array(num_changed)
+        changed_ratio = num_changed * 100.0 / area
+        changed &= changed_ratio >= _get_threshold(self.sensitivity)
+        for i in np.flatnonzero(changed):
+            results["frames"].append(frames[i])
+            results["index"].append(int(i))
+            results["regions"].append(regions[i])
+        return results
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+from concurrent import futures
+
+import pytest
+
+from jagereye_ng.gpu_worker.batcher import DynamicBatcher
+
+
+class FakeModel(object):
+    """A model that doubles frames, and blocks on the first batch."""
+
+    def __init__(self, block_first=False):
+        self.batches = []
+        self.unblocked = threading.Event()
+        if not block_first:
+            self.unblocked.set()
+
+    def run(self, frames):
+        self.batches.append(list(frames))
+        self.unblocked.wait()
+        if "bad" in frames:
+            raise ValueError("Bad frame")
+        return [frame * 2 for frame in frames]
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def executor():
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        yield executor
+
+
+def test_flush_when_batch_is_full(executor):
+    model = FakeModel(block_first=True)
+    batcher = DynamicBatcher(model, max_batch_size=4, max_wait=10)
+    # A full batch doesn't wait for more requests.
+    first = executor.submit(batcher.run, [0, 0, 0, 1])
+    wait_until(lambda: len(model.batches) == 1)
+    # The requests queue up while the first batch is running.
+    requests = []
+    for frames in ([2, 3], [4, 5], [6, 7, 8, 9, 10]):
+        requests.append(executor.submit(batcher.run, frames))
+        wait_until(lambda: len(batcher._queue) == len(requests))
+    start = time.time()
+    model.unblocked.set()
+    assert first.result(5) == [0, 0, 0, 2]
+    assert requests[0].result(5) == [4, 6]
+    assert requests[1].result(5) == [8, 10]
+    # A request bigger than the batch size is run by itself.
+    assert requests[2].result(5) == [12, 14, 16, 18, 20]
+    assert time.time() - start < 5
+    assert model.batches == [[0, 0, 0, 1], [2, 3, 4, 5], [6, 7, 8, 9, 10]]
+
+    metrics = batcher.get_metrics()
+    assert metrics["num_batches"] == 3
+    assert metrics["avg_batch_size"] == pytest.approx(13 / 3)
+    assert metrics["avg_batch_requests"] == pytest.approx(4 / 3)
+    assert metrics["queue_depth"] == 0
+    batcher.stop()
+
+
+def test_flush_when_wait_times_out():
+    model = FakeModel()
+    batcher = DynamicBatcher(model, max_batch_size=16, max_wait=0.1)
+    start = time.time()
+    assert batcher.run([1, 2]) == [2, 4]
+    assert time.time() - start >= 0.09
+    metrics = batcher.get_metrics()
+    assert metrics["num_batches"] == 1
+    assert metrics["avg_queueing_delay"] >= 0.09
+    assert metrics["max_queueing_delay"] >= 0.09
+    batcher.stop()
+
+
+def test_errors_are_raised_to_requests_of_batch(executor):
+    model = FakeModel(block_first=True)
+    batcher = DynamicBatcher(model, max_batch_size=4, max_wait=10)
+    first = executor.submit(batcher.run, [0, 0, 0, 1])
+    wait_until(lambda: len(model.batches) == 1)
+    good = executor.submit(batcher.run, [2])
+    wait_until(lambda: len(batcher._queue) == 1)
+    bad = executor.submit(batcher.run, ["bad", 3, 4])
+    wait_until(lambda: len(batcher._queue) == 2)
+    model.unblocked.set()
+    assert first.result(5) == [0, 0, 0, 2]
+    with pytest.raises(ValueError):
+        good.result(5)
+    with pytest.raises(ValueError):
+        bad.result(5)
+    # The batcher keeps serving after a failed batch.
+    assert batcher.run([5, 6, 7, 8]) == [10, 12, 14, 16]
+    batcher.stop()
+
+
+def test_stopped_batcher_refuses_requests():
+    batcher = DynamicBatcher(FakeModel())
+    assert batcher.run([]) == []
+    batcher.stop()
+    with pytest.raises(RuntimeError):
+        batcher.run([1])
@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from jagereye_ng.gpu_worker import cache
+from jagereye_ng.gpu_worker.cache import ResultCache, image_hash
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    return clock
+
+
+def flip_bits(hash_value, bits):
+    for bit in bits:
+        hash_value ^= 1 << int(bit)
+    return hash_value
+
+
+def test_image_hash_ignores_noise_and_brightness():
+    rng = np.random.RandomState(0)
+    image = np.zeros((120, 160, 3), dtype=np.uint8)
+    image[20:80, 30:90] = 200
+    image[60:100, 100:150] = 120
+    noisy = np.clip(image.astype(np.int16) + rng.randint(-3, 4, image.shape)
+                    + 20, 0, 255).astype(np.uint8)
+    distance = bin(image_hash(image) ^ image_hash(noisy)).count("1")
+    assert distance <= cache.DEFAULT_TOLERANCE
+    moved = np.roll(image, 40, axis=1)
+    distance = bin(image_hash(image) ^ image_hash(moved)).count("1")
+    assert distance > cache.DEFAULT_TOLERANCE
+
+
+def test_get_within_tolerance(clock):
+    c = ResultCache(tolerance=2)
+    c.put("a", 0b1111, "r1")
+    assert c.get("a", 0b1111) == "r1"
+    assert c.get("a", 0b1100) == "r1"
+    assert c.get("a", 0b1000) is None
+    # The groups don't share results.
+    assert c.get("b", 0b1111) is None
+    # The closest hash wins.
+    c.put("a", 0b0000, "r2")
+    assert c.get("a", 0b0001) == "r2"
+    assert c.get("a", 0b0111) == "r1"
+
+
+def test_entries_expire_after_ttl(clock):
+    c = ResultCache()
+    c.put("a", 1, "r1", ttl=2.0)
+    c.put("b", 1, "r2", ttl=10.0)
+    clock.now += 2.0
+    assert c.get("a", 1) is None
+    assert c.get("b", 1) == "r2"
+    metrics = c.get_metrics()
+    assert metrics["expirations"] == 1
+    assert metrics["size"] == 1
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    c = ResultCache(max_entries=2, tolerance=0)
+    c.put("a", 1, "r1")
+    c.put("a", 2, "r2")
+    assert c.get("a", 1) == "r1"
+    c.put("a", 3, "r3")
+    assert c.get("a", 2) is None
+    assert c.get("a", 1) == "r1"
+    assert c.get("a", 3) == "r3"
+    assert c.get_metrics()["evictions"] == 1
+
+
+def test_metrics(clock):
+    c = ResultCache()
+    c.put("a", 1, "r1")
+    c.get("a", 1)
+    c.get("a", 1)
+    c.get("a", (1 << 64) - 2)
+    c.get("b", 1)
+    metrics = c.get_metrics()
+    assert metrics["hits"] == 2 and metrics["misses"] == 2
+    assert metrics["hit_rate"] == pytest.approx(0.5)
+    assert metrics["size"] == 1
+
+
+@pytest.mark.parametrize("tolerance", [0, 1, 4, 9])
+def test_indexed_lookup_equals_brute_force(clock, tolerance):
+    rng = np.random.RandomState(tolerance)
+    num_bits = cache.DEFAULT_HASH_SIZE ** 2
+    c = ResultCache(max_entries=10000, tolerance=tolerance)
+    bases = [int(rng.randint(0, 2 ** 62)) << int(rng.randint(0, 190))
+             for _ in range(20)]
+    stored = {}
+    for i in range(300):
+        base = bases[i % len(bases)]
+        h = flip_bits(base, rng.randint(0, num_bits, rng.randint(0, 12)))
+        c.put("a", h, h)
+        stored[h] = h
+    for _ in range(500):
+        base = bases[rng.randint(len(bases))]
+        query = flip_bits(base, rng.randint(0, num_bits, rng.randint(0, 12)))
+        distances = [bin(h ^ query).count("1") for h in stored]
+        result = c.get("a", query)
+        if min(distances) > tolerance:
+            assert result is None
+        else:
+            assert bin(result ^ query).count("1") == min(distances)
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+import pytest
+
+from jagereye_ng.io import encoder_pool
+from jagereye_ng.io.encoder_pool import EncoderPool
+
+
+class FakeWriter(object):
+    """A video writer that blocks on writing until it's unblocked."""
+
+    def __init__(self, unblocked):
+        self.unblocked = unblocked
+        self.frames = []
+
+    def write(self, image):
+        self.unblocked.wait()
+        self.frames.append(image)
+
+    def release(self):
+        pass
+
+
+class FakeFrame(object):
+
+    def __init__(self, image):
+        self.image = image
+
+
+@pytest.fixture
+def unblocked(monkeypatch):
+    unblocked = threading.Event()
+    unblocked.set()
+
+    def fake_open(self, job):
+        job.writer = FakeWriter(unblocked)
+
+    monkeypatch.setattr(encoder_pool.os, "cpu_count", lambda: 2)
+    monkeypatch.setattr(encoder_pool.EncoderThread, "_open", fake_open)
+    yield unblocked
+    unblocked.set()
+
+
+def test_num_encoders_is_capped_at_cores(unblocked):
+    pool = EncoderPool(num_encoders=8)
+    assert len(pool.get_metrics()["encoders"]) == 2
+    pool.shutdown()
+
+
+def test_open_picks_least_loaded_encoder(unblocked):
+    pool = EncoderPool()
+    job1 = pool.open("1.mp4", 15, (4, 4))
+    job2 = pool.open("2.mp4", 15, (4, 4))
+    assert job1._encoder is not job2._encoder
+
+    # The encoder with fewer queued frames wins a tie in active jobs.
+    unblocked.clear()
+    job1.write([FakeFrame(i) for i in range(3)])
+    job3 = pool.open("3.mp4", 15, (4, 4))
+    assert job3._encoder is job2._encoder
+    metrics = pool.get_metrics()
+    assert metrics["active_jobs"] == 3
+    assert sorted(e["active_jobs"] for e in metrics["encoders"]) == [1, 2]
+    assert metrics["queue_depth"] >= 2
+
+    # The encoder with fewer active jobs wins.
+    unblocked.set()
+    job2.end()
+    job3.end()
+    assert job2.wait(5) and job3.wait(5)
+    job4 = pool.open("4.mp4", 15, (4, 4))
+    assert job4._encoder is job2._encoder
+
+    job1.end()
+    job4.end()
+    assert job1.wait(5) and job4.wait(5)
+    assert job1.writer is None and job1.exception is None
+    assert pool.get_metrics()["active_jobs"] == 0
+    pool.shutdown()
+
+
+def test_failed_job_skips_its_frames(unblocked, monkeypatch):
+    def failed_open(self, job):
+        raise RuntimeError("Cannot open {}".format(job.filename))
+
+    monkeypatch.setattr(encoder_pool.EncoderThread, "_open", failed_open)
+    pool = EncoderPool(num_encoders=1)
+    ended = []
+    job = pool.open("1.mp4", 15, (4, 4))
+    job.write(FakeFrame(0))
+    job.end(ended.append)
+    assert job.wait(5)
+    assert isinstance(job.exception, RuntimeError)
+    assert ended == [job]
+    assert pool.get_metrics()["active_jobs"] == 0
+    pool.shutdown()
@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import pytest
+
+from jagereye_ng.gpu_worker.registry import ModelRegistry
+
+
+# The size, in bytes, of the model files, 2 of them fit in a budget of 1 MB.
+MODEL_SIZE = 400 * 1024
+
+
+class FakeModelPath(object):
+    """The model files of each version, written into a directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, name, version):
+        path = self.root / "{}-{}.pb".format(name, version)
+        if not path.exists():
+            path.write_bytes(b"0" * MODEL_SIZE)
+        return str(path)
+
+
+class FakeModel(object):
+
+    loaded = []
+
+    def __init__(self, path, version, **kwargs):
+        self.version = version
+        self.kwargs = kwargs
+        self.released = False
+
+    def load(self):
+        if self.version == "bad":
+            raise IOError("Corrupted model")
+        FakeModel.loaded.append(self)
+
+    def run(self, frames):
+        return [self.version for _ in frames]
+
+    def release(self):
+        self.released = True
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeModel, "loaded", [])
+    registry = ModelRegistry(FakeModelPath(tmp_path),
+                             {"a": FakeModel, "b": FakeModel},
+                             {"a": "2", "b": "1"},
+                             memory_budget=1,
+                             max_wait=0.01,
+                             model_options={"device": "cpu"})
+    yield registry
+    registry.release()
+
+
+def loaded_keys(registry):
+    return sorted(registry.get_metrics())
+
+
+def test_versions_are_pinned(registry):
+    assert registry.get_version("a") == "2"
+    assert registry.get_version("a", "1") == "1"
+    with registry.use("a") as batcher:
+        assert batcher.run([0]) == ["2"]
+    with registry.use("a", "1") as batcher:
+        assert batcher.run([0]) == ["1"]
+    assert loaded_keys(registry) == ["a/1", "a/2"]
+    assert FakeModel.loaded[0].kwargs == {"device": "cpu"}
+    with pytest.raises(KeyError):
+        registry.get_version("c")
+
+
+def test_least_recently_used_model_is_unloaded(registry):
+    registry.preload("a")
+    registry.preload("b")
+    # Using a model makes it the most recently used one.
+    registry.preload("a")
+    model_a, model_b = FakeModel.loaded
+    registry.preload("a", "1")
+    assert loaded_keys(registry) == ["a/1", "a/2"]
+    wait_until(lambda: model_b.released)
+    assert not model_a.released
+    # The unloaded model is loaded again on its next use.
+    with registry.use("b") as batcher:
+        assert batcher.run([0]) == ["1"]
+    assert len(FakeModel.loaded) == 4
+
+
+def test_models_in_use_are_not_unloaded(registry):
+    with registry.use("a"), registry.use("b"):
+        # The budget is exceeded while all loaded models are in use.
+        registry.preload("a", "1")
+        assert loaded_keys(registry) == ["a/1", "a/2", "b/1"]
+    registry.preload("b")
+    registry.preload("a", "3")
+    assert loaded_keys(registry) == ["a/3", "b/1"]
+
+
+def test_failed_model_is_not_kept(registry):
+    with pytest.raises(IOError):
+        registry.preload("a", "bad")
+    assert loaded_keys(registry) == []
+    with pytest.raises(IOError):
+        registry.preload("a", "bad")
@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import pytest
+
+from jagereye_ng.io import shared_frames
+from jagereye_ng.io.shared_frames import SharedFrameRing
+from jagereye_ng.io.streaming import VideoFrame
+
+
+@pytest.fixture
+def shm_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_frames, "SHM_DIR", str(tmp_path))
+    monkeypatch.setattr(shared_frames, "_attached_segments",
+                        shared_frames.OrderedDict())
+    return tmp_path
+
+
+def make_frames(num, size=(4, 3)):
+    return [VideoFrame(np.full((size[1], size[0], 3), i, dtype=np.uint8),
+                       float(i))
+            for i in range(num)]
+
+
+def test_put_frames_and_resolve(shm_dir):
+    ring = SharedFrameRing(capacity=4, name_prefix="test")
+    refs = ring.put_frames(make_frames(3))
+    assert len(set(ref.segment for ref in refs)) == 1
+    assert refs[0].segment.startswith("jagereye-test-{}-".format(os.getpid()))
+    frames = shared_frames.resolve(refs)
+    assert [int(f.image[0, 0, 0]) for f in frames] == [0, 1, 2]
+    assert [f.timestamp for f in frames] == [0.0, 1.0, 2.0]
+    ring.close()
+    assert os.listdir(str(shm_dir)) == []
+
+
+def test_removed_segments_are_unmapped(shm_dir):
+    ring = SharedFrameRing(capacity=4)
+    old = ring.put_frames(make_frames(1))
+    shared_frames.resolve(old)
+    # Bigger frames start a new segment and remove the old one.
+    new = ring.put_frames(make_frames(1, size=(8, 6)))
+    shared_frames.resolve(new)
+    assert list(shared_frames._attached_segments) == [new[0].segment]
+    ring.close()
+
+
+def test_close_rings(shm_dir):
+    rings = [SharedFrameRing(capacity=2) for _ in range(2)]
+    for ring in rings:
+        ring.put_frames(make_frames(1))
+    assert len(os.listdir(str(shm_dir))) == 2
+    shared_frames.close_rings()
+    assert os.listdir(str(shm_dir)) == []
+
+
+def test_remove_stale_segments(shm_dir, monkeypatch):
+    dead_pid = 999999
+    monkeypatch.setattr(shared_frames, "_is_process_alive",
+                        lambda pid: pid != dead_pid)
+    names = ["jagereye-frames-{}-abc".format(dead_pid),
+             "jagereye-intrusion_detection-{}-abc".format(dead_pid),
+             "jagereye-frames-{}-abc".format(os.getpid()),
+             "jagereye-unknown",
+             "other-frames-{}-abc".format(dead_pid)]
+    for name in names:
+        (shm_dir / name).write_bytes(b"0")
+    assert shared_frames.remove_stale_segments() == 2
+    assert sorted(os.listdir(str(shm_dir))) == sorted(names[2:])
@@ -0,0 +1,271 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from jagereye_ng.io import streaming
+from jagereye_ng.io.streaming import ConnectionError, EndOfVideoError
+from jagereye_ng.io.streaming import FrameRingBuffer, StreamMultiplexer
+from jagereye_ng.io.streaming import VideoFrame, VideoStreamReader
+from jagereye_ng.io.streaming import VideoStreamWriter
+
+
+class FakeCapture(object):
+    """A capture whose reads of "stalled" sources block until unblocked."""
+
+    unblocked = None
+
+    def __init__(self):
+        self.src = None
+        self.released = False
+
+    def get(self, prop):
+        return 10.0
+
+    def read(self):
+        if self.src == "stalled":
+            self.unblocked.wait()
+        return True, np.zeros((2, 3, 3), dtype=np.uint8)
+
+    def release(self):
+        self.released = True
+
+
+class FakeVideoWriter(object):
+    """A video writer that blocks on writing until it's unblocked."""
+
+    unblocked = None
+
+    def __init__(self):
+        self.images = []
+
+    def isOpened(self):
+        return False
+
+    def open(self, filename, fourcc, fps, size):
+        return True
+
+    def write(self, image):
+        self.unblocked.wait()
+        if image == "bad":
+            raise IOError("Can't write frame")
+        self.images.append(image)
+
+    def release(self):
+        pass
+
+
+def make_video(path, num_frames, fps=10, size=(32, 24)):
+    """Make a video whose frame brightness is 8 times the frame index."""
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), fps,
+                             size)
+    if not writer.isOpened():
+        pytest.skip("OpenCV can't write MJPG videos")
+    for i in range(num_frames):
+        writer.write(np.full((size[1], size[0], 3), i * 8, dtype=np.uint8))
+    writer.release()
+    return str(path)
+
+
+def write_frame(ring, value, timestamp=None):
+    """Write a frame filled with a value into a ring buffer."""
+    slot, image = ring.acquire()
+    image[:] = value
+    ring.commit(slot, value if timestamp is None else timestamp)
+    return slot
+
+
+def read_values(ring, batch_size):
+    return [int(frame.image[0, 0, 0]) for frame in ring.read(batch_size)]
+
+
+def read_all(reader):
+    """Read all frames as tuples of (timestamp, frame index)."""
+    frames = []
+    try:
+        while True:
+            frames += [(round(f.timestamp, 3), int(round(f.image.mean() / 8)))
+                       for f in reader.read(batch_size=1, timeout=5)]
+    except EndOfVideoError:
+        pass
+    finally:
+        reader.release()
+    return frames
+
+
+@pytest.mark.parametrize("decimate", [False, True])
+def test_offline_reads_every_frame(tmp_path, decimate):
+    src = make_video(tmp_path / "video.avi", 30)
+    reader = VideoStreamReader()
+    reader.open(src, fps=10, decimate=decimate, offline=True,
+                start_time=100.0)
+    frames = read_all(reader)
+    assert [i for _, i in frames] == list(range(30))
+    assert frames[0][0] == 100.0 and frames[-1][0] == 102.9
+
+
+@pytest.mark.parametrize("decimate", [False, True])
+def test_offline_stops_at_end_pos(tmp_path, decimate):
+    src = make_video(tmp_path / "video.avi", 30)
+    reader = VideoStreamReader()
+    reader.open(src, fps=10, decimate=decimate, offline=True,
+                start_time=100.0, start_pos=1.0, end_pos=2.0)
+    frames = read_all(reader)
+    assert [i for _, i in frames] == list(range(10, 20))
+    assert frames[0][0] == 101.0
+
+
+def test_ring_buffer_wraps_around():
+    ring = FrameRingBuffer(4, (3, 2))
+    slots = []
+    for value in range(10):
+        slots.append(write_frame(ring, value))
+        batch = ring.read(1)
+        assert len(batch) == 1
+        assert batch[0].timestamp == value
+        assert int(batch.images[0][0, 0, 0]) == value
+    # The slots are recycled instead of allocating new frames.
+    assert set(slots) <= set(range(4))
+    assert ring.images.shape == (4, 2, 3, 3)
+
+
+def test_ring_buffer_drops_oldest_frame():
+    ring = FrameRingBuffer(4, (3, 2))
+    for value in range(6):
+        write_frame(ring, value)
+    assert len(ring) == 4
+    assert not ring.has_free_slot()
+    assert read_values(ring, 2) == [2, 3]
+    # The leased slots are not taken back until the next read.
+    write_frame(ring, 6)
+    write_frame(ring, 7)
+    assert read_values(ring, 2) == [6, 7]
+    assert read_values(ring, 2) == []
+
+
+def test_ring_buffer_reuses_frames_of_slots():
+    ring = FrameRingBuffer(4, (3, 2), analysis_size=(2, 1))
+    write_frame(ring, 1, timestamp=10.0)
+    frame = ring.read(1)[0]
+    assert frame.leased and frame.analysis_image.shape == (1, 2, 3)
+    detached = frame.detach()
+    assert not detached.leased
+    for value in range(2, 6):
+        write_frame(ring, value)
+        batch = ring.read(1)
+    # The frame of the slot is overwritten, but the detached one isn't.
+    assert batch[0] is frame
+    assert frame.timestamp == 5.0 and int(frame.image[0, 0, 0]) == 5
+    assert detached.timestamp == 10.0 and int(detached.image[0, 0, 0]) == 1
+
+
+@pytest.fixture
+def unblocked(monkeypatch):
+    unblocked = threading.Event()
+
+    def fake_open_capture(reader, src, timeout):
+        reader.src = src
+        return np.zeros((2, 3, 3), dtype=np.uint8)
+
+    monkeypatch.setattr(FakeCapture, "unblocked", unblocked)
+    monkeypatch.setattr(streaming.cv2, "VideoCapture", FakeCapture)
+    monkeypatch.setattr(streaming, "_open_capture", fake_open_capture)
+    monkeypatch.setattr(streaming, "MUX_RELEASE_TIMEOUT", 0.2)
+    yield unblocked
+    unblocked.set()
+
+
+def test_multiplexer_stops_stalled_sources(unblocked):
+    mux = StreamMultiplexer(num_workers=1, read_timeout=0.2)
+    mux.start()
+    stalled = mux.add_source("1", "stalled", fps=100)
+    with pytest.raises(ConnectionError):
+        stalled.read(timeout=5)
+    # A new thread takes the place of the blocked one.
+    healthy = mux.add_source("2", "healthy", fps=100)
+    assert len(healthy.read(batch_size=3, timeout=5)) == 3
+
+    start = time.time()
+    mux.release()
+    assert time.time() - start < 1
+    assert healthy._reader.released
+    # The stalled source is released when its read returns.
+    assert not stalled._reader.released
+    unblocked.set()
+    deadline = time.time() + 5
+    while not stalled._reader.released:
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def writer_unblocked(monkeypatch):
+    unblocked = threading.Event()
+    monkeypatch.setattr(FakeVideoWriter, "unblocked", unblocked)
+    monkeypatch.setattr(streaming.cv2, "VideoWriter", FakeVideoWriter)
+    monkeypatch.setattr(streaming, "WRITER_PUT_TIMEOUT", 0.01)
+    yield unblocked
+    unblocked.set()
+
+
+def open_blocked_writer(overflow):
+    """Open a writer whose thread is blocked on writing frame 0."""
+    writer = VideoStreamWriter(queue_size=2, overflow=overflow)
+    writer.open("video.avi", 10, (4, 4))
+    writer.write(VideoFrame(0, 0.0))
+    deadline = time.time() + 5
+    while not writer._queue.empty():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.001)
+    return writer
+
+
+@pytest.mark.parametrize("overflow,written", [
+    (VideoStreamWriter.OVERFLOW_DROP_OLDEST, [0, 3, 4]),
+    (VideoStreamWriter.OVERFLOW_DROP_NEWEST, [0, 1, 2]),
+])
+def test_writer_drops_frames_on_overflow(writer_unblocked, overflow,
+                                         written):
+    writer = open_blocked_writer(overflow)
+    writer.write([VideoFrame(i, float(i)) for i in range(1, 5)])
+    assert writer.num_dropped == 2
+    writer_unblocked.set()
+    writer.end()
+    assert writer._writer.images == written
+
+
+def test_writer_blocks_on_overflow(writer_unblocked):
+    writer = open_blocked_writer(VideoStreamWriter.OVERFLOW_BLOCK)
+    frames = [VideoFrame(i, float(i)) for i in range(1, 5)]
+    thread = threading.Thread(target=writer.write, args=(frames,))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+    writer_unblocked.set()
+    thread.join(5)
+    writer.end()
+    assert writer._writer.images == [0, 1, 2, 3, 4]
+    assert writer.num_dropped == 0
+
+
+def test_blocked_writes_are_dropped_when_writer_thread_dies(
+        writer_unblocked):
+    writer = VideoStreamWriter(queue_size=1)
+    writer.open("video.avi", 10, (4, 4))
+    writer_unblocked.set()
+    writer.write(VideoFrame("bad", 0.0))
+    writer._thread.join(5)
+    writer.write([VideoFrame(i, float(i)) for i in range(3)])
+    assert writer.num_dropped == 2
+    writer.end()
+
+
+def test_writer_rejects_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        VideoStreamWriter(overflow="drop_all")
@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from jagereye_ng.gpu_worker.detections import DETECTION_DTYPE
+from jagereye_ng.video_proc import tracker
+from jagereye_ng.video_proc.tracker import ObjectTracker, box_iou
+
+
+def make_detection(*items):
+    """Make detections from tuples of (box, score, class)."""
+    detection = np.empty(len(items), dtype=DETECTION_DTYPE)
+    for i, item in enumerate(items):
+        detection[i] = item
+    return detection
+
+
+class FakeCorrelationTracker(object):
+    """A correlation tracker that finds its object in the first frames."""
+
+    def __init__(self, frames_found=1):
+        self.frames_found = frames_found
+
+    def init(self, image, rect):
+        self.rect = rect
+
+    def update(self, image):
+        self.frames_found -= 1
+        return (self.frames_found >= 0, self.rect)
+
+
+def test_box_iou():
+    boxes1 = [(0.0, 0.0, 0.5, 0.5), (0.0, 0.0, 0.0, 0.0)]
+    boxes2 = [(0.0, 0.0, 0.5, 0.5), (0.25, 0.0, 0.75, 0.5),
+              (0.5, 0.5, 1.0, 1.0)]
+    np.testing.assert_allclose(box_iou(boxes1, boxes2),
+                               [[1.0, 1.0 / 3.0, 0.0], [0.0, 0.0, 0.0]])
+    assert box_iou(np.zeros((0, 4)), boxes2).shape == (0, 3)
+
+
+def test_update_keeps_ids_of_matched_detections():
+    t = ObjectTracker()
+    ids = t.update(make_detection(((0.1, 0.1, 0.3, 0.2), 0.9, 1),
+                                  ((0.5, 0.5, 0.7, 0.6), 0.8, 1)))
+    assert ids.tolist() == [0, 1]
+    # The second object changes its class, so it's a new track.
+    ids = t.update(make_detection(((0.5, 0.5, 0.7, 0.6), 0.8, 3),
+                                  ((0.1, 0.12, 0.3, 0.22), 0.9, 1)))
+    assert ids.tolist() == [2, 0]
+    assert len(t) == 2
+
+
+def test_update_drops_missing_tracks():
+    t = ObjectTracker(max_missed=1)
+    t.update(make_detection(((0.1, 0.1, 0.3, 0.2), 0.9, 1)))
+    t.update(make_detection())
+    # Missing tracks are kept but not reported.
+    assert len(t) == 0
+    detection, track_ids, lost = t.predict()
+    assert len(detection) == 0 and len(track_ids) == 0 and not lost
+    ids = t.update(make_detection(((0.1, 0.1, 0.3, 0.2), 0.9, 1)))
+    assert ids.tolist() == [0]
+    t.update(make_detection())
+    t.update(make_detection())
+    ids = t.update(make_detection(((0.1, 0.1, 0.3, 0.2), 0.9, 1)))
+    assert ids.tolist() == [1]
+
+
+def test_predict_propagates_boxes_by_velocity():
+    t = ObjectTracker()
+    t.update(make_detection(((0.1, 0.1, 0.3, 0.2), 0.9, 1)))
+    t.predict()
+    t.update(make_detection(((0.1, 0.14, 0.3, 0.24), 0.9, 1)))
+    detection, track_ids, lost = t.predict()
+    assert track_ids.tolist() == [0] and not lost
+    np.testing.assert_allclose(detection["box"][0], (0.1, 0.16, 0.3, 0.26),
+                               atol=1e-6)
+
+
+def test_predict_loses_tracks_that_leave_the_frame():
+    t = ObjectTracker(iou_threshold=0.2)
+    t.update(make_detection(((0.1, 0.6, 0.3, 0.9), 0.9, 1)))
+    t.update(make_detection(((0.1, 0.8, 0.3, 1.0), 0.9, 1)))
+    # The box is clipped to the frame border and has no area left.
+    detection, track_ids, lost = t.predict()
+    assert lost
+    assert len(detection) == 0 and len(track_ids) == 0
+    assert len(t) == 0
+    # The next detection confirms or drops the lost track.
+    assert t.update(make_detection()).tolist() == []
+    assert len(t._tracks) == 0
+
+
+def test_predict_loses_tracks_without_detections():
+    t = ObjectTracker(max_age=3)
+    t.update(make_detection(((0.1, 0.1, 0.3, 0.2), 0.9, 1)))
+    for _ in range(3):
+        detection, track_ids, lost = t.predict()
+        assert track_ids.tolist() == [0] and not lost
+    detection, track_ids, lost = t.predict()
+    assert lost and len(track_ids) == 0
+    # The track is confirmed by a detection.
+    ids = t.update(make_detection(((0.1, 0.1, 0.3, 0.2), 0.9, 1)))
+    assert ids.tolist() == [0]
+    assert len(t) == 1
+
+
+def test_predict_with_correlation_tracker(monkeypatch):
+    monkeypatch.setattr(tracker, "get_correlation_tracker",
+                        lambda name: FakeCorrelationTracker)
+    image = np.zeros((100, 200, 3), dtype=np.uint8)
+    t = ObjectTracker(correlation="kcf")
+    t.update(make_detection(((0.1, 0.1, 0.3, 0.2), 0.9, 1)), image)
+    detection, track_ids, lost = t.predict(image)
+    assert track_ids.tolist() == [0] and not lost
+    np.testing.assert_allclose(detection["box"][0], (0.1, 0.1, 0.3, 0.2),
+                               atol=1e-6)
+    # The correlation tracker loses the object.
+    detection, track_ids, lost = t.predict(image)
+    assert lost and track_ids.tolist() == [0]
+
+
+def test_unknown_correlation_tracker():
+    with pytest.raises(ValueError):
+        ObjectTracker(correlation="unknown")
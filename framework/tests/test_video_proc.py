@@ -0,0 +1,150 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import cv2
+import numpy as np
+import pytest
+
+from jagereye_ng.video_proc import video_proc
+from jagereye_ng.video_proc.video_proc import RoiMask, _count_changed_pixels
+
+
+def filter_alone(image, reference, mask=None):
+    """Filter the difference of a frame alone, as motion detection did."""
+    diff = cv2.absdiff(image, reference)
+    if mask is not None:
+        diff = cv2.bitwise_and(diff, mask)
+    diff = cv2.blur(diff, (5, 5))
+    diff = cv2.morphologyEx(diff, cv2.MORPH_OPEN, None)
+    diff = cv2.morphologyEx(diff, cv2.MORPH_CLOSE, None)
+    _, changed = cv2.threshold(diff, 10, 255, cv2.THRESH_BINARY)
+    if mask is not None:
+        changed = cv2.bitwise_and(changed, mask)
+    return changed
+
+
+def make_images(num, size, seed):
+    """Make gray images with blobs that touch the borders."""
+    width, height = size
+    rng = np.random.RandomState(seed)
+    images = rng.randint(0, 8, (num, height, width)).astype(np.uint8)
+    for image in images:
+        for _ in range(4):
+            x, y = rng.randint(-3, width), rng.randint(-3, height)
+            w, h = rng.randint(1, 6, size=2)
+            image[max(0, y):y + h, max(0, x):x + w] = rng.randint(20, 256)
+        # Thin lines along the top and bottom borders.
+        image[0, rng.randint(width):] = 255
+        image[-1, :rng.randint(width)] = 255
+    return images
+
+
+@pytest.mark.parametrize("size", [(32, 24), (17, 5), (9, 2), (6, 1)])
+@pytest.mark.parametrize("use_mask", [False, True])
+def test_stacked_filter_equals_filter_alone(size, use_mask):
+    num = 7
+    images = make_images(num, size, seed=0)
+    references = make_images(num, size, seed=1)
+    mask = None
+    if use_mask:
+        mask = np.zeros(images.shape[1:], dtype=np.uint8)
+        mask[:, :size[0] // 2 + 1] = 255
+    origin = (0, 0) + size
+    counts, regions = _count_changed_pixels(images, references, mask, origin)
+
+    for i in range(num):
+        changed = filter_alone(images[i], references[i], mask)
+        assert counts[i] == cv2.countNonZero(changed)
+        assert regions[i] == video_proc._get_regions(changed, origin)
+
+
+def test_stacked_filter_in_groups(monkeypatch):
+    # Stack a few frames at a time, so the last group is partial.
+    size = (16, 12)
+    monkeypatch.setattr(video_proc, "_MAX_STACK_PIXELS",
+                        3 * 16 * (12 + video_proc._SEAM_ROWS))
+    images = make_images(8, size, seed=2)
+    references = make_images(8, size, seed=3)
+    counts = _count_changed_pixels(images, references)
+    assert counts == [cv2.countNonZero(filter_alone(image, reference))
+                      for image, reference in zip(images, references)]
+
+
+def make_boxes(frame_size, roi, rng):
+    """Make random, degenerate, sliver and edge touching boxes."""
+    width, height = frame_size
+    corners = rng.rand(300, 4) * [width, height, width, height]
+    boxes = np.concatenate([np.minimum(corners[:, :2], corners[:, 2:]),
+                            np.maximum(corners[:, :2], corners[:, 2:])],
+                           axis=1)
+    # Small boxes.
+    boxes[:60, 2:] = boxes[:60, :2] + rng.rand(60, 2) * 3
+    # Zero width, zero height and zero size boxes.
+    boxes[60:70, 2] = boxes[60:70, 0]
+    boxes[70:80, 3] = boxes[70:80, 1]
+    boxes[80:90, 2:] = boxes[80:90, :2]
+    # Slivers, thinner than the cells of the mask.
+    boxes[90:110, 2] = boxes[90:110, 0] + rng.rand(20) * 0.5
+    boxes[110:130, 3] = boxes[110:130, 1] + rng.rand(20) * 0.5
+    # Boxes that touch the points of the region from outside or inside.
+    points = np.array(roi, dtype=np.float64)
+    for i in range(130, 170):
+        x, y = points[i % len(points)]
+        w, h = rng.rand(2) * 20
+        (dx, dy) = rng.randint(2, size=2)
+        boxes[i] = (x - w * dx, y - h * dy, x + w * (1 - dx),
+                    y + h * (1 - dy))
+    # Boxes partly out of the frame.
+    boxes[170:180, :2] -= width / 2
+    boxes[180:190, 2:] += width / 2
+    return boxes
+
+
+def make_star(frame_size, rng, geometry):
+    """Make a valid random star shaped polygon."""
+    width, height = frame_size
+    while True:
+        center = rng.rand(2) * [width, height]
+        angles = np.sort(rng.rand(rng.randint(3, 12)) * 2 * np.pi)
+        radii = (rng.rand(len(angles)) * 0.6 + 0.02) * min(width, height)
+        points = np.stack([center[0] + radii * np.cos(angles),
+                           center[1] + radii * np.sin(angles)], axis=1)
+        roi = [tuple(p) for p in np.clip(points, 0, [width, height])]
+        if geometry.Polygon(roi).is_valid:
+            return roi
+
+
+@pytest.mark.parametrize("frame_size", [(300, 300), (1920, 1080)])
+def test_roi_mask_equals_polygon_intersection(frame_size):
+    geometry = pytest.importorskip("shapely.geometry")
+    width, height = frame_size
+    rng = np.random.RandomState(0)
+    rois = [
+        # A concave L shape with a slanted edge.
+        [(0.1 * width, 0.2 * height), (0.6 * width, 0.1 * height),
+         (0.6 * width, 0.5 * height), (0.9 * width, 0.5 * height),
+         (0.9 * width, 0.9 * height), (0.1 * width, 0.9 * height)],
+        # The whole frame.
+        [(0, 0), (width, 0), (width, height), (0, height)],
+        # Thin polygons, thinner than the cells of the mask.
+        [(0.1 * width, 0.5 * height), (0.9 * width, 0.5 * height),
+         (0.9 * width, 0.5 * height + 0.3), (0.1 * width, 0.5 * height + 0.3)],
+        [(0.1 * width, 0.1 * height), (0.1 * width + 0.4, 0.1 * height),
+         (0.8 * width + 0.4, 0.9 * height), (0.8 * width, 0.9 * height)]
+    ]
+    rois += [make_star(frame_size, rng, geometry) for _ in range(20)]
+
+    for roi in rois:
+        polygon = geometry.Polygon(roi)
+        roi_mask = RoiMask(roi, frame_size)
+        boxes = make_boxes(frame_size, roi, rng)
+        results = roi_mask.overlaps(boxes)
+        assert len(results) == len(boxes)
+        for box, result in zip(boxes.tolist(), results.tolist()):
+            (xmin, ymin, xmax, ymax) = box
+            expected = polygon.intersection(geometry.box(
+                xmin, ymin, xmax, ymax)).area > 0.0
+            if result == RoiMask.UNDECIDED:
+                continue
+            assert bool(result) == expected, (roi, box)